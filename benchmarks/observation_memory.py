@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Measures the memory used per observation.
+
+Each observation gets its own value object; the patient, concept, visit
+and trial visit are shared, as is typical for real data collections.
+The memory use of the Observation and NumericalValue classes is compared
+with a baseline of equivalent classes that store their attributes in an
+instance dictionary, as these classes did before they declared slots.
+
+Usage: python benchmarks/observation_memory.py [count]
+"""
+import sys
+import tracemalloc
+from datetime import date
+from typing import Optional, Any
+
+from transmart_loader.transmart import Concept, ValueType, Study, \
+    TrialVisit, Patient, Visit, Observation, NumericalValue
+
+
+class DictNumericalValue:
+    """
+    A numerical value with an instance dictionary.
+    """
+    def __init__(self, value: Optional[float]):
+        self._value = value
+
+    @property
+    def value_type(self):
+        return ValueType.Numeric
+
+    @property
+    def value(self):
+        return self._value
+
+
+class DictObservation:
+    """
+    An observation with an instance dictionary.
+    """
+    def __init__(self,
+                 patient: Patient,
+                 concept: Concept,
+                 visit: Optional[Visit],
+                 trial_visit: TrialVisit,
+                 start_date: Optional[date],
+                 end_date: Optional[date],
+                 value: Any,
+                 metadata: Any = None):
+        self.patient = patient
+        self.concept = concept
+        self.visit = visit
+        self.trial_visit = trial_visit
+        self.start_date = start_date
+        self.end_date = end_date
+        self.value = value
+        self.metadata = metadata
+
+
+def measure(count: int, observation_class=Observation,
+            value_class=NumericalValue) -> float:
+    concept = Concept('test:age', 'Age', '\\Test\\age', ValueType.Numeric)
+    trial_visit = TrialVisit(Study('test', 'Test study'), 'Week 1', 'Week', 1)
+    patient = Patient('SUBJ0', 'male', [])
+    visit = Visit(patient, 'visit1', None, None, None, None, None, None, [])
+    start_date = date(2019, 3, 28)
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    observations = [
+        observation_class(patient, concept, visit, trial_visit, start_date,
+                          None, value_class(index))
+        for index in range(count)]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    # Exclude the list itself and the integer values
+    overhead = sys.getsizeof(observations) + \
+        sum(sys.getsizeof(index) for index in range(count))
+    return (after - before - overhead) / count
+
+
+if __name__ == '__main__':
+    observation_count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    baseline = measure(observation_count, DictObservation, DictNumericalValue)
+    current = measure(observation_count)
+    print('{:.1f} bytes per observation with instance dictionaries'.format(
+        baseline))
+    print('{:.1f} bytes per observation with slots'.format(current))
+    print('{:.0%} less memory'.format(1 - current / baseline))
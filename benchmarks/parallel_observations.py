@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Benchmarks writing observations in parallel with the TransmartCopyWriter.
+
+Writes the observations of a synthetic data collection with one process
+and with several worker processes and reports the wall time and the speed-up
+of each. The CPU time of the writer process is reported as well: the
+workers write the observations, so the CPU time of the writer process,
+which appends the shard files, bounds the speed-up that more CPUs can give.
+For comparison, the time to pickle and unpickle the observations is
+reported, which a pool of workers that receives the observations instead
+of inheriting them would spend on top of writing them.
+
+Usage: python benchmarks/parallel_observations.py [count] [workers ...]
+"""
+import os
+import pickle
+import shutil
+import sys
+import tempfile
+import time
+from typing import Tuple
+
+from transmart_loader.copy_writer import TransmartCopyWriter
+from transmart_loader.synthetic import SyntheticCollectionSettings, \
+    generate_collection
+from transmart_loader.transmart import DataCollection
+
+
+def write(collection: DataCollection, workers: int) -> Tuple[float, float]:
+    """ Writes the collection and returns the wall time and the CPU time
+    of this process.
+    """
+    temp_dir = tempfile.mkdtemp()
+    try:
+        writer = TransmartCopyWriter(os.path.join(temp_dir, 'output'),
+                                     workers=workers)
+        start = time.perf_counter()
+        start_cpu = time.process_time()
+        writer.write_collection(collection)
+        writer.close()
+        return time.perf_counter() - start, time.process_time() - start_cpu
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+if __name__ == '__main__':
+    observation_count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    worker_counts = [int(count) for count in sys.argv[2:]] \
+        or [2, os.cpu_count() or 1]
+    collection = generate_collection(SyntheticCollectionSettings(
+        patients=max(1, observation_count // 20),
+        visits_per_patient=(1, 3), observations_per_visit=(5, 15)))
+    # The workers read the observations from a list they inherit
+    collection.observations = list(collection.observations)
+    print('{} observations, {} CPUs'.format(
+        len(collection.observations), os.cpu_count()))
+    serial, serial_cpu = write(collection, 1)
+    print('1 process: {:.2f} s'.format(serial))
+    for workers in sorted(set(worker_counts) - {1}):
+        seconds, cpu = write(collection, workers)
+        print('{} workers: {:.2f} s, {:.1f}x, writer process CPU '
+              '{:.2f} s'.format(workers, seconds, serial / seconds, cpu))
+    start = time.perf_counter()
+    pickle.loads(pickle.dumps(collection.observations,
+                              pickle.HIGHEST_PROTOCOL))
+    print('Pickling the observations: {:.2f} s'.format(
+        time.perf_counter() - start))
@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Benchmarks writing data collections with the TransmartCopyWriter.
+
+Writes synthetic data collections of several sizes, each in a separate
+process, and reports the end-to-end time of writing the collection,
+including validation, the observations written per second of that time,
+the time per writer method (as recorded by the writer metrics), per output
+table the number of rows, the time spent writing the rows of the table and
+the bytes written, and the peak memory of the process. The results are
+written as JSON.
+
+If a baseline results file is specified, the benchmark fails when the
+end-to-end time or the time of a writer method exceeds the baseline time
+by more than the tolerance, i.e., when the throughput drops by more than
+the tolerance. Times shorter than min_seconds in the baseline are not
+compared, because they are too short to measure reliably.
+
+Usage:
+    python benchmarks/write_collection.py [--sizes 10000 100000]
+        [--output results.json] [--baseline baseline.json] [--tolerance 0.2]
+"""
+import argparse
+import csv
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Any, List, Optional
+
+from transmart_loader.copy_writer import TransmartCopyWriter
+from transmart_loader.metrics import Metrics
+from transmart_loader.synthetic import SyntheticCollectionSettings, \
+    generate_collection
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+
+def benchmark_settings(size: int) -> SyntheticCollectionSettings:
+    """ Settings for a synthetic collection with about size observations.
+    """
+    return SyntheticCollectionSettings(patients=max(1, size // 20),
+                                       visits_per_patient=(1, 3),
+                                       observations_per_visit=(5, 15))
+
+
+min_seconds = 0.05
+
+
+def count_rows(file_path: str) -> int:
+    """ Counts the records of a table file, excluding the header. Quoted
+    values can contain line breaks, so lines are not counted.
+    """
+    with open(file_path, newline='') as file:
+        return sum(1 for _ in csv.reader(file, dialect='excel-tab')) - 1
+
+
+def run_benchmark(size: int) -> Dict[str, Any]:
+    """ Writes a generated collection and measures the throughput.
+    Runs in a separate process, such that the peak memory is measured
+    per collection size.
+    """
+    collection = generate_collection(benchmark_settings(size))
+    temp_dir = tempfile.mkdtemp()
+    output_dir = os.path.join(temp_dir, 'output')
+    metrics = Metrics()
+    writer = TransmartCopyWriter(output_dir, metrics=metrics)
+    start = time.perf_counter()
+    writer.write_collection(collection, streaming=True)
+    writer.close()
+    seconds = time.perf_counter() - start
+    tables = {}
+    for schema in ['i2b2demodata', 'i2b2metadata']:
+        for file_name in sorted(os.listdir(os.path.join(output_dir, schema))):
+            file_path = os.path.join(output_dir, schema, file_name)
+            table = schema + '/' + file_name.split('.')[0]
+            rows = count_rows(file_path)
+            table_seconds = metrics.tables[table].seconds
+            tables[table] = {
+                'rows': rows,
+                'bytes': os.path.getsize(file_path),
+                'seconds': table_seconds,
+                'rows_per_second':
+                    rows / table_seconds if table_seconds > 0 else None
+            }
+    shutil.rmtree(temp_dir)
+    peak_memory = None
+    if resource is not None:
+        peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform != 'darwin':
+            peak_memory = peak_memory * 1024
+    observations = tables['i2b2demodata/observation_fact']['rows']
+    return {
+        'size': size,
+        'seconds': seconds,
+        'observations_per_second': observations / seconds,
+        'bytes': sum(table['bytes'] for table in tables.values()),
+        'peak_memory_bytes': peak_memory,
+        'methods': {name: {'calls': method['calls'],
+                           'seconds': method['seconds']}
+                    for name, method in metrics.report()['methods'].items()},
+        'tables': tables
+    }
+
+
+def run_benchmarks(sizes: List[int]) -> Dict[str, Any]:
+    results = []
+    context = multiprocessing.get_context('spawn')
+    for size in sizes:
+        with ProcessPoolExecutor(1, mp_context=context) as executor:
+            results.append(executor.submit(run_benchmark, size).result())
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': results
+    }
+
+
+def is_slower(seconds: float, baseline_seconds: float,
+              tolerance: float) -> bool:
+    """ Checks if a time exceeds the baseline time by more than the
+    tolerance, expressed as a relative decrease of throughput. Baseline
+    times shorter than min_seconds are not compared.
+    """
+    return baseline_seconds >= min_seconds \
+        and seconds * (1 - tolerance) > baseline_seconds
+
+
+def find_regressions(results: Dict[str, Any],
+                     baseline: Dict[str, Any],
+                     tolerance: float) -> List[str]:
+    """ Compares the end-to-end time and the time per writer method with
+    the baseline.
+
+    :return: a message for the end-to-end time and for each method that is
+             slower than the baseline time, with the tolerance.
+    """
+    regressions = []
+    baseline_results = {result['size']: result
+                        for result in baseline['results']}
+    for result in results['results']:
+        baseline_result = baseline_results.get(result['size'])
+        if baseline_result is None:
+            continue
+        if is_slower(result['seconds'], baseline_result['seconds'],
+                     tolerance):
+            regressions.append(
+                'end-to-end (size {}): {:.2f} s, baseline {:.2f} s'.format(
+                    result['size'], result['seconds'],
+                    baseline_result['seconds']))
+        baseline_methods = baseline_result.get('methods', {})
+        for name, method in sorted(result['methods'].items()):
+            baseline_method = baseline_methods.get(name)
+            if baseline_method is not None and is_slower(
+                    method['seconds'], baseline_method['seconds'],
+                    tolerance):
+                regressions.append(
+                    '{} (size {}): {:.2f} s, baseline {:.2f} s'.format(
+                        name, result['size'], method['seconds'],
+                        baseline_method['seconds']))
+    return regressions
+
+
+def main(arguments: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+        description='Benchmark writing data collections.')
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[10000, 100000, 1000000],
+                        help='numbers of observations')
+    parser.add_argument('--output', default='benchmark_results.json',
+                        help='the results file')
+    parser.add_argument('--baseline', help='baseline results file')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed relative throughput decrease, of '
+                             'the end-to-end time and per method')
+    args = parser.parse_args(arguments)
+
+    results = run_benchmarks(args.sizes)
+    with open(args.output, 'w') as output_file:
+        json.dump(results, output_file, indent=2)
+    for result in results['results']:
+        print('{:>10} observations: {:8.2f} s, {:10.0f} observations/s, '
+              '{:12} bytes, peak memory {} bytes'.format(
+                  result['size'], result['seconds'],
+                  result['observations_per_second'], result['bytes'],
+                  result['peak_memory_bytes']))
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = find_regressions(results, baseline, args.tolerance)
+        for regression in regressions:
+            print('Regression: ' + regression, file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
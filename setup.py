@@ -69,5 +69,8 @@ setup(
     ],
     extras_require={
         'dev':  ['prospector[with_pyroma]', 'yapf', 'isort'],
+        'numpy': ['numpy'],
+        'zstd': ['zstandard'],
+        'postgres': ['psycopg>=3.0'],
     }
 )
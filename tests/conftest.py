@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Data collections shared by the tests.
+"""
+from datetime import date, datetime
+from typing import List
+
+import pytest
+
+from transmart_loader.transmart import DataCollection, Concept, Study, \
+    TrialVisit, Visit, TreeNode, Patient, Observation, ValueType, StudyNode, \
+    ConceptNode, CategoricalValue, Modifier, ObservationMetadata, \
+    TextValue, DateValue, Dimension, DimensionType, RelationType, Relation, \
+    TreeNodeMetadata, StudyMetadata
+
+
+@pytest.fixture
+def empty_collection() -> DataCollection:
+    concepts: List[Concept] = []
+    modifiers: List[Modifier] = []
+    dimensions: List[Dimension] = []
+    studies: List[Study] = []
+    trial_visits: List[TrialVisit] = []
+    patients: List[Patient] = []
+    visits: List[Visit] = []
+    ontology: List[TreeNode] = []
+    observations: List[Observation] = []
+    collection = DataCollection(concepts, modifiers, dimensions, studies,
+                                trial_visits, visits, ontology, patients,
+                                observations)
+    return collection
+
+
+@pytest.fixture
+def simple_collection() -> DataCollection:
+    concepts: List[Concept] = [
+        Concept('dummy_code', 'Dummy variable', '\\dummy\\path',
+                ValueType.Categorical),
+        Concept('diagnosis_date', 'Diagnosis date', '\\diagnosis_date',
+                ValueType.Date),
+        Concept('extra_c1', 'Extra c1', '\\c1', ValueType.Categorical),
+        Concept('extra_c2', 'Extra c2', '\\c1', ValueType.Categorical)]
+    modifiers: List[Modifier] = [
+        Modifier('missing_value', 'Missing value', '\\missing_value',
+                 ValueType.Text),
+        Modifier('sample_id', 'Sample ID', '\\sample_id',
+                 ValueType.Numeric)]
+    dimensions: List[Dimension] = [
+        Dimension('sample', modifiers[1], DimensionType.Subject, 1)
+    ]
+    study_metadata = StudyMetadata(**{'conceptCodeToVariableMetadata': {
+        'test_concept': {
+            'name': 'variable_1',
+            'type': 'DATETIME'
+        }
+    }})
+    studies: List[Study] = [Study('test', 'Test study', study_metadata)]
+    trial_visits: List[TrialVisit] = [
+        TrialVisit(studies[0], 'Week 1', 'Week', 1)]
+    patients: List[Patient] = [Patient('SUBJ0', 'male', [])]
+    visits: List[Visit] = [
+        Visit(patients[0], 'visit1', None, None, None, None, None, None, [])]
+    top_node = StudyNode(studies[0])
+    top_node.metadata = TreeNodeMetadata(
+        {'Upload date': '2019-07-01'})
+    top_node.add_child(ConceptNode(concepts[0]))
+    top_node.add_child(ConceptNode(concepts[1]))
+
+    node2 = TreeNode('Extra node')
+    node2.add_child((ConceptNode(concepts[2])))
+    node3 = TreeNode('Extra node')
+    node3.add_child(ConceptNode(concepts[3]))
+
+    ontology: List[TreeNode] = [top_node, node2, node3]
+    observations: List[Observation] = [
+        Observation(patients[0], concepts[0], visits[0], trial_visits[0],
+                    date(2019, 3, 28), None, CategoricalValue('value')),
+        Observation(patients[0], concepts[0], visits[0], trial_visits[0],
+                    datetime(2019, 6, 26, 12, 34, 00),
+                    datetime(2019, 6, 28, 16, 46, 13, 345),
+                    CategoricalValue(None),
+                    ObservationMetadata({
+                        modifiers[0]: TextValue('Invalid')
+                    })),
+        Observation(patients[0], concepts[1], visits[0], trial_visits[0],
+                    datetime(2019, 6, 26, 13, 50, 10), None,
+                    DateValue(datetime(2018, 4, 30, 17, 10, 00)))
+    ]
+    collection = DataCollection(concepts, modifiers, dimensions, studies,
+                                trial_visits, visits, ontology, patients,
+                                observations)
+    return collection
+
+
+@pytest.fixture
+def collection_with_relations() -> DataCollection:
+    concepts: List[Concept] = [
+        Concept('dummy_code', 'Dummy variable', '\\dummy\\path',
+                ValueType.Categorical)]
+    studies: List[Study] = [Study('test', 'Test study')]
+    trial_visits: List[TrialVisit] = [
+        TrialVisit(studies[0], 'Week 1', 'Week', 1)]
+    patients: List[Patient] = [
+        Patient('SUBJ0', 'male', []),
+        Patient('SUBJ1', 'female', []),
+        Patient('SUBJ2', 'female', [])
+    ]
+    visits: List[Visit] = [
+        Visit(patients[0], 'visit1', None, None, None, None, None, None, [])]
+    top_node = StudyNode(studies[0])
+    top_node.add_child(ConceptNode(concepts[0]))
+    ontology: List[TreeNode] = [top_node]
+    relation_types = [RelationType('parent', None, None, None),
+                      RelationType('sibling', 'Sibling of', True, True)]
+    relations = [
+        Relation(patients[0], relation_types[0], patients[1], None, None),
+        Relation(patients[0], relation_types[0], patients[2], None, None),
+        Relation(patients[1], relation_types[1], patients[2], True, True)]
+    collection = DataCollection(concepts, [], [], studies,
+                                trial_visits, visits, ontology, patients,
+                                [], relation_types, relations)
+    return collection
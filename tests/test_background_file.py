@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for output files written by background threads.
+"""
+from os import path
+
+import pytest
+
+from transmart_loader.background_file import BackgroundFile
+from transmart_loader.copy_writer import TransmartCopyWriter
+from transmart_loader.loader_exception import LoaderException
+from transmart_loader.synthetic import SyntheticCollectionSettings, \
+    generate_collection
+
+
+class FailingStream:
+    def __init__(self):
+        self.chunks = 0
+
+    def write(self, chunk: bytes) -> None:
+        self.chunks = self.chunks + 1
+        raise IOError('Disk full')
+
+    def close(self) -> None:
+        pass
+
+
+def test_threaded_output(tmp_path):
+    collection = generate_collection(SyntheticCollectionSettings(patients=50))
+    serial_path = (tmp_path / 'serial').as_posix()
+    writer = TransmartCopyWriter(serial_path)
+    writer.write_collection(collection)
+    writer.close()
+
+    threaded_path = (tmp_path / 'threaded').as_posix()
+    writer = TransmartCopyWriter(threaded_path, threaded=True)
+    writer.write_collection(collection)
+    writer.close()
+
+    for table in ['i2b2demodata/observation_fact.tsv',
+                  'i2b2demodata/patient_dimension.tsv',
+                  'i2b2metadata/i2b2_secure.tsv']:
+        with open(path.join(serial_path, table), 'rb') as serial_file, \
+                open(path.join(threaded_path, table), 'rb') as threaded_file:
+            assert threaded_file.read() == serial_file.read()
+
+
+def test_background_file_sync(tmp_path):
+    file_path = (tmp_path / 'test.tsv').as_posix()
+    background_file = BackgroundFile(file_path, buffer_size=10, queue_size=1)
+    lines = ['line {}\r\n'.format(index) for index in range(1000)]
+    for line in lines[:500]:
+        background_file.write(line)
+    assert background_file.sync() == len(''.join(lines[:500]))
+    for line in lines[500:]:
+        background_file.write(line)
+    background_file.close()
+    background_file.close()
+    with open(file_path, newline='') as file:
+        assert file.read() == ''.join(lines)
+
+
+def test_background_file_error(tmp_path):
+    file_path = (tmp_path / 'test.tsv').as_posix()
+    background_file = BackgroundFile(file_path, buffer_size=10, queue_size=1)
+    stream = FailingStream()
+    background_file.stream = stream
+    with pytest.raises(LoaderException, match='Disk full'):
+        for index in range(1000):
+            background_file.write('line {}\r\n'.format(index))
+    # The failed file does not block and raises the error when closed
+    with pytest.raises(LoaderException, match='Disk full'):
+        background_file.close()
+    assert stream.chunks == 1
+    assert not background_file.thread.is_alive()
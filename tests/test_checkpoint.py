@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for checkpoints and resuming interrupted writes.
+"""
+import os
+from typing import Dict, Optional
+
+import pytest
+
+from transmart_loader.compression import Compression, CompressionFormat, \
+    open_compressed
+from transmart_loader.copy_writer import TransmartCopyWriter
+from transmart_loader.loader_exception import LoaderException
+from transmart_loader.synthetic import SyntheticCollectionSettings, \
+    generate_collection
+
+
+def interrupted(items, count: int):
+    for index, item in enumerate(items):
+        if index == count:
+            raise RuntimeError('Interrupted')
+        yield item
+
+
+def read_output(output_dir: str,
+                compression: Optional[Compression]) -> Dict[str, str]:
+    output = {}
+    for schema in ['i2b2demodata', 'i2b2metadata']:
+        for file_name in os.listdir(os.path.join(output_dir, schema)):
+            with open_compressed(os.path.join(output_dir, schema, file_name),
+                                 compression) as file:
+                output[schema + '/' + file_name] = file.read()
+    return output
+
+
+@pytest.mark.parametrize('compression', [
+    None, Compression(CompressionFormat.Gzip)])
+def test_resume_from_checkpoint(tmp_path, compression):
+    settings = SyntheticCollectionSettings(patients=60)
+    expected_path = (tmp_path / 'expected').as_posix()
+    writer = TransmartCopyWriter(expected_path, compression=compression)
+    writer.write_collection(generate_collection(settings), streaming=True)
+    writer.close()
+
+    target_path = (tmp_path / 'output').as_posix()
+    collection = generate_collection(settings)
+    collection.observations = interrupted(collection.observations, 300)
+    writer = TransmartCopyWriter(target_path, compression=compression,
+                                 checkpoint_interval=0)
+    # Save a checkpoint every 16 entities
+    writer.checkpoints.check_items = 16
+    writer.checkpoints.max_overhead = float('inf')
+    with pytest.raises(RuntimeError):
+        writer.write_collection(collection, streaming=True)
+    # Rows written after the last checkpoint are flushed as well
+    writer.close()
+    assert os.path.exists(os.path.join(target_path, 'checkpoint.pickle'))
+
+    writer = TransmartCopyWriter(target_path, compression=compression,
+                                 checkpoint_interval=0, resume=True)
+    assert 0 < writer.instance_num <= 300
+    writer.write_collection(generate_collection(settings), streaming=True)
+    writer.close()
+
+    assert not os.path.exists(os.path.join(target_path, 'checkpoint.pickle'))
+    assert read_output(target_path, compression) == \
+        read_output(expected_path, compression)
+
+
+def test_resume_without_checkpoint(tmp_path):
+    with pytest.raises(LoaderException):
+        TransmartCopyWriter(tmp_path.as_posix(), checkpoint_interval=60,
+                            resume=True)
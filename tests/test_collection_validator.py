@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for the referential integrity checks of the collection validator.
+"""
+import csv
+from datetime import date
+
+import pytest
+
+from transmart_loader.collection_validator import CollectionValidator
+from transmart_loader.copy_writer import TransmartCopyWriter
+from transmart_loader.digest_set import DigestSet
+from transmart_loader.identifier_store import CompactIdentifierStore
+from transmart_loader.loader_exception import LoaderException
+from transmart_loader.transmart import Patient, Visit, Observation, \
+    CategoricalValue, Relation, RelationType, Modifier, Dimension, \
+    DimensionType, Concept, ValueType, ConceptNode
+
+
+def test_valid_collections(simple_collection, collection_with_relations):
+    for collection in [simple_collection, collection_with_relations]:
+        validator = CollectionValidator()
+        validator.visit(collection)
+        assert validator.errors == []
+        validator.report()
+
+
+def test_missing_references(collection_with_relations):
+    collection = collection_with_relations
+    unknown_patient = Patient('SUBJX', 'female', [])
+    unknown_type = RelationType('cousin', None, None, None)
+    unknown_concept = Concept('unknown', 'Unknown', '\\unknown',
+                              ValueType.Categorical)
+    unknown_modifier = Modifier('unknown', 'Unknown', '\\unknown',
+                                ValueType.Text)
+    collection.visits = list(collection.visits) + [
+        Visit(unknown_patient, 'visitX', None, None, None, None, None, None,
+              [])]
+    collection.relations = list(collection.relations) + [
+        Relation(collection.patients[0], unknown_type, unknown_patient,
+                 None, None)]
+    collection.dimensions = [
+        Dimension('sample', unknown_modifier, DimensionType.Subject, 1)]
+    collection.ontology[0].add_child(ConceptNode(unknown_concept))
+    collection.observations = [
+        Observation(unknown_patient, unknown_concept, None,
+                    collection.trial_visits[0], date(2019, 3, 28), None,
+                    CategoricalValue('value'))]
+
+    validator = CollectionValidator()
+    validator.visit(collection)
+    assert validator.errors == [
+        'Dimension sample refers to unknown modifier unknown',
+        'Visit visitX refers to unknown patient SUBJX',
+        'Node Unknown refers to unknown concept unknown',
+        'Observation of concept unknown of patient SUBJX '
+        'refers to unknown patient SUBJX',
+        'Observation of concept unknown of patient SUBJX '
+        'refers to unknown concept unknown',
+        'Relation cousin of patient SUBJ0 refers to unknown patient SUBJX',
+        'Relation cousin of patient SUBJ0 refers to unknown relation type '
+        'cousin']
+    with pytest.raises(LoaderException):
+        validator.report()
+
+
+def test_bounded_errors(simple_collection):
+    unknown_patient = Patient('SUBJX', 'female', [])
+    observation = simple_collection.observations[0]
+    simple_collection.observations = [
+        Observation(unknown_patient, observation.concept, None,
+                    observation.trial_visit, observation.start_date, None,
+                    observation.value)] * 1000
+    validator = CollectionValidator()
+    validator.max_errors = 10
+    validator.visit(simple_collection)
+    assert len(validator.errors) == 10
+    assert validator.error_count == 1000
+
+
+def test_streaming_skips_invalid_entities(tmp_path, simple_collection):
+    unknown_patient = Patient('SUBJX', 'female', [])
+    observation = simple_collection.observations[0]
+    simple_collection.observations = iter(
+        list(simple_collection.observations) + [
+            Observation(unknown_patient, observation.concept, None,
+                        observation.trial_visit, observation.start_date,
+                        None, observation.value)])
+    writer = TransmartCopyWriter(tmp_path.as_posix())
+    # The error is raised after writing, instead of a KeyError
+    with pytest.raises(LoaderException):
+        writer.write_collection(simple_collection, streaming=True)
+    writer.close()
+    with open((tmp_path / 'i2b2demodata/observation_fact.tsv').as_posix(),
+              newline='') as file:
+        rows = list(csv.reader(file, dialect='excel-tab'))
+    assert len(rows) == 5
+
+
+def test_compact_identifier_store(tmp_path, collection_with_relations):
+    store = CompactIdentifierStore(
+        verification_directory=(tmp_path / 'keys').as_posix())
+    validator = CollectionValidator(store)
+    validator.visit(collection_with_relations)
+    validator.close()
+    assert validator.errors == []
+    assert isinstance(validator.patients, DigestSet)
+    assert len(validator.patients) == len(collection_with_relations.patients)
+
+    writer = TransmartCopyWriter((tmp_path / 'output').as_posix(),
+                                 identifier_store=store)
+    writer.write_collection(collection_with_relations, streaming=True)
+    writer.close()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for compressed output of the TransmartCopyWriter.
+"""
+import gzip
+from os import path
+
+import pytest
+
+from transmart_loader.compression import Compression, CompressionFormat, \
+    CompressedFile
+from transmart_loader.copy_writer import TransmartCopyWriter
+
+
+def read_table(target_path: str, table: str) -> bytes:
+    with open(path.join(target_path, table), 'rb') as file:
+        return file.read()
+
+
+def test_compressed_output(tmp_path, simple_collection):
+    plain_path = (tmp_path / 'plain').as_posix()
+    writer = TransmartCopyWriter(plain_path)
+    writer.write_collection(simple_collection)
+    writer.close()
+
+    compressed_path = (tmp_path / 'compressed').as_posix()
+    writer = TransmartCopyWriter(
+        compressed_path,
+        compression=Compression(CompressionFormat.Gzip),
+        table_compression={
+            'observation_fact': Compression(CompressionFormat.Gzip, 1),
+            'study': None})
+    writer.write_collection(simple_collection)
+    writer.close()
+
+    for table in ['i2b2demodata/observation_fact.tsv',
+                  'i2b2demodata/concept_dimension.tsv',
+                  'i2b2metadata/i2b2_secure.tsv']:
+        assert gzip.decompress(read_table(compressed_path, table + '.gz')) \
+            == read_table(plain_path, table)
+    assert read_table(compressed_path, 'i2b2demodata/study.tsv') \
+        == read_table(plain_path, 'i2b2demodata/study.tsv')
+
+
+def test_compressed_file_buffers(tmp_path):
+    file_path = (tmp_path / 'test.tsv').as_posix()
+    compressed_file = CompressedFile(
+        file_path + '.gz', Compression(CompressionFormat.Gzip, 9),
+        buffer_size=10, queue_size=1)
+    lines = ['line {}\r\n'.format(index) for index in range(1000)]
+    for line in lines:
+        compressed_file.write(line)
+    compressed_file.close()
+    compressed_file.close()
+    with gzip.open(file_path + '.gz', 'rt', newline='') as file:
+        assert file.read() == ''.join(lines)
+
+
+def test_zstd_compressed_file(tmp_path):
+    zstandard = pytest.importorskip('zstandard')
+    file_path = (tmp_path / 'test.tsv.zst').as_posix()
+    compressed_file = CompressedFile(
+        file_path, Compression(CompressionFormat.Zstd))
+    compressed_file.write('a\tb\r\n')
+    compressed_file.close()
+    with open(file_path, 'rb') as file:
+        with zstandard.ZstdDecompressor().stream_reader(file) as reader:
+            assert reader.read() == b'a\tb\r\n'
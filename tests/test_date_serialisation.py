@@ -4,8 +4,12 @@
 """Tests for the date formatter of the TransmartCopyWriter.
 """
 from datetime import datetime, timezone, date
+
+import pytest
 from dateutil.tz import gettz
-from transmart_loader.copy_writer import format_date, microseconds
+
+from transmart_loader.copy_writer import format_date, microseconds, \
+    format_date_array, microseconds_array
 
 
 def test_date_serialization():
@@ -27,3 +31,43 @@ def test_date_serialization():
     assert format_date(datetime.fromtimestamp(
         microseconds(datetime(2019, 6, 28, 13, 2, 58))/1000,
         timezone.utc)) == '2019-06-28 13:02:58'
+
+
+def test_cached_date_serialization():
+    amsterdam = datetime(2019, 6, 28, 13, 2, 58,
+                         tzinfo=gettz('Europe/Amsterdam'))
+    utc = datetime(2019, 6, 28, 11, 2, 58, tzinfo=timezone.utc)
+    assert amsterdam == utc
+    for _ in range(2):
+        assert format_date(amsterdam) == format_date(utc) == \
+            '2019-06-28 11:02:58'
+        assert microseconds(amsterdam) == \
+            microseconds(datetime(2019, 6, 28, 13, 2, 58))
+        assert microseconds(utc) == \
+            microseconds(datetime(2019, 6, 28, 11, 2, 58))
+        assert format_date(date(2019, 6, 28)) == '2019-06-28'
+        assert format_date(datetime(2019, 6, 28)) != '2019-06-28'
+
+
+def test_date_array_serialization():
+    np = pytest.importorskip('numpy')
+    values = [datetime(2019, 6, 28, 13, 2, 58),
+              datetime(2019, 6, 28, 13, 2, 58, 12345),
+              datetime(1969, 12, 31, 23, 59, 59, 500000)]
+    utc_values = [value.replace(tzinfo=timezone.utc) for value in values]
+    array = np.array(values + ['NaT'], dtype='datetime64[us]')
+    assert format_date_array(array).tolist() == \
+        [format_date(value) for value in utc_values] + ['']
+    assert format_date_array(array.view(np.int64)).tolist() == \
+        [format_date(value) for value in utc_values] + ['']
+    timestamps = microseconds_array(array)
+    assert timestamps[:3].tolist() == \
+        [microseconds(value) for value in values]
+    assert np.isnan(timestamps[3])
+
+    dates = [date(2019, 6, 28), date(1900, 1, 1)]
+    array = np.array(dates + ['NaT'], dtype='datetime64[D]')
+    assert format_date_array(array).tolist() == \
+        [format_date(value) for value in dates] + ['']
+    assert microseconds_array(array)[:2].tolist() == \
+        [microseconds(value) for value in dates]
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for the compact digest sets.
+"""
+import os
+import pickle
+import sys
+
+from transmart_loader import digest_set
+from transmart_loader.copy_writer import TransmartCopyWriter
+from transmart_loader.digest_set import DigestSet
+from transmart_loader.identifier_store import SqliteKeySet, \
+    CompactIdentifierStore
+from transmart_loader.synthetic import SyntheticCollectionSettings, \
+    generate_collection
+
+
+def test_digest_set():
+    paths = ['\\Ontology\\{}\\Folder {}\\'.format('x' * 200, index)
+             for index in range(10000)]
+    keys = DigestSet(capacity=16)
+    for path in paths:
+        keys.add(path)
+    keys.add(paths[0])
+    keys.add(('path', 'tag type'))
+    assert len(keys) == 10001
+    assert all(path in keys for path in paths)
+    assert ('path', 'tag type') in keys
+    assert ('path', 'other') not in keys
+    assert '\\Ontology\\' not in keys
+    assert keys.capacity == 32768
+    assert sys.getsizeof(keys.table) * 5 < sys.getsizeof(set(paths)) + sum(
+        sys.getsizeof(path) for path in paths)
+    assert paths[-1] in pickle.loads(pickle.dumps(keys))
+
+
+def test_digest_collisions(tmp_path, monkeypatch):
+    monkeypatch.setattr(digest_set, 'digest',
+                        lambda key: bytes(15) + b'\x02')
+    keys = DigestSet()
+    keys.add('a')
+    # Without verification, keys with the same digest are equal
+    assert 'b' in keys
+
+    verification = SqliteKeySet((tmp_path / 'keys.sqlite').as_posix(),
+                                batch_size=1)
+    keys = DigestSet(verification=verification)
+    keys.add('a')
+    assert 'a' in keys
+    assert 'b' not in keys
+    keys.add('b')
+    assert 'b' in keys
+    assert len(keys) == 2
+    assert keys.collisions == 1
+    keys.close()
+
+
+def test_write_with_compact_identifier_store(tmp_path):
+    settings = SyntheticCollectionSettings(patients=20, studies=2)
+    output = {}
+    for name, store in [
+            ('default', None),
+            ('compact', CompactIdentifierStore()),
+            ('verified', CompactIdentifierStore(
+                verification_directory=(tmp_path / 'keys').as_posix()))]:
+        target_path = (tmp_path / name).as_posix()
+        writer = TransmartCopyWriter(target_path, identifier_store=store)
+        collection = generate_collection(settings)
+        # Concepts are visited twice
+        collection.concepts = collection.concepts * 2
+        writer.write_collection(collection)
+        writer.close()
+        output[name] = {}
+        for table in ['i2b2demodata/concept_dimension',
+                      'i2b2demodata/modifier_dimension',
+                      'i2b2metadata/i2b2_secure']:
+            with open(os.path.join(target_path, table + '.tsv')) as file:
+                output[name][table] = file.read()
+    assert output['compact'] == output['default']
+    assert output['verified'] == output['default']
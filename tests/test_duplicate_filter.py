@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for detecting duplicate observations.
+"""
+import csv
+import os
+from collections import Counter
+from typing import List
+
+import pytest
+
+from transmart_loader.copy_writer import TransmartCopyWriter
+from transmart_loader.duplicate_filter import DuplicateMode, DuplicateFilter
+from transmart_loader.loader_exception import LoaderException
+from transmart_loader.synthetic import SyntheticCollectionSettings, \
+    generate_collection
+from transmart_loader.transmart import DataCollection
+
+
+def read_rows(directory: str) -> List[List[str]]:
+    with open(os.path.join(directory, 'i2b2demodata/observation_fact.tsv'),
+              newline='') as file:
+        return list(csv.reader(file, dialect='excel-tab'))[1:]
+
+
+def collection_with_duplicates():
+    collection = generate_collection(SyntheticCollectionSettings(
+        patients=100, metadata_probability=0.3))
+    observations = list(collection.observations)
+    # Every tenth observation is written twice
+    duplicates = observations[::10]
+    return DataCollection(
+        collection.concepts, collection.modifiers, collection.dimensions,
+        collection.studies, collection.trial_visits, collection.visits,
+        collection.ontology, collection.patients,
+        observations + duplicates), duplicates
+
+
+def without_instance_num(rows: List[List[str]]) -> Counter:
+    return Counter(tuple(row[:7] + row[8:]) for row in rows)
+
+
+@pytest.mark.parametrize('workers,memory', [(1, 1 << 20), (1, 1000),
+                                            (2, 1000)])
+def test_drop_duplicates(tmp_path, workers, memory):
+    collection, duplicates = collection_with_duplicates()
+    writer = TransmartCopyWriter((tmp_path / 'all').as_posix(),
+                                 workers=workers, shard_size=100,
+                                 duplicates=DuplicateMode.Report,
+                                 duplicate_memory=memory)
+    writer.write_collection(collection)
+    writer.close()
+    expected = Counter(observation.concept.concept_code
+                       for observation in duplicates)
+    assert writer.observations_writer.duplicates == expected
+    all_rows = read_rows((tmp_path / 'all').as_posix())
+
+    writer = TransmartCopyWriter((tmp_path / 'dropped').as_posix(),
+                                 workers=workers, shard_size=100,
+                                 duplicates=DuplicateMode.Drop,
+                                 duplicate_memory=memory)
+    # With a small budget, bucket files are partitioned again
+    writer.observations_writer.buckets = 4
+    writer.write_collection(collection)
+    writer.close()
+    assert writer.observations_writer.duplicates == expected
+    assert (writer.observations_writer.bucket_files is None) \
+        == (memory > 1000)
+    dropped_rows = read_rows((tmp_path / 'dropped').as_posix())
+    # The duplicates are the last observations written, the other
+    # observations are written once, in their original order
+    first_duplicate = len(collection.observations) - len(duplicates)
+    assert dropped_rows == [
+        row for row in all_rows if int(row[7]) < first_duplicate]
+    assert sorted(os.listdir((tmp_path / 'dropped').as_posix())) \
+        == ['i2b2demodata', 'i2b2metadata']
+
+
+def test_fail_on_first_duplicate(tmp_path):
+    collection, duplicates = collection_with_duplicates()
+    writer = TransmartCopyWriter(tmp_path.as_posix(),
+                                 duplicates=DuplicateMode.Fail)
+    with pytest.raises(LoaderException, match='Duplicate observation of '
+                       'concept {}'.format(duplicates[0].concept.concept_code)):
+        writer.write_collection(collection)
+    writer.close()
+
+
+def test_fail_on_spilled_duplicates(tmp_path):
+    collection, duplicates = collection_with_duplicates()
+    # Only observations after the memory budget is reached are duplicated
+    observations = collection.observations[:-len(duplicates)]
+    collection.observations = observations + observations[-10:]
+    writer = TransmartCopyWriter(tmp_path.as_posix(),
+                                 duplicates=DuplicateMode.Fail,
+                                 duplicate_memory=1000)
+    writer.write_collection(collection)
+    with pytest.raises(LoaderException, match='Found'):
+        writer.close()
+
+
+def test_no_duplicates(tmp_path, simple_collection):
+    writer = TransmartCopyWriter(tmp_path.as_posix(),
+                                 duplicates=DuplicateMode.Fail)
+    writer.write_collection(simple_collection)
+    writer.close()
+    assert isinstance(writer.observations_writer, DuplicateFilter)
+    assert writer.observations_writer.duplicates == Counter()
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for the identifier stores.
+"""
+import os
+import pickle
+
+import pytest
+
+from transmart_loader.copy_writer import TransmartCopyWriter
+from transmart_loader.collection_validator import CollectionValidator
+from transmart_loader.identifier_store import SqliteIdentifierMap, \
+    SqliteIdentifierStore, SqliteKeySet
+from transmart_loader.loader_exception import LoaderException
+from transmart_loader.synthetic import SyntheticCollectionSettings, \
+    generate_collection
+
+
+def test_sqlite_identifier_map(tmp_path):
+    identifiers = SqliteIdentifierMap((tmp_path / 'map.sqlite').as_posix(),
+                                      cache_size=3, batch_size=4)
+    for number in range(10):
+        identifiers['ID{}'.format(number)] = number
+    assert len(identifiers) == 10
+    assert len(identifiers.cache) == 3
+    assert len(identifiers.pending) == 2
+    assert all(identifiers['ID{}'.format(number)] == number
+               for number in range(10))
+    assert 'ID3' in identifiers
+    assert 'ID10' not in identifiers
+    with pytest.raises(KeyError):
+        identifiers['ID10']
+    with pytest.raises(LoaderException):
+        identifiers['ID12'] = 12
+    assert list(identifiers) == ['ID{}'.format(number) for number in range(10)]
+
+    # A restored map has the size of the pickled map
+    state = pickle.dumps(identifiers)
+    identifiers['ID10'] = 10
+    identifiers.flush()
+    restored = pickle.loads(state)
+    assert len(restored) == 10
+    assert 'ID10' not in restored
+    restored.close()
+    identifiers.close()
+
+
+def test_sqlite_key_set(tmp_path):
+    keys = SqliteKeySet((tmp_path / 'keys.sqlite').as_posix(), batch_size=4)
+    for number in range(10):
+        keys.add('ID{}'.format(number))
+    keys.add(('path', 'tag'))
+    assert len(keys) == 11
+    assert len(keys.pending) == 3
+    assert 'ID3' in keys
+    assert ('path', 'tag') in keys
+    assert 'ID10' not in keys
+    with pytest.raises(LoaderException):
+        keys.discard('ID3')
+    keys |= {'ID3', 'ID10'}
+    # Keys that were added again are only counted once when inserted
+    keys.flush()
+    assert len(keys) == 12
+    assert list(keys)[-1] == 'ID10'
+
+    # A restored set has the size of the pickled set
+    state = pickle.dumps(keys)
+    keys.add('ID11')
+    keys.flush()
+    restored = pickle.loads(state)
+    assert len(restored) == 12
+    assert 'ID11' not in restored
+    restored.add('ID12')
+    assert len(restored) == 13
+    restored.close()
+    keys.close()
+
+
+def test_disk_backed_sets(tmp_path, simple_collection):
+    store = SqliteIdentifierStore((tmp_path / 'store').as_posix())
+    validator = CollectionValidator(store)
+    validator.visit(simple_collection)
+    validator.close()
+    assert validator.errors == []
+    for identifiers in [validator.patients, validator.visits,
+                        validator.concepts, validator.trial_visits]:
+        assert isinstance(identifiers, SqliteKeySet)
+    assert len(validator.patients) == len(simple_collection.patients)
+
+    writer = TransmartCopyWriter((tmp_path / 'output').as_posix(),
+                                 identifier_store=store)
+    writer.write_collection(simple_collection)
+    writer.close()
+    for identifiers in [writer.concepts, writer.modifiers, writer.paths,
+                        writer.tags]:
+        assert isinstance(identifiers, SqliteKeySet)
+    assert len(writer.concepts) == len(simple_collection.concepts)
+
+
+def test_write_with_sqlite_identifier_store(tmp_path):
+    settings = SyntheticCollectionSettings(patients=40)
+    output = {}
+    for name, store, workers in [
+            ('memory', None, 1),
+            ('sqlite', SqliteIdentifierStore(
+                (tmp_path / 'store').as_posix(), cache_size=10, batch_size=7),
+             1),
+            ('parallel', SqliteIdentifierStore(
+                (tmp_path / 'parallel_store').as_posix(), cache_size=10),
+             2)]:
+        target_path = (tmp_path / name).as_posix()
+        writer = TransmartCopyWriter(target_path, workers=workers,
+                                     shard_size=50, identifier_store=store)
+        collection = generate_collection(settings)
+        # Observations are written in parallel if they are a sequence
+        collection.observations = list(collection.observations)
+        writer.write_collection(collection)
+        writer.close()
+        output[name] = {}
+        for table in ['patient_mapping', 'encounter_mapping',
+                      'observation_fact', 'relations']:
+            with open(os.path.join(target_path, 'i2b2demodata',
+                                   table + '.tsv')) as table_file:
+                output[name][table] = table_file.read()
+    assert output['sqlite'] == output['memory']
+    assert output['parallel'] == output['memory']
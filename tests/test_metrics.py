@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for the writer metrics.
+"""
+import json
+import os
+
+from transmart_loader.copy_writer import TransmartCopyWriter
+from transmart_loader.metrics import Metrics
+from transmart_loader.tsv_writer import TsvWriter
+
+
+def test_metrics(tmp_path, simple_collection):
+    target_path = (tmp_path / 'output').as_posix()
+    metrics = Metrics()
+    writer = TransmartCopyWriter(target_path, metrics=metrics)
+    writer.write_collection(simple_collection)
+    writer.close()
+
+    report = metrics.report()
+    assert report['methods']['visit_concept']['calls'] == 4
+    assert report['methods']['visit_concept']['dedup_hits'] == 0
+    assert report['methods']['visit_dimension']['calls'] == 6
+    assert report['methods']['visit_observation']['calls'] == 3
+    assert report['methods']['write_observation']['calls'] == 4
+    assert report['methods']['visit_tree_node']['calls'] == 3
+    assert report['methods']['write_node']['calls'] == 7
+    # Both 'Extra node' folders have the same path
+    assert report['methods']['write_tree_node']['dedup_hits'] == 1
+    assert report['methods']['visit_observation']['seconds'] > 0
+
+    observations = report['tables']['i2b2demodata/observation_fact']
+    assert observations['rows'] == 4
+    assert observations['bytes'] == os.path.getsize(
+        os.path.join(target_path, 'i2b2demodata', 'observation_fact.tsv'))
+    assert report['caches']['format_date']['hits'] + \
+        report['caches']['format_date']['misses'] > 0
+
+    json_path = (tmp_path / 'metrics.json').as_posix()
+    metrics.write_json(json_path)
+    with open(json_path) as json_file:
+        assert json.load(json_file) == report
+
+    prometheus_path = (tmp_path / 'metrics.prom').as_posix()
+    metrics.write_prometheus(prometheus_path)
+    with open(prometheus_path) as prometheus_file:
+        lines = prometheus_file.read().splitlines()
+    assert '# TYPE transmart_loader_table_rows_total counter' in lines
+    assert 'transmart_loader_table_rows_total' \
+           '{table="i2b2demodata/observation_fact"} 4' in lines
+    assert 'transmart_loader_method_dedup_hits_total' \
+           '{method="write_tree_node"} 1' in lines
+    assert not os.path.exists(prometheus_path + '.tmp')
+
+
+def test_metrics_disabled(tmp_path, simple_collection):
+    target_path = tmp_path.as_posix()
+    writer = TransmartCopyWriter(target_path)
+    writer.write_collection(simple_collection)
+    writer.close()
+    assert 'visit_observation' not in vars(writer)
+    assert 'writerow' not in vars(writer.observations_writer)
+
+
+def test_rows_written_as_text(tmp_path):
+    rows = [['1', 'Line\nbreak'], ['2', 'Quoted "line\r\nbreak"'],
+            ['3', 'value']]
+    metrics = Metrics()
+    row_writer = TsvWriter((tmp_path / 'rows.tsv').as_posix())
+    metrics.instrument_writer('rows', row_writer)
+    row_writer.writerows(rows)
+    row_writer.close()
+    with open((tmp_path / 'rows.tsv').as_posix(), newline='') as file:
+        data = file.read()
+
+    text_writer = TsvWriter((tmp_path / 'text.tsv').as_posix())
+    metrics.instrument_writer('text', text_writer)
+    # Chunks that end within quoted fields, as in shard files
+    for start in range(0, len(data), 7):
+        text_writer.write(data[start:start + 7])
+    text_writer.close()
+    assert metrics.tables['text'].rows == metrics.tables['rows'].rows == 3
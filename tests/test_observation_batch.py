@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for writing observation batches with the TransmartCopyWriter.
+"""
+from datetime import datetime, timezone
+
+import pytest
+
+from transmart_loader.collection_validator import CollectionValidator
+from transmart_loader.copy_writer import TransmartCopyWriter, quote_strings
+from transmart_loader.loader_exception import LoaderException
+from transmart_loader.transmart import DataCollection, Concept, Study, \
+    TrialVisit, Visit, Patient, Observation, ValueType, CategoricalValue, \
+    TextValue, DateValue, NumericalValue, ObservationBatch
+
+np = pytest.importorskip('numpy')
+
+concepts = [
+    Concept('age', 'Age', '\\age', ValueType.Numeric),
+    Concept('diagnosis', 'Diagnosis', '\\diagnosis', ValueType.Categorical),
+    Concept('diagnosis_date', 'Diagnosis date', '\\diagnosis_date',
+            ValueType.Date),
+    Concept('remarks', 'Remarks', '\\remarks', ValueType.Text)]
+studies = [Study('test', 'Test study')]
+trial_visits = [TrialVisit(studies[0], 'Week 1', 'Week', 1)]
+patients = [Patient('SUBJ0', 'male', []), Patient('SUBJ1', 'female', [])]
+visits = [Visit(patients[1], 'visit1', None, None, None, None, None, None, [])]
+start = datetime(2019, 6, 26, 12, 34, 0, tzinfo=timezone.utc)
+end = datetime(2019, 6, 28, 16, 46, 13, 345, tzinfo=timezone.utc)
+diagnosis_date = datetime(2018, 4, 30, 17, 10, 0)
+
+
+def epoch(value: datetime) -> int:
+    return int(value.replace(tzinfo=timezone.utc).timestamp() * 1000000)
+
+
+def write_observations(target_path, observations, batches):
+    collection = DataCollection(concepts, [], [], studies, trial_visits,
+                                visits, [], patients, observations,
+                                observation_batches=batches)
+    writer = TransmartCopyWriter(target_path)
+    writer.write_collection(collection)
+    del writer
+    with open(target_path + '/i2b2demodata/observation_fact.tsv') as file:
+        return file.read()
+
+
+def test_write_observation_batch(tmp_path):
+    observations = [
+        Observation(patients[0], concepts[0], None, trial_visits[0],
+                    start, None, NumericalValue(28.5)),
+        Observation(patients[1], concepts[1], visits[0], trial_visits[0],
+                    start, end, CategoricalValue('Influenza')),
+        Observation(patients[1], concepts[2], visits[0], trial_visits[0],
+                    start, None, DateValue(diagnosis_date)),
+        Observation(patients[0], concepts[3], None, trial_visits[0],
+                    None, None, TextValue('Tab\tand "quotes"')),
+        Observation(patients[0], concepts[1], None, trial_visits[0],
+                    end, None, CategoricalValue(None))]
+    batch = ObservationBatch(
+        patients, concepts, trial_visits,
+        patient_index=[0, 1, 1, 0, 0],
+        concept_index=[0, 1, 2, 3, 1],
+        trial_visit_index=[0, 0, 0, 0, 0],
+        start_date=np.array([epoch(start), epoch(start), epoch(start),
+                             ObservationBatch.missing_date, epoch(end)]),
+        end_date=np.array(['NaT', end.replace(tzinfo=None), 'NaT', 'NaT',
+                           'NaT'], dtype='datetime64[us]'),
+        value_type=[ValueType.Numeric.value, ValueType.Categorical.value,
+                    ValueType.Date.value, ValueType.Text.value,
+                    ValueType.Categorical.value],
+        numeric_value=[28.5, np.nan, epoch(diagnosis_date), np.nan, np.nan],
+        text_value=[None, 'Influenza', None, 'Tab\tand "quotes"', None],
+        visits=visits,
+        visit_index=[-1, 0, 0, -1, -1])
+
+    expected = write_observations(
+        (tmp_path / 'objects').as_posix(), observations, [])
+    actual = write_observations(
+        (tmp_path / 'batch').as_posix(), [], [batch])
+    assert actual == expected
+
+
+def test_observation_batch_column_lengths():
+    with pytest.raises(LoaderException):
+        ObservationBatch(patients, concepts, trial_visits,
+                         [0, 1], [0], [0, 0], [0, 0], None,
+                         [1, 1], [1.0, 2.0], None)
+
+
+def test_observation_batch_text_columns(tmp_path):
+    long_text = 'Lorem ipsum "dolor"\n' * 1000
+    texts = [long_text, 'Short', None, 'Ünïcödé']
+    observations = [
+        Observation(patients[0], concepts[3], None, trial_visits[0],
+                    None, None, TextValue(text))
+        for text in texts]
+    batch = ObservationBatch(
+        patients, concepts, trial_visits,
+        patient_index=[0, 0, 0, 0],
+        concept_index=[3, 3, 3, 3],
+        trial_visit_index=[0, 0, 0, 0],
+        start_date=np.full(4, ObservationBatch.missing_date),
+        end_date=None,
+        value_type=np.full(4, ValueType.Text.value),
+        numeric_value=np.full(4, np.nan),
+        text_value=texts)
+
+    expected = write_observations(
+        (tmp_path / 'objects').as_posix(), observations, [])
+    actual = write_observations(
+        (tmp_path / 'batch').as_posix(), [], [batch])
+    assert actual == expected
+    assert quote_strings(np.array(texts, dtype=object)).dtype == object
+
+
+def test_observation_batch_index_bounds():
+    batch = ObservationBatch(
+        patients, concepts, trial_visits,
+        patient_index=[0, 2],
+        concept_index=[-1, 0],
+        trial_visit_index=[0, 0],
+        start_date=np.full(2, ObservationBatch.missing_date),
+        end_date=None,
+        value_type=np.full(2, ValueType.Numeric.value),
+        numeric_value=[1.0, 2.0],
+        text_value=None,
+        visits=visits,
+        visit_index=[-1, 1])
+    collection = DataCollection(concepts, [], [], studies, trial_visits,
+                                visits, [], patients, [],
+                                observation_batches=[batch])
+    validator = CollectionValidator()
+    validator.visit(collection)
+    assert validator.errors == [
+        'Observation batch has patient index 2 out of range [0, 2)',
+        'Observation batch has concept index -1 out of range [0, 4)',
+        'Observation batch has visit index 1 out of range [-1, 1)']
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for writing collections partitioned by study.
+"""
+import csv
+import os
+from collections import Counter
+from os import path
+from typing import List, Dict
+
+import pytest
+
+from transmart_loader.copy_writer import TransmartCopyWriter
+from transmart_loader.loader_exception import LoaderException
+from transmart_loader.partitioned_writer import PartitionedWriter
+from transmart_loader.synthetic import SyntheticCollectionSettings, \
+    generate_collection
+from transmart_loader.transmart import Study, StudyNode, ConceptNode, \
+    TreeNodeMetadata, DataCollection
+
+
+def read_rows(directory: str, table: str) -> List[List[str]]:
+    with open(path.join(directory, table + '.tsv'), newline='') as file:
+        return list(csv.reader(file, dialect='excel-tab'))[1:]
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_partitioned_output(tmp_path, workers):
+    collection = generate_collection(SyntheticCollectionSettings(
+        studies=3, trial_visits_per_study=2, patients=60,
+        metadata_probability=0.5))
+    # A study node with the same path and tag as the node of another study
+    duplicate_study = Study('DUPLICATE', collection.studies[0].name)
+    collection.studies = collection.studies + [duplicate_study]
+    duplicate_node = StudyNode(duplicate_study)
+    duplicate_node.add_child(ConceptNode(collection.concepts[0]))
+    for node in [collection.ontology[0], duplicate_node]:
+        node.metadata = TreeNodeMetadata({'Upload date': '2020-01-01'})
+    collection.ontology = collection.ontology + [duplicate_node]
+    serial_path = (tmp_path / 'serial').as_posix()
+    writer = TransmartCopyWriter(serial_path)
+    writer.write_collection(collection)
+    writer.close()
+
+    partitioned_path = (tmp_path / 'partitioned').as_posix()
+    partitioned_writer = PartitionedWriter(partitioned_path, workers=workers)
+    partitioned_writer.write_collection(collection)
+    partitioned_writer.close()
+    directories = [path.join(partitioned_path, 'shared')] + [
+        partitioned_writer.partition_dir(study.study_id)
+        for study in collection.studies]
+
+    # Shared entities have the same ids as in the serial output
+    for table in ['i2b2demodata/patient_dimension',
+                  'i2b2demodata/visit_dimension',
+                  'i2b2demodata/trial_visit_dimension',
+                  'i2b2demodata/concept_dimension']:
+        assert read_rows(directories[0], table) \
+            == read_rows(serial_path, table)
+
+    # Every study partition has observations of its own study only,
+    # and only the tables of the ontology and observations
+    for directory in directories[1:-1]:
+        assert len(read_rows(directory, 'i2b2demodata/observation_fact')) > 0
+    for directory in directories[1:]:
+        assert sorted(os.listdir(directory)) \
+            == ['i2b2demodata', 'i2b2metadata']
+        assert sorted(os.listdir(path.join(directory, 'i2b2metadata'))) \
+            == ['i2b2_secure.tsv', 'i2b2_tags.tsv']
+        assert os.listdir(path.join(directory, 'i2b2demodata')) \
+            == ['observation_fact.tsv']
+    # The spool files have been removed
+    assert sorted(os.listdir(partitioned_path)) == ['shared', 'studies']
+
+    def observations_without_instance_num(rows: List[List[str]]) -> Counter:
+        return Counter(tuple(row[:7] + row[8:]) for row in rows)
+
+    partitioned_observations = [
+        row for directory in directories
+        for row in read_rows(directory, 'i2b2demodata/observation_fact')]
+    serial_observations = read_rows(serial_path,
+                                    'i2b2demodata/observation_fact')
+    assert observations_without_instance_num(partitioned_observations) \
+        == observations_without_instance_num(serial_observations)
+    # Instance numbers are unique per observation, rows of modifiers share
+    # the instance number of their observation
+    instance_nums = {row[7] for row in partitioned_observations
+                     if row[6] == '@'}
+    assert len(instance_nums) == len(
+        [row for row in partitioned_observations if row[6] == '@'])
+
+    for table in ['i2b2metadata/i2b2_secure', 'i2b2metadata/i2b2_tags']:
+        partitioned_rows = [
+            tuple(row[1:] if table.endswith('tags') else row)
+            for directory in directories
+            for row in read_rows(directory, table)]
+        assert Counter(partitioned_rows) == Counter(
+            tuple(row[1:] if table.endswith('tags') else row)
+            for row in read_rows(serial_path, table))
+        # Paths and tags are unique across partitions
+        assert len(set(partitioned_rows)) == len(partitioned_rows)
+    tag_ids = [row[0] for directory in directories
+               for row in read_rows(directory, 'i2b2metadata/i2b2_tags')]
+    assert len(tag_ids) == len(set(tag_ids))
+
+
+def test_partitioned_output_dir_not_empty(tmp_path):
+    (tmp_path / 'file.txt').write_text('content')
+    with pytest.raises(LoaderException):
+        PartitionedWriter(tmp_path.as_posix())
+
+
+def read_partitioned_output(directory: str) -> Dict[str, str]:
+    files = {}
+    for parent, _, names in os.walk(directory):
+        for name in names:
+            file_path = path.join(parent, name)
+            with open(file_path) as file:
+                files[path.relpath(file_path, directory)] = file.read()
+    return files
+
+
+def test_partitioned_output_from_generators(tmp_path):
+    collection = generate_collection(SyntheticCollectionSettings(
+        studies=2, patients=30, metadata_probability=0.5,
+        relation_probability=0.5))
+    list_path = (tmp_path / 'lists').as_posix()
+    writer = PartitionedWriter(list_path, workers=1)
+    writer.write_collection(collection)
+    writer.close()
+
+    # Every field is iterated only once
+    generator_collection = DataCollection(*[
+        (item for item in items) for items in [
+            collection.concepts, collection.modifiers, collection.dimensions,
+            collection.studies, collection.trial_visits, collection.visits,
+            collection.ontology, collection.patients,
+            collection.observations, collection.relation_types,
+            collection.relations, collection.observation_batches]])
+    generator_path = (tmp_path / 'generators').as_posix()
+    writer = PartitionedWriter(generator_path, workers=1)
+    writer.write_collection(generator_collection)
+    writer.close()
+
+    assert read_partitioned_output(generator_path) \
+        == read_partitioned_output(list_path)
+    assert len(read_rows(path.join(generator_path, 'shared'),
+                         'i2b2demodata/relations')) > 0
+
+
+def test_partitioned_output_invalid_collection(tmp_path):
+    collection = generate_collection(SyntheticCollectionSettings(patients=5))
+    # An observation of a patient that is not in the collection
+    collection.patients = list(collection.patients)[1:]
+    partitioned_path = (tmp_path / 'partitioned').as_posix()
+    writer = PartitionedWriter(partitioned_path, workers=1)
+    with pytest.raises(LoaderException):
+        writer.write_collection(collection)
+    writer.close()
+    # The partitions are not written
+    assert sorted(os.listdir(partitioned_path)) == ['shared']
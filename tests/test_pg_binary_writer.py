@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for output in PostgreSQL binary COPY format.
+"""
+import csv
+import gzip
+import struct
+from datetime import datetime, timedelta
+from decimal import Decimal, localcontext
+from os import path
+from typing import List, Any, Optional
+
+import pytest
+
+from transmart_loader.compression import Compression, CompressionFormat
+from transmart_loader.copy_writer import TransmartCopyWriter, OutputFormat
+from transmart_loader.loader_exception import LoaderException
+from transmart_loader.pg_binary_writer import PgType, PgBinaryWriter, \
+    encode_numeric, header, trailer
+from transmart_loader.synthetic import SyntheticCollectionSettings, \
+    generate_collection
+
+
+def decode_numeric(data: bytes) -> Decimal:
+    count, weight, sign, scale = struct.unpack('>hhHH', data[:8])
+    digits = struct.unpack('>{}H'.format(count), data[8:])
+    with localcontext() as context:
+        context.prec = 100
+        value = sum(Decimal(digit) * Decimal(10000) ** (weight - index)
+                    for index, digit in enumerate(digits))
+    return -value if sign == 0x4000 else value
+
+
+def decode_field(column_type: PgType, data: bytes) -> Any:
+    if column_type in (PgType.Int4, PgType.Int8):
+        return int.from_bytes(data, 'big', signed=True)
+    if column_type is PgType.Numeric:
+        return decode_numeric(data)
+    if column_type is PgType.Timestamp:
+        microseconds = int.from_bytes(data, 'big', signed=True)
+        return datetime(2000, 1, 1) + timedelta(microseconds=microseconds)
+    if column_type is PgType.Bool:
+        return data == b'\x01'
+    return data.decode('utf-8')
+
+
+def read_binary(data: bytes,
+                column_types: List[PgType]) -> List[List[Optional[Any]]]:
+    assert data.startswith(header)
+    assert data.endswith(trailer)
+    offset = len(header)
+    rows = []
+    while True:
+        field_count, = struct.unpack_from('>h', data, offset)
+        offset += 2
+        if field_count == -1:
+            assert offset == len(data)
+            return rows
+        assert field_count == len(column_types)
+        row = []
+        for column_type in column_types:
+            length, = struct.unpack_from('>i', data, offset)
+            offset += 4
+            if length == -1:
+                row.append(None)
+            else:
+                row.append(decode_field(column_type,
+                                        data[offset:offset + length]))
+                offset += length
+        rows.append(row)
+
+
+def parse_text(column_type: PgType, value: str) -> Any:
+    if value == '':
+        return None
+    if column_type in (PgType.Int4, PgType.Int8):
+        return int(value)
+    if column_type is PgType.Numeric:
+        return Decimal(value)
+    if column_type is PgType.Timestamp:
+        return datetime.fromisoformat(value)
+    if column_type is PgType.Bool:
+        return value == 't'
+    return value
+
+
+@pytest.mark.parametrize('value', [
+    0, 1, -5, 10000, 123456789012345678901234567890,
+    1.5, 0.0001, 1e-07, -0.5, 123.456, 12345678.9, Decimal('1E+5'), '42'])
+def test_encode_numeric(value):
+    data = encode_numeric(value)
+    length, = struct.unpack('>i', data[:4])
+    assert length == len(data) - 4
+    assert decode_numeric(data[4:]) == Decimal(str(value))
+
+
+def test_binary_output(tmp_path):
+    collection = generate_collection(SyntheticCollectionSettings(patients=20))
+    text_path = (tmp_path / 'text').as_posix()
+    writer = TransmartCopyWriter(text_path)
+    writer.write_collection(collection)
+    writer.close()
+
+    binary_path = (tmp_path / 'binary').as_posix()
+    writer = TransmartCopyWriter(binary_path,
+                                 output_format=OutputFormat.PgBinary)
+    writer.write_collection(collection)
+    writer.close()
+
+    for table, table_header in [
+            ('i2b2demodata/observation_fact', writer.observations_header),
+            ('i2b2demodata/visit_dimension', writer.visits_header),
+            ('i2b2demodata/patient_mapping', writer.patient_mappings_header),
+            ('i2b2demodata/relation_types', writer.relation_types_header),
+            ('i2b2metadata/i2b2_secure', writer.tree_nodes_header)]:
+        column_types = writer.get_column_types(table, table_header)
+        with open(path.join(text_path, table + '.tsv'), newline='') as file:
+            reader = csv.reader(file, dialect='excel-tab')
+            assert next(reader) == table_header
+            expected = [[parse_text(column_type, value) for column_type, value
+                         in zip(column_types, row)] for row in reader]
+        with open(path.join(binary_path, table + '.bin'), 'rb') as file:
+            assert read_binary(file.read(), column_types) == expected
+    assert writer.get_column_types(
+        'i2b2demodata/patient_mapping', writer.patient_mappings_header) == [
+        PgType.Text, PgType.Text, PgType.Int4]
+
+
+def test_compressed_binary_output(tmp_path):
+    file_path = (tmp_path / 'table').as_posix()
+    writer = PgBinaryWriter(file_path,
+                            [PgType.Int8, PgType.Timestamp, PgType.Text],
+                            Compression(CompressionFormat.Gzip),
+                            buffer_rows=2)
+    writer.write_header()
+    writer.writerow([1, datetime(2019, 5, 1, 10, 30), 'one'])
+    writer.write('2\t2019-05-02\t"tab\tseparated"\r\n3\t\t\r\n')
+    writer.close()
+    with open(file_path + '.gz', 'rb') as file:
+        rows = read_binary(gzip.decompress(file.read()),
+                           [PgType.Int8, PgType.Timestamp, PgType.Text])
+    assert rows == [[1, datetime(2019, 5, 1, 10, 30), 'one'],
+                    [2, datetime(2019, 5, 2), 'tab\tseparated'],
+                    [3, None, None]]
+
+
+def test_binary_append_not_supported(tmp_path):
+    with pytest.raises(LoaderException):
+        TransmartCopyWriter(tmp_path.as_posix(), append=True,
+                            output_format=OutputFormat.PgBinary)
@@ -0,0 +1,325 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for loading tables into PostgreSQL with the PostgresSink,
+using fake connections and, if available, a PostgreSQL server.
+"""
+import os
+from typing import Dict, List, Iterator, Tuple, Optional
+
+import pytest
+
+from transmart_loader.copy_writer import TransmartCopyWriter
+from transmart_loader.loader_exception import LoaderException
+from transmart_loader.postgres_sink import PostgresSink, copy_statement, \
+    psycopg
+from transmart_loader.sink import MemorySink, OutputFormat
+from transmart_loader.synthetic import SyntheticCollectionSettings, \
+    generate_collection
+
+
+class FakeCopy:
+    def __init__(self, connection: 'FakeConnection', statement: str):
+        self.connection = connection
+        self.statement = statement
+        self.chunks: List[bytes] = []
+
+    def __enter__(self) -> 'FakeCopy':
+        if self.connection.copy is not None:
+            raise IOError('Another copy is in progress')
+        self.connection.copy = self
+        self.connection.events.append(('start', self.statement))
+        return self
+
+    def __exit__(self, error_type, error, traceback) -> None:
+        self.connection.copy = None
+        if error_type is None:
+            self.connection.events.append(('end', self.statement))
+            self.connection.pending[self.statement] = \
+                self.connection.pending.get(self.statement, b'') + \
+                b''.join(self.chunks)
+
+    def write(self, chunk: bytes) -> None:
+        if self.connection.fail_on in self.statement:
+            raise IOError('Copy failed')
+        self.chunks.append(chunk)
+
+
+class FakeCursor:
+    def __init__(self, connection: 'FakeConnection'):
+        self.connection = connection
+
+    def copy(self, statement: str) -> FakeCopy:
+        return FakeCopy(self.connection, statement)
+
+
+class FakeConnection:
+    """
+    Connection that keeps the data copied in the current transaction
+    until it is committed, and records when copies start and end.
+    Only one copy can be in progress at a time.
+    """
+    def __init__(self, fail_on: str = 'no table'):
+        self.fail_on = fail_on
+        self.pending: Dict[str, bytes] = {}
+        self.loaded: Dict[str, bytes] = {}
+        self.events: List[Tuple[str, str]] = []
+        self.copy: Optional[FakeCopy] = None
+        self.state = 'open'
+
+    def cursor(self) -> FakeCursor:
+        return FakeCursor(self)
+
+    def commit(self) -> None:
+        self.loaded.update(self.pending)
+        self.pending = {}
+        self.state = 'committed'
+
+    def rollback(self) -> None:
+        self.pending = {}
+        self.state = 'rolled back'
+
+    def close(self) -> None:
+        pass
+
+
+def test_copy_statement():
+    assert copy_statement('i2b2demodata/study', ['study_num', 'study_id'],
+                          OutputFormat.Tsv) == \
+        'COPY "i2b2demodata"."study" ("study_num", "study_id") FROM STDIN ' \
+        "WITH (FORMAT csv, DELIMITER E'\\t')"
+
+
+def test_postgres_sink(tmp_path):
+    collection = generate_collection(SyntheticCollectionSettings(patients=50))
+    memory_sink = MemorySink()
+    writer = TransmartCopyWriter((tmp_path / 'memory').as_posix(),
+                                 sink=memory_sink)
+    writer.write_collection(collection)
+    writer.close()
+
+    connection = FakeConnection()
+    # Small tables are spooled in memory, large tables in files
+    sink = PostgresSink(chunk_size=1000, spool_memory=10000,
+                        connect=lambda: connection)
+    writer = TransmartCopyWriter((tmp_path / 'database').as_posix(),
+                                 sink=sink)
+    writer.write_collection(collection)
+    writer.close()
+
+    assert connection.state == 'committed'
+    expected = {}
+    for table, table_writer in memory_sink.tables.items():
+        header, data = table_writer.text.split('\r\n', 1)
+        statement = copy_statement(table, header.split('\t'),
+                                   OutputFormat.Tsv)
+        if data:
+            expected[statement] = data.encode('utf-8')
+    # Empty tables are not copied
+    assert connection.loaded == expected
+    # Tables are loaded in dependency order, the dimensions before the
+    # observations, which are streamed while they are written
+    tables = [statement.split(' ')[1]
+              for event, statement in connection.events if event == 'start']
+    assert tables.index('"i2b2demodata"."study"') \
+        < tables.index('"i2b2demodata"."trial_visit_dimension"')
+    assert tables.index('"i2b2demodata"."patient_dimension"') \
+        < tables.index('"i2b2demodata"."relations"')
+    for table in ['"i2b2demodata"."concept_dimension"',
+                  '"i2b2demodata"."patient_dimension"',
+                  '"i2b2demodata"."trial_visit_dimension"']:
+        assert tables.index(table) \
+            < tables.index('"i2b2demodata"."observation_fact"')
+
+
+def test_postgres_sink_streams_observations(tmp_path):
+    # More observations than the writer buffers
+    collection = generate_collection(SyntheticCollectionSettings(
+        patients=1200, relation_probability=0.5))
+    connection = FakeConnection()
+    sink = PostgresSink(chunk_size=1000, spool_memory=10000,
+                        connect=lambda: connection)
+    writer = TransmartCopyWriter(tmp_path.as_posix(), sink=sink)
+    writer.write_collection(collection)
+    # The observations are sent before the writer is closed
+    started = [statement for event, statement in connection.events
+               if event == 'start']
+    assert 'observation_fact' in started[-1]
+    assert connection.copy is not None
+    assert connection.copy.chunks
+    writer.close()
+    assert connection.state == 'committed'
+    # The relations are loaded after the observations, in the same
+    # transaction
+    assert 'relations' in connection.events[-1][1]
+    assert connection.copy is None
+
+
+def test_postgres_sink_failure(tmp_path, simple_collection):
+    connection = FakeConnection(fail_on='observation_fact')
+    sink = PostgresSink(chunk_size=10, connect=lambda: connection)
+    writer = TransmartCopyWriter(tmp_path.as_posix(), sink=sink)
+    writer.write_collection(simple_collection)
+    # The tables are loaded when the writer is closed
+    with pytest.raises(LoaderException):
+        writer.close()
+    assert connection.state == 'rolled back'
+    assert connection.loaded == {}
+
+
+def test_postgres_sink_streaming_failure(tmp_path):
+    collection = generate_collection(SyntheticCollectionSettings(
+        patients=1200))
+    connection = FakeConnection(fail_on='observation_fact')
+    sink = PostgresSink(chunk_size=1000, connect=lambda: connection)
+    writer = TransmartCopyWriter(tmp_path.as_posix(), sink=sink)
+    # The observations fail to load while they are written
+    with pytest.raises(LoaderException):
+        writer.write_collection(collection)
+    writer.close()
+    assert connection.state == 'rolled back'
+    assert connection.loaded == {}
+
+
+def test_postgres_sink_incomplete_collection(tmp_path, simple_collection):
+    connection = FakeConnection()
+    sink = PostgresSink(connect=lambda: connection)
+    writer = TransmartCopyWriter(tmp_path.as_posix(), sink=sink)
+    writer.visit(simple_collection)
+    # Not written with write_collection, so nothing is committed
+    writer.close()
+    assert connection.state == 'rolled back'
+    assert connection.loaded == {}
+
+
+@pytest.mark.skipif(psycopg is not None, reason='psycopg is installed')
+def test_postgres_sink_requires_psycopg():
+    with pytest.raises(LoaderException):
+        PostgresSink('dbname=transmart')
+
+
+@pytest.fixture(scope='module')
+def postgres_conninfo(tmp_path_factory) -> Iterator[str]:
+    """ The connection string of a PostgreSQL database, from the
+    TRANSMART_LOADER_TEST_POSTGRES environment variable, or of a server
+    started with pgserver.
+    """
+    if psycopg is None:
+        pytest.skip('Requires psycopg')
+    conninfo = os.environ.get('TRANSMART_LOADER_TEST_POSTGRES')
+    if conninfo:
+        yield conninfo
+        return
+    pgserver = pytest.importorskip('pgserver')
+    server = pgserver.get_server(tmp_path_factory.mktemp('postgres'),
+                                 cleanup_mode='stop')
+    yield server.get_uri()
+    server.cleanup()
+
+
+primary_keys = {
+    'i2b2demodata/concept_dimension': 'concept_cd',
+    'i2b2demodata/study': 'study_num',
+    'i2b2demodata/patient_dimension': 'patient_num',
+    'i2b2demodata/relation_types': 'id'
+}
+
+foreign_keys = {
+    'i2b2demodata/trial_visit_dimension': [
+        ('study_num', 'i2b2demodata/study')],
+    'i2b2demodata/patient_mapping': [
+        ('patient_num', 'i2b2demodata/patient_dimension')],
+    'i2b2demodata/relations': [
+        ('left_subject_id', 'i2b2demodata/patient_dimension'),
+        ('right_subject_id', 'i2b2demodata/patient_dimension'),
+        ('relation_type_id', 'i2b2demodata/relation_types')],
+    'i2b2demodata/observation_fact': [
+        ('patient_num', 'i2b2demodata/patient_dimension'),
+        ('concept_cd', 'i2b2demodata/concept_dimension')]
+}
+
+
+def create_schema(conninfo: str, writer: TransmartCopyWriter,
+                  tables: Dict[str, List[str]]) -> None:
+    """ Creates the tables with the column types of binary output,
+    with primary and foreign keys for some of the references.
+    """
+    with psycopg.connect(conninfo, autocommit=True) as connection:
+        for schema in ['i2b2demodata', 'i2b2metadata']:
+            connection.execute(
+                'DROP SCHEMA IF EXISTS {} CASCADE'.format(schema))
+            connection.execute('CREATE SCHEMA {}'.format(schema))
+        order = PostgresSink.table_order
+        for table in sorted(tables, key=order.index):
+            header = tables[table]
+            columns = ['{} {}'.format(column, column_type.value)
+                       for column, column_type in zip(
+                           header, writer.get_column_types(table, header))]
+            if table in primary_keys:
+                columns.append('PRIMARY KEY ({})'.format(primary_keys[table]))
+            for column, parent in foreign_keys.get(table, []):
+                columns.append('FOREIGN KEY ({}) REFERENCES {} ({})'.format(
+                    column, parent.replace('/', '.'), primary_keys[parent]))
+            connection.execute('CREATE TABLE {} ({})'.format(
+                table.replace('/', '.'), ', '.join(columns)))
+
+
+def count_rows(conninfo: str, tables: List[str]) -> Dict[str, int]:
+    with psycopg.connect(conninfo) as connection:
+        return {table: connection.execute('SELECT count(*) FROM {}'.format(
+                    table.replace('/', '.'))).fetchone()[0]
+                for table in tables}
+
+
+@pytest.mark.parametrize('output_format', [OutputFormat.Tsv,
+                                           OutputFormat.PgBinary])
+def test_load_into_postgres(tmp_path, postgres_conninfo, output_format):
+    # The observations are streamed while the collection is written
+    collection = generate_collection(SyntheticCollectionSettings(
+        patients=1200, relation_probability=0.5))
+    memory_sink = MemorySink()
+    memory_writer = TransmartCopyWriter((tmp_path / 'memory').as_posix(),
+                                        sink=memory_sink)
+    memory_writer.write_collection(collection)
+    memory_writer.close()
+    tables = {table: table_writer.rows[0]
+              for table, table_writer in memory_sink.tables.items()}
+    create_schema(postgres_conninfo, memory_writer, tables)
+
+    writer = TransmartCopyWriter(
+        (tmp_path / 'database').as_posix(),
+        sink=PostgresSink(postgres_conninfo, chunk_size=1000,
+                          spool_memory=10000, output_format=output_format))
+    writer.write_collection(collection)
+    writer.close()
+
+    assert count_rows(postgres_conninfo, list(tables)) == {
+        table: len(table_writer.rows) - 1
+        for table, table_writer in memory_sink.tables.items()}
+    assert count_rows(postgres_conninfo,
+                      ['i2b2demodata/relations'])['i2b2demodata/relations'] \
+        > 0
+
+
+def test_load_into_postgres_is_atomic(tmp_path, postgres_conninfo):
+    collection = generate_collection(SyntheticCollectionSettings(patients=20))
+    memory_sink = MemorySink()
+    memory_writer = TransmartCopyWriter((tmp_path / 'memory').as_posix(),
+                                        sink=memory_sink)
+    memory_writer.write_collection(collection)
+    memory_writer.close()
+    tables = {table: table_writer.rows[0]
+              for table, table_writer in memory_sink.tables.items()}
+    # The last table fails to load
+    tables['i2b2demodata/observation_fact'] = \
+        tables['i2b2demodata/observation_fact'][:-1]
+    create_schema(postgres_conninfo, memory_writer, tables)
+
+    writer = TransmartCopyWriter(
+        (tmp_path / 'database').as_posix(),
+        sink=PostgresSink(postgres_conninfo))
+    writer.write_collection(collection)
+    with pytest.raises(LoaderException):
+        writer.close()
+
+    assert set(count_rows(postgres_conninfo, list(tables)).values()) == {0}
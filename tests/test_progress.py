@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for progress reporting.
+"""
+import os
+from typing import List
+
+from transmart_loader.copy_writer import TransmartCopyWriter
+from transmart_loader.progress import ProgressReporter, Progress
+from transmart_loader.synthetic import SyntheticCollectionSettings, \
+    generate_collection
+
+
+def test_progress_reports(tmp_path):
+    collection = generate_collection(SyntheticCollectionSettings(patients=50))
+    reports: List[Progress] = []
+    progress = ProgressReporter(reports.append, interval=0)
+    progress.check_items = 64
+    target_path = (tmp_path / 'output').as_posix()
+    writer = TransmartCopyWriter(target_path, progress=progress)
+    writer.write_collection(collection, streaming=True)
+    writer.close()
+
+    observation_reports = [report for report in reports
+                           if report.field == 'observations']
+    assert len(observation_reports) > 1
+    total = observation_reports[0].totals['observations']
+    assert total == collection.observations.__length_hint__()
+    assert observation_reports[0].eta is not None
+    assert 'observations: 64/{}'.format(total) in str(observation_reports[0])
+
+    final = reports[-1]
+    assert final.counts['patients'] == 50
+    assert final.counts['concepts'] == 24
+    # Observation rows without modifier, one per observation
+    with open(os.path.join(target_path, 'i2b2demodata',
+                           'observation_fact.tsv')) as observations_file:
+        assert final.counts['observations'] == sum(
+            1 for line in observations_file if line.split('\t')[6] == '@')
+    assert final.bytes_written <= writer.bytes_written()
+
+
+def test_progress_of_generators(tmp_path, simple_collection):
+    simple_collection.observations = (
+        observation for observation in simple_collection.observations)
+    reports: List[Progress] = []
+    progress = ProgressReporter(reports.append, interval=3600)
+    writer = TransmartCopyWriter(tmp_path.as_posix(), progress=progress)
+    writer.write_collection(simple_collection, streaming=True)
+    writer.close()
+
+    # Only the final report, the interval has not passed
+    assert len(reports) == 1
+    assert reports[0].counts['observations'] == 3
+    assert reports[0].totals['observations'] is None
+    assert reports[0].totals['concepts'] == 4
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Conformance tests of the TSV row encoders against csv.writer.
+"""
+import csv
+import io
+import random
+from datetime import date, datetime
+from decimal import Decimal
+
+import pytest
+
+from transmart_loader.row_encoder import row_encoder, format_row
+from transmart_loader.transmart import VariableDataType
+from transmart_loader.tsv_writer import TsvWriter
+
+
+def csv_line(row) -> str:
+    output = io.StringIO()
+    csv.writer(output, delimiter='\t').writerow(row)
+    return output.getvalue()
+
+
+def encode(row) -> str:
+    line = row_encoder(len(row))(row)
+    if line is None:
+        line = format_row(row)
+    return line + '\r\n'
+
+
+rows = [
+    [],
+    [None],
+    [''],
+    ['value'],
+    ['"'],
+    [None, None],
+    ['', ''],
+    [-1, 0, 'dummy_code', '@', '2019-06-26 12:34:00', None, '@', 12, 0,
+     'T', 'value', None, None],
+    [1, 'tab\tseparated', 'new\nline', 'carriage\rreturn', 'cr\r\nlf'],
+    ['"quoted"', 'a "quote" inside', 'trailing"', '""'],
+    [' leading space', 'trailing space ', ' ', '\\back\\slash\\'],
+    ['ünïcödé', '漢字', ' ', '\x00nul', '\x0b\x0c'],
+    [1.5, 0.1, 1e100, -0.0, float('nan'), float('inf'), 2 ** 70],
+    [True, False, Decimal('1.10'), date(2019, 6, 28),
+     datetime(2019, 6, 28, 13, 2, 58, 12345)],
+    [VariableDataType.Numeric, VariableDataType.DateTime],
+]
+
+
+@pytest.mark.parametrize('row', rows)
+def test_row_encoder_conformance(row):
+    assert encode(row) == csv_line(row)
+
+
+def test_row_encoder_random_conformance():
+    generator = random.Random(42)
+    alphabet = ['a', 'b', ' ', '\t', '"', '\n', '\r', '\\', ',', 'é']
+    for column_count in range(1, 15):
+        for _ in range(200):
+            row = []
+            for _ in range(column_count):
+                choice = generator.random()
+                if choice < 0.1:
+                    row.append(None)
+                elif choice < 0.2:
+                    row.append(generator.randint(-10 ** 6, 10 ** 6))
+                elif choice < 0.3:
+                    row.append(generator.uniform(-1e6, 1e6))
+                else:
+                    row.append(''.join(
+                        generator.choice(alphabet)
+                        for _ in range(generator.randint(0, 6))))
+            assert encode(row) == csv_line(row)
+
+
+def test_tsv_writer_conformance(tmp_path):
+    file_path = (tmp_path / 'test.tsv').as_posix()
+    writer = TsvWriter(file_path, buffer_rows=3)
+    expected = []
+    header = ['a', 'b', 'c']
+    writer.writerow(header)
+    expected.append(csv_line(header))
+    for row in rows:
+        writer.writerow(row)
+        expected.append(csv_line(row))
+    writer.writerows([[1, 2, 3], [4, None, '\t']])
+    expected.append(csv_line([1, 2, 3]) + csv_line([4, None, '\t']))
+    writer.write('raw\r\n')
+    expected.append('raw\r\n')
+    writer.close()
+    with open(file_path, newline='') as file:
+        assert file.read() == ''.join(expected)
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for the sinks of the TransmartCopyWriter.
+"""
+import os
+import threading
+import time
+from os import path
+from typing import Dict, List
+
+import pytest
+
+from transmart_loader.copy_writer import TransmartCopyWriter
+from transmart_loader.loader_exception import LoaderException
+from transmart_loader.sink import Sink, MemorySink, FifoSink
+from transmart_loader.synthetic import SyntheticCollectionSettings, \
+    generate_collection
+
+
+def read_tables(target_path: str) -> Dict[str, str]:
+    tables = {}
+    for directory, _, file_names in os.walk(target_path):
+        for file_name in file_names:
+            file_path = path.join(directory, file_name)
+            table = path.relpath(file_path, target_path)[:-len('.tsv')]
+            with open(file_path, newline='') as table_file:
+                tables[table] = table_file.read()
+    return tables
+
+
+def test_memory_sink(tmp_path, simple_collection):
+    file_path = (tmp_path / 'files').as_posix()
+    writer = TransmartCopyWriter(file_path)
+    writer.write_collection(simple_collection)
+    writer.close()
+
+    sink = MemorySink()
+    writer = TransmartCopyWriter((tmp_path / 'memory').as_posix(), sink=sink)
+    writer.write_collection(simple_collection)
+    writer.close()
+
+    assert {table: table_writer.text
+            for table, table_writer in sink.tables.items()} \
+        == read_tables(file_path)
+    assert sink.tables['i2b2demodata/patient_dimension'].rows[0] \
+        == writer.patients_header
+    assert writer.bytes_written() == 0
+
+
+@pytest.mark.skipif(not hasattr(os, 'mkfifo'), reason='Requires mkfifo')
+def test_fifo_sink(tmp_path):
+    collection = generate_collection(SyntheticCollectionSettings(patients=50))
+    file_path = (tmp_path / 'files').as_posix()
+    writer = TransmartCopyWriter(file_path)
+    writer.write_collection(collection)
+    writer.close()
+    expected = read_tables(file_path)
+
+    # Read all tables concurrently, as the rows of tables are interleaved
+    fifo_path = (tmp_path / 'fifos').as_posix()
+    received: Dict[str, str] = {}
+
+    def consume(table: str) -> None:
+        table_path = path.join(fifo_path, table + '.tsv')
+        while not path.exists(table_path):
+            time.sleep(0.01)
+        with open(table_path, newline='') as table_file:
+            received[table] = table_file.read()
+
+    consumers: List[threading.Thread] = [
+        threading.Thread(target=consume, args=(table,), daemon=True)
+        for table in expected]
+    for consumer in consumers:
+        consumer.start()
+    writer = TransmartCopyWriter(fifo_path, sink=FifoSink(fifo_path))
+    writer.write_collection(collection)
+    writer.close()
+    for consumer in consumers:
+        consumer.join(10)
+    assert received == expected
+
+
+def test_checkpoints_require_file_sink(tmp_path):
+    with pytest.raises(LoaderException):
+        TransmartCopyWriter(tmp_path.as_posix(), sink=MemorySink(),
+                            checkpoint_interval=10)
+
+
+def test_abstract_sink():
+    with pytest.raises(TypeError):
+        Sink()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for sorting rows with an external merge sort.
+"""
+import csv
+import os
+import random
+from collections import Counter
+from typing import List
+
+import pytest
+
+from transmart_loader.copy_writer import TransmartCopyWriter, \
+    observation_sort_key
+from transmart_loader.loader_exception import LoaderException
+from transmart_loader.sink import MemoryWriter
+from transmart_loader.sorting_writer import SortingWriter
+from transmart_loader.synthetic import SyntheticCollectionSettings, \
+    generate_collection
+
+
+def read_rows(file_path: str) -> List[List[str]]:
+    with open(file_path, newline='') as file:
+        return list(csv.reader(file, dialect='excel-tab'))[1:]
+
+
+def test_sorting_writer_spills_runs(tmp_path):
+    generator = random.Random(1)
+    rows = [[generator.randrange(100), 'value {}'.format(index)]
+            for index in range(5000)]
+    target = MemoryWriter()
+    writer = SortingWriter(target, lambda row: int(row[0]), memory=10000,
+                           temp_dir=tmp_path.as_posix())
+    # Merge runs in multiple passes
+    writer.fan_in = 3
+    writer.writerows(rows[:2500])
+    writer.write(''.join('{}\t{}\r\n'.format(*row) for row in rows[2500:]))
+    assert len(writer.runs) > writer.fan_in
+    run_count = len(writer.runs)
+    write_run = writer.write_run
+    merged_rows = []
+
+    def count_rows(run_rows):
+        return write_run(merged_rows.append(row) or row for row in run_rows)
+    writer.write_run = count_rows
+    writer.close()
+
+    # Balanced passes: every row is written at most once per pass
+    passes = 0
+    while run_count >= writer.fan_in:
+        run_count = -(-run_count // writer.fan_in)
+        passes = passes + 1
+    assert 0 < len(merged_rows) <= passes * len(rows)
+
+    # Stable sort: rows with equal keys keep their order
+    assert target.rows == [[str(value), text] for value, text
+                           in sorted(rows, key=lambda row: row[0])]
+    assert os.listdir(tmp_path.as_posix()) == []
+
+
+def test_sorted_observations(tmp_path):
+    collection = generate_collection(SyntheticCollectionSettings(
+        patients=300, trial_visits_per_study=2))
+    table = 'i2b2demodata/observation_fact.tsv'
+    writer = TransmartCopyWriter((tmp_path / 'unsorted').as_posix())
+    writer.write_collection(collection)
+    writer.close()
+    unsorted_rows = read_rows((tmp_path / 'unsorted' / table).as_posix())
+
+    sorted_path = tmp_path / 'sorted'
+    writer = TransmartCopyWriter(sorted_path.as_posix(),
+                                 sort_observations=True, sort_memory=10000)
+    writer.write_collection(collection)
+    assert len(writer.observations_writer.runs) > 1
+    writer.close()
+    sorted_rows = read_rows((sorted_path / table).as_posix())
+
+    assert sorted_rows == sorted(unsorted_rows, key=observation_sort_key)
+    assert Counter(map(tuple, sorted_rows)) \
+        == Counter(map(tuple, unsorted_rows))
+    assert sorted(os.listdir(sorted_path.as_posix())) \
+        == ['i2b2demodata', 'i2b2metadata']
+
+
+def test_sorted_observations_with_checkpoints(tmp_path):
+    with pytest.raises(LoaderException):
+        TransmartCopyWriter(tmp_path.as_posix(), sort_observations=True,
+                            checkpoint_interval=10)
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for the synthetic data collection generator.
+"""
+import operator
+from os import path
+
+from transmart_loader.copy_writer import TransmartCopyWriter
+from transmart_loader.synthetic import SyntheticCollectionSettings, \
+    generate_collection
+from transmart_loader.transmart import ValueType, StudyNode, ConceptNode
+
+tables = ['i2b2demodata/observation_fact.tsv',
+          'i2b2demodata/patient_dimension.tsv',
+          'i2b2demodata/visit_dimension.tsv',
+          'i2b2demodata/relations.tsv',
+          'i2b2metadata/i2b2_secure.tsv']
+
+
+def write(target_path: str, settings: SyntheticCollectionSettings,
+          streaming: bool = False):
+    writer = TransmartCopyWriter(target_path)
+    writer.write_collection(generate_collection(settings), streaming)
+    writer.close()
+    output = {}
+    for table in tables:
+        with open(path.join(target_path, table), 'rb') as file:
+            output[table] = file.read()
+    return output
+
+
+def test_synthetic_collection_is_reproducible(tmp_path):
+    settings = SyntheticCollectionSettings(seed=7, studies=2, patients=20,
+                                           trial_visits_per_study=2)
+    output = write((tmp_path / 'a').as_posix(), settings)
+    assert output == write((tmp_path / 'b').as_posix(), settings, True)
+    settings.seed = 8
+    other_output = write((tmp_path / 'c').as_posix(), settings)
+    assert other_output['i2b2demodata/observation_fact.tsv'] != \
+        output['i2b2demodata/observation_fact.tsv']
+    assert output['i2b2demodata/patient_dimension.tsv'].count(b'\n') == 21
+
+
+def test_synthetic_collection_contents():
+    settings = SyntheticCollectionSettings(
+        patients=10, visits_per_patient=(2, 2), observations_per_visit=(3, 3),
+        concepts_per_value_type={ValueType.Numeric: 30, ValueType.Text: 5},
+        ontology_depth=2, ontology_width=3, metadata_probability=1)
+    collection = generate_collection(settings)
+    assert len(collection.concepts) == 35
+    assert operator.length_hint(collection.observations) == 60
+    observations = list(collection.observations)
+    assert len(observations) == 60
+    assert all(observation.metadata for observation in observations)
+    assert {observation.concept.value_type
+            for observation in observations} <= {ValueType.Numeric,
+                                                 ValueType.Text}
+
+    study_node = collection.ontology[0]
+    assert isinstance(study_node, StudyNode)
+    stack = [(study_node, 0)]
+    concept_nodes = 0
+    while stack:
+        node, depth = stack.pop()
+        assert depth <= 3
+        assert len(node.children) <= 3 or depth == 2
+        if isinstance(node, ConceptNode):
+            concept_nodes += 1
+        else:
+            assert node.children
+        stack.extend((child, depth + 1) for child in node.children)
+    assert concept_nodes == 35
@@ -4,126 +4,20 @@
 """Tests for the transmart_loader module.
 """
 import csv
-from datetime import date, datetime
+import os
+from datetime import datetime, timezone, timedelta
 from os import path
 from typing import List
 
 import pytest
 
-from transmart_loader.copy_writer import TransmartCopyWriter
-from transmart_loader.transmart import DataCollection, Concept, Study, \
-    TrialVisit, Visit, TreeNode, Patient, Observation, ValueType, StudyNode, \
-    ConceptNode, CategoricalValue, Modifier, ObservationMetadata, \
-    TextValue, DateValue, Dimension, DimensionType, RelationType, Relation, \
-    TreeNodeMetadata, StudyMetadata
-
-
-@pytest.fixture
-def empty_collection() -> DataCollection:
-    concepts: List[Concept] = []
-    modifiers: List[Modifier] = []
-    dimensions: List[Dimension] = []
-    studies: List[Study] = []
-    trial_visits: List[TrialVisit] = []
-    patients: List[Patient] = []
-    visits: List[Visit] = []
-    ontology: List[TreeNode] = []
-    observations: List[Observation] = []
-    collection = DataCollection(concepts, modifiers, dimensions, studies,
-                                trial_visits, visits, ontology, patients,
-                                observations)
-    return collection
-
-
-@pytest.fixture
-def simple_collection() -> DataCollection:
-    concepts: List[Concept] = [
-        Concept('dummy_code', 'Dummy variable', '\\dummy\\path',
-                ValueType.Categorical),
-        Concept('diagnosis_date', 'Diagnosis date', '\\diagnosis_date',
-                ValueType.Date),
-        Concept('extra_c1', 'Extra c1', '\\c1', ValueType.Categorical),
-        Concept('extra_c2', 'Extra c2', '\\c1', ValueType.Categorical)]
-    modifiers: List[Modifier] = [
-        Modifier('missing_value', 'Missing value', '\\missing_value',
-                 ValueType.Text),
-        Modifier('sample_id', 'Sample ID', '\\sample_id',
-                 ValueType.Numeric)]
-    dimensions: List[Dimension] = [
-        Dimension('sample', modifiers[1], DimensionType.Subject, 1)
-    ]
-    study_metadata = StudyMetadata(**{'conceptCodeToVariableMetadata': {
-        'test_concept': {
-            'name': 'variable_1',
-            'type': 'DATETIME'
-        }
-    }})
-    studies: List[Study] = [Study('test', 'Test study', study_metadata)]
-    trial_visits: List[TrialVisit] = [
-        TrialVisit(studies[0], 'Week 1', 'Week', 1)]
-    patients: List[Patient] = [Patient('SUBJ0', 'male', [])]
-    visits: List[Visit] = [
-        Visit(patients[0], 'visit1', None, None, None, None, None, None, [])]
-    top_node = StudyNode(studies[0])
-    top_node.metadata = TreeNodeMetadata(
-        {'Upload date': '2019-07-01'})
-    top_node.add_child(ConceptNode(concepts[0]))
-    top_node.add_child(ConceptNode(concepts[1]))
-
-    node2 = TreeNode('Extra node')
-    node2.add_child((ConceptNode(concepts[2])))
-    node3 = TreeNode('Extra node')
-    node3.add_child(ConceptNode(concepts[3]))
-
-    ontology: List[TreeNode] = [top_node, node2, node3]
-    observations: List[Observation] = [
-        Observation(patients[0], concepts[0], visits[0], trial_visits[0],
-                    date(2019, 3, 28), None, CategoricalValue('value')),
-        Observation(patients[0], concepts[0], visits[0], trial_visits[0],
-                    datetime(2019, 6, 26, 12, 34, 00),
-                    datetime(2019, 6, 28, 16, 46, 13, 345),
-                    CategoricalValue(None),
-                    ObservationMetadata({
-                        modifiers[0]: TextValue('Invalid')
-                    })),
-        Observation(patients[0], concepts[1], visits[0], trial_visits[0],
-                    datetime(2019, 6, 26, 13, 50, 10), None,
-                    DateValue(datetime(2018, 4, 30, 17, 10, 00)))
-    ]
-    collection = DataCollection(concepts, modifiers, dimensions, studies,
-                                trial_visits, visits, ontology, patients,
-                                observations)
-    return collection
-
-
-@pytest.fixture
-def collection_with_relations() -> DataCollection:
-    concepts: List[Concept] = [
-        Concept('dummy_code', 'Dummy variable', '\\dummy\\path',
-                ValueType.Categorical)]
-    studies: List[Study] = [Study('test', 'Test study')]
-    trial_visits: List[TrialVisit] = [
-        TrialVisit(studies[0], 'Week 1', 'Week', 1)]
-    patients: List[Patient] = [
-        Patient('SUBJ0', 'male', []),
-        Patient('SUBJ1', 'female', []),
-        Patient('SUBJ2', 'female', [])
-    ]
-    visits: List[Visit] = [
-        Visit(patients[0], 'visit1', None, None, None, None, None, None, [])]
-    top_node = StudyNode(studies[0])
-    top_node.add_child(ConceptNode(concepts[0]))
-    ontology: List[TreeNode] = [top_node]
-    relation_types = [RelationType('parent', None, None, None),
-                      RelationType('sibling', 'Sibling of', True, True)]
-    relations = [
-        Relation(patients[0], relation_types[0], patients[1], None, None),
-        Relation(patients[0], relation_types[0], patients[2], None, None),
-        Relation(patients[1], relation_types[1], patients[2], True, True)]
-    collection = DataCollection(concepts, [], [], studies,
-                                trial_visits, visits, ontology, patients,
-                                [], relation_types, relations)
-    return collection
+from transmart_loader.compression import Compression, CompressionFormat, \
+    open_compressed
+from transmart_loader.copy_writer import TransmartCopyWriter, TagKey
+from transmart_loader.loader_exception import LoaderException
+from transmart_loader.transmart import Observation, CategoricalValue, \
+    TextValue, intern_value, intern_metadata, Patient, Visit, StudyNode, \
+    TreeNode, ConceptNode, TreeNodeMetadata, NumericalValue, is_interned, DateValue
 
 
 def get_column_values(file_path: str, column_name: str) -> List[str]:
@@ -202,3 +96,243 @@ def test_load_collection_with_relations(tmp_path, collection_with_relations):
     assert path.exists(target_path + '/i2b2demodata/observation_fact.tsv')
     assert path.exists(target_path + '/i2b2demodata/relation_types.tsv')
     assert path.exists(target_path + '/i2b2demodata/relations.tsv')
+
+
+def test_load_streaming_collection(tmp_path, simple_collection):
+    target_path = tmp_path.as_posix()
+    observations = simple_collection.observations
+    simple_collection.observations = (
+        observation for observation in observations)
+    writer = TransmartCopyWriter(target_path)
+    writer.write_collection(simple_collection, streaming=True)
+    del writer
+
+    instance_nums = get_column_values(
+        target_path + '/i2b2demodata/observation_fact.tsv', 'instance_num')
+    assert instance_nums == ['0', '1', '1', '2']
+
+
+def test_load_invalid_streaming_collection(tmp_path, simple_collection):
+    target_path = tmp_path.as_posix()
+    child = simple_collection.ontology[0].children[0]
+    child.parent = simple_collection.ontology[0]
+    simple_collection.ontology = iter([child])
+    writer = TransmartCopyWriter(target_path)
+    with pytest.raises(LoaderException):
+        writer.write_collection(simple_collection, streaming=True)
+
+
+def test_compact_observations(simple_collection):
+    for observation in simple_collection.observations:
+        assert not hasattr(observation, '__dict__')
+        assert not hasattr(observation.value, '__dict__')
+        assert not hasattr(observation.patient, '__dict__')
+        assert not hasattr(observation.visit, '__dict__')
+        assert not hasattr(observation.trial_visit, '__dict__')
+
+
+def test_interned_values(tmp_path, simple_collection):
+    assert intern_value(CategoricalValue, 'value') is \
+        intern_value(CategoricalValue, 'value')
+    assert intern_value(CategoricalValue, 'value') is not \
+        intern_value(TextValue, 'value')
+    assert type(intern_value(NumericalValue, 1).value) is int
+    assert type(intern_value(NumericalValue, 1.0).value) is float
+    assert intern_value(NumericalValue, True) is not \
+        intern_value(NumericalValue, 1)
+    nan = intern_value(NumericalValue, float('nan'))
+    assert intern_value(NumericalValue, float('nan')) is nan
+    assert is_interned(nan)
+    utc = datetime(2019, 3, 28, 12, 0, tzinfo=timezone.utc)
+    cet = datetime(2019, 3, 28, 13, 0, tzinfo=timezone(timedelta(hours=1)))
+    assert intern_value(DateValue, utc) is not intern_value(DateValue, cet)
+    assert intern_value(DateValue, cet).value.utcoffset() \
+        == timedelta(hours=1)
+    modifier = simple_collection.modifiers[0]
+    metadata = intern_metadata({modifier: TextValue('Invalid')})
+    assert metadata is intern_metadata({modifier: TextValue('Invalid')})
+    assert metadata.values[modifier] is intern_value(TextValue, 'Invalid')
+    with pytest.raises(TypeError):
+        metadata.values[modifier] = TextValue('Other')
+
+    target_path = tmp_path.as_posix()
+    observation = simple_collection.observations[1]
+    for _ in range(2):
+        simple_collection.observations.append(Observation(
+            observation.patient, observation.concept, observation.visit,
+            observation.trial_visit, observation.start_date, None,
+            intern_value(CategoricalValue, 'value'), metadata))
+    writer = TransmartCopyWriter(target_path)
+    writer.write_collection(simple_collection)
+    del writer
+
+    tval_chars = get_column_values(
+        target_path + '/i2b2demodata/observation_fact.tsv', 'tval_char')
+    blobs = get_column_values(
+        target_path + '/i2b2demodata/observation_fact.tsv', 'observation_blob')
+    assert tval_chars[-4:] == ['value', '', 'value', '']
+    assert blobs[-4:] == ['', 'Invalid', '', 'Invalid']
+
+
+def test_load_collection_in_parallel(tmp_path, simple_collection):
+    observations = simple_collection.observations
+    simple_collection.observations = [
+        observations[index % len(observations)] for index in range(50)]
+    output = {}
+    for workers in [1, 2, 3]:
+        target_path = (tmp_path / str(workers)).as_posix()
+        writer = TransmartCopyWriter(target_path, workers=workers,
+                                     shard_size=7)
+        writer.write_collection(simple_collection)
+        del writer
+        with open(target_path + '/i2b2demodata/observation_fact.tsv',
+                  'rb') as file:
+            output[workers] = file.read()
+        assert sorted(os.listdir(target_path)) == [
+            'i2b2demodata', 'i2b2metadata']
+    assert output[2] == output[1]
+    assert output[3] == output[1]
+    assert output[1].count(b'\n') == 1 + 50 + 17
+
+
+def test_load_unpicklable_observations_in_parallel(tmp_path,
+                                                   simple_collection):
+    class LocalValue(CategoricalValue):
+        """ A value class that cannot be pickled, because it is local. """
+        __slots__ = ()
+
+    observations = [
+        Observation(observation.patient, observation.concept,
+                    observation.visit, observation.trial_visit,
+                    observation.start_date, observation.end_date,
+                    LocalValue('value {}'.format(index)))
+        for index, observation in enumerate(
+            simple_collection.observations[:1] * 30)]
+    simple_collection.observations = observations
+    output = {}
+    for workers in [1, 2]:
+        target_path = (tmp_path / str(workers)).as_posix()
+        writer = TransmartCopyWriter(target_path, workers=workers,
+                                     shard_size=7)
+        writer.write_collection(simple_collection)
+        writer.close()
+        with open(target_path + '/i2b2demodata/observation_fact.tsv',
+                  'rb') as file:
+            output[workers] = file.read()
+    # The workers read the observations they inherit, which are not sent
+    assert output[2] == output[1]
+    assert output[1].count(b'\n') == 1 + 30
+
+
+def test_load_generated_observations_with_workers(tmp_path,
+                                                  simple_collection):
+    observations = simple_collection.observations
+    output = {}
+    for workers in [1, 2]:
+        target_path = (tmp_path / str(workers)).as_posix()
+        # Observations that are not a sequence are written serially
+        simple_collection.observations = (
+            observation for observation in observations)
+        writer = TransmartCopyWriter(target_path, workers=workers,
+                                     shard_size=7)
+        writer.write_collection(simple_collection, streaming=True)
+        writer.close()
+        with open(target_path + '/i2b2demodata/observation_fact.tsv',
+                  'rb') as file:
+            output[workers] = file.read()
+    assert output[2] == output[1]
+
+
+@pytest.mark.parametrize('compression', [
+    None, Compression(CompressionFormat.Gzip)])
+def test_append_collection(tmp_path, simple_collection, compression):
+    target_path = tmp_path.as_posix()
+    writer = TransmartCopyWriter(target_path, compression=compression)
+    writer.write_collection(simple_collection)
+    writer.close()
+
+    # The increment contains a new patient, visit and observation
+    # and the entities of the first collection
+    observation = simple_collection.observations[0]
+    patient = Patient('SUBJ1', 'female', [])
+    visit = Visit(patient, 'visit2', None, None, None, None, None, None, [])
+    simple_collection.patients.append(patient)
+    simple_collection.visits.append(visit)
+    simple_collection.observations = [Observation(
+        patient, observation.concept, visit, observation.trial_visit,
+        observation.start_date, None, CategoricalValue('new'))]
+    writer = TransmartCopyWriter(target_path, compression=compression,
+                                 append=True)
+    writer.write_collection(simple_collection)
+    writer.close()
+
+    extension = compression.extension if compression else ''
+
+    def read_rows(table: str) -> List[List[str]]:
+        with open_compressed(path.join(target_path, table + '.tsv' + extension),
+                             compression) as file:
+            return list(csv.reader(file, dialect='excel-tab'))
+
+    patients = read_rows('i2b2demodata/patient_dimension')
+    assert patients[1:] == [['0', 'male'], ['1', 'female']]
+    visits = read_rows('i2b2demodata/visit_dimension')
+    assert [row[:2] for row in visits[1:]] == [['0', '0'], ['1', '1']]
+    assert len(read_rows('i2b2demodata/concept_dimension')) == 1 + 4
+    assert len(read_rows('i2b2metadata/dimension_description')) == 1 + 6
+    assert len(read_rows('i2b2metadata/i2b2_secure')) == 1 + 6
+    observations = read_rows('i2b2demodata/observation_fact')
+    assert observations[0][0] == 'encounter_num'
+    assert [row[7] for row in observations[1:]] == ['0', '1', '1', '2', '3']
+    assert observations[-1][:3] == ['1', '1', 'dummy_code']
+
+
+def test_append_to_invalid_directory(tmp_path):
+    os.mkdir(path.join(tmp_path.as_posix(), 'i2b2demodata'))
+    with open(path.join(tmp_path.as_posix(), 'i2b2demodata', 'study.tsv'),
+              'w') as study_file:
+        study_file.write('id\tname\r\n')
+    with pytest.raises(LoaderException):
+        TransmartCopyWriter(tmp_path.as_posix(), append=True)
+
+
+def test_deep_ontology(tmp_path, simple_collection):
+    concept = simple_collection.concepts[0]
+    top_node = StudyNode(simple_collection.studies[0])
+    node = top_node
+    # Deeper than the recursion limit
+    for depth in range(1500):
+        child = TreeNode('Level {}'.format(depth))
+        node.add_child(child)
+        node = child
+    node.add_child(ConceptNode(concept))
+    simple_collection.ontology = [top_node]
+    target_path = tmp_path.as_posix()
+    writer = TransmartCopyWriter(target_path)
+    writer.write_collection(simple_collection)
+    writer.close()
+
+    levels = get_column_values(
+        target_path + '/i2b2metadata/i2b2_secure.tsv', 'c_hlevel')
+    assert levels == [str(level) for level in range(1502)]
+    paths = get_column_values(
+        target_path + '/i2b2metadata/i2b2_secure.tsv', 'c_fullname')
+    assert paths[2] == '\\Test study\\Level 0\\Level 1\\'
+
+
+def test_duplicate_tags(tmp_path, simple_collection):
+    top_node = simple_collection.ontology[0]
+    duplicate_node = StudyNode(simple_collection.studies[0])
+    duplicate_node.metadata = TreeNodeMetadata(
+        {'Upload date': '2019-07-01', 'Source': 'Test'})
+    simple_collection.ontology.append(duplicate_node)
+    target_path = tmp_path.as_posix()
+    writer = TransmartCopyWriter(target_path)
+    writer.write_collection(simple_collection)
+    writer.close()
+
+    tags = get_column_values(
+        target_path + '/i2b2metadata/i2b2_tags.tsv', 'tag_type')
+    assert top_node.metadata.values['Upload date'] == '2019-07-01'
+    assert tags == ['Upload date', 'Source']
+    assert TagKey('\\a\\', 'Source') == TagKey('\\a\\', 'Source')
+    assert len({TagKey('\\a\\', 'Source'), TagKey('\\a\\', 'Source')}) == 1
@@ -0,0 +1,131 @@
+import threading
+from queue import Queue
+from typing import Optional, List, Any, AnyStr
+
+from transmart_loader.loader_exception import LoaderException
+
+
+class BackgroundFile:
+    """
+    Text file that is written by a background thread.
+
+    Written text is collected in a buffer. Full buffers are encoded and
+    passed to the writer thread through a bounded queue, so that formatting
+    rows and writing to the file overlap. With the default queue size of
+    two, one buffer is written while the next one is filled (double
+    buffering). The writing thread waits when the writer thread falls behind
+    by more than queue_size buffers (backpressure).
+
+    An error in the writer thread is raised in the writing thread at the
+    next flush, sync or close. After an error, the writer thread discards
+    the remaining buffers, so the writing thread never blocks on a failed
+    file.
+
+    Text is written encoded as UTF-8. A binary file accepts bytes instead
+    of text. Creates a new file when initialised and fails when the file
+    already exists, unless append is set.
+    """
+    def write(self, data: AnyStr) -> None:
+        self.buffer.append(data)
+        self.buffered = self.buffered + len(data)
+        if self.buffered >= self.buffer_size:
+            self.flush()
+
+    def check_error(self) -> None:
+        if self.error:
+            raise LoaderException(
+                'Error writing {}: {}'.format(self.path, self.error))
+
+    def flush(self) -> None:
+        """ Passes the buffered text to the writer thread.
+        """
+        self.check_error()
+        if self.buffer:
+            if self.binary:
+                chunk = b''.join(self.buffer)
+            else:
+                chunk = ''.join(self.buffer).encode('utf-8')
+            self.queue.put(chunk)
+            self.buffer = []
+            self.buffered = 0
+
+    def write_chunks(self) -> None:
+        chunk = self.queue.get()
+        while chunk is not None:
+            if self.error is None:
+                try:
+                    self.stream.write(chunk)
+                except Exception as e:
+                    self.error = e
+            self.queue.task_done()
+            chunk = self.queue.get()
+
+    def open_stream(self) -> Any:
+        """ Returns the stream that the writer thread writes to,
+        the raw file by default.
+        """
+        return self.raw
+
+    def end_segment(self) -> int:
+        """ Ends a segment of the stream that can be truncated after.
+
+        :return: the size of the file at the end of the segment.
+        """
+        return self.raw.tell()
+
+    def sync(self) -> int:
+        """ Writes the buffered data and waits until the writer thread has
+        written it, such that the file can be truncated to the returned size
+        and appended to later.
+
+        :return: the size of the file in bytes.
+        """
+        self.flush()
+        self.queue.join()
+        self.check_error()
+        size = self.end_segment()
+        self.raw.flush()
+        return size
+
+    def close(self) -> None:
+        """ Writes the buffered data, waits for the writer thread to finish
+        and closes the file. Raises errors of the writer thread.
+        Closing multiple times has no effect.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.flush()
+        finally:
+            self.queue.put(None)
+            self.thread.join()
+            try:
+                if self.stream is not self.raw:
+                    self.stream.close()
+            finally:
+                self.raw.close()
+        self.check_error()
+
+    def __init__(self,
+                 path: str,
+                 buffer_size: int = 1 << 20,
+                 queue_size: int = 2,
+                 append: bool = False,
+                 binary: bool = False):
+        self.path = path
+        self.binary = binary
+        self.closed = False
+        self.raw = open(path, 'ab' if append else 'xb')
+        try:
+            self.stream = self.open_stream()
+        except LoaderException:
+            self.raw.close()
+            raise
+        self.buffer_size = buffer_size
+        self.buffer: List[AnyStr] = []
+        self.buffered = 0
+        self.error: Optional[Exception] = None
+        self.queue: Queue = Queue(queue_size)
+        self.thread = threading.Thread(target=self.write_chunks, daemon=True)
+        self.thread.start()
@@ -0,0 +1,86 @@
+from itertools import islice
+from time import perf_counter
+from typing import Callable, Dict, Optional, Iterable, Iterator, TypeVar
+
+from transmart_loader.transmart import DataCollection, collection_fields
+
+T = TypeVar('T')
+
+
+class CheckpointTracker:
+    """
+    Tracks the position in the fields of a data collection while it is
+    being written and saves checkpoints periodically.
+
+    A checkpoint is saved between two entities, when all entities before
+    the current position have been written. The elapsed time is checked
+    every check_items entities. The time between checkpoints is at least
+    the interval, and is increased if saving a checkpoint takes more than
+    max_overhead times the interval, such that the time spent on
+    checkpoints is bounded.
+
+    When resuming from a checkpoint, the entities before the saved
+    positions are skipped.
+    """
+    check_items = 256
+
+    def tracking(self, field: str, items: Iterable[T]) -> Iterator[T]:
+        """ Yields the items of a field, after skipping the items before
+        the saved position, and saves checkpoints when due.
+        """
+        iterator = iter(items)
+        position = self.positions.get(field, 0)
+        if position:
+            next(islice(iterator, position, position), None)
+        check_mask = self.check_items - 1
+        for item in iterator:
+            if not position & check_mask:
+                self.positions[field] = position
+                self.check()
+            yield item
+            position = position + 1
+        self.positions[field] = position
+        self.check()
+
+    def tracked(self, collection: DataCollection) -> DataCollection:
+        """ Wraps the fields of a collection in generators that skip the
+        entities that have been written already and save checkpoints.
+
+        :param collection: the collection.
+        :return: a collection that can be iterated once.
+        """
+        return DataCollection(**{
+            field: self.tracking(field, getattr(collection, field))
+            for field in collection_fields})
+
+    def check(self) -> None:
+        if perf_counter() >= self.next_checkpoint:
+            self.checkpoint()
+
+    def checkpoint(self) -> None:
+        """ Saves a checkpoint with the current positions.
+        """
+        start = perf_counter()
+        self.save(dict(self.positions))
+        end = perf_counter()
+        self.next_checkpoint = end + max(
+            self.interval, (end - start) / self.max_overhead)
+
+    def __init__(self,
+                 save: Callable[[Dict[str, int]], None],
+                 interval: float = 600.0,
+                 max_overhead: float = 0.05,
+                 positions: Optional[Dict[str, int]] = None):
+        """
+        :param save: the function that saves a checkpoint, given
+                     the number of entities written per field.
+        :param interval: the minimum number of seconds between checkpoints.
+        :param max_overhead: the maximum fraction of time spent saving
+                             checkpoints.
+        :param positions: the positions to resume from.
+        """
+        self.save = save
+        self.interval = interval
+        self.max_overhead = max_overhead
+        self.positions: Dict[str, int] = dict(positions or {})
+        self.next_checkpoint = perf_counter() + interval
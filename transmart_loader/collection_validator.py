@@ -1,61 +1,304 @@
-from typing import List
+from typing import List, Iterable, Callable, TypeVar, Iterator, \
+    Optional, MutableSet
 
 from transmart_loader.collection_visitor import CollectionVisitor
 from transmart_loader.console import Console
+from transmart_loader.digest_set import Key
+from transmart_loader.identifier_store import IdentifierStore
 from transmart_loader.loader_exception import LoaderException
 from transmart_loader.transmart import TreeNode, DataCollection, Observation, \
     Patient, Visit, TrialVisit, Study, Concept, Modifier, Dimension, \
-    RelationType, Relation
+    RelationType, Relation, ObservationBatch, ConceptNode, StudyNode
+
+T = TypeVar('T')
+
+
+def observation_referrer(observation: Observation) -> str:
+    return 'Observation of concept {} of patient {}'.format(
+        observation.concept.concept_code, observation.patient.identifier)
 
 
 class CollectionValidator(CollectionVisitor):
     """
     Validation class for TranSMART data collections.
+
+    Checks that ontology nodes are root nodes and that the entities that
+    are referred to are part of the collection: the patient, visit, trial
+    visit, concept and modifiers of observations and observation batches,
+    the patient of visits, the patients and relation type of relations,
+    the modifier of dimensions, the study of trial visits and the concepts
+    and studies of ontology nodes.
+
+    The identifiers of the entities are indexed while they are visited, in
+    the order of CollectionVisitor.visit, which visits entities before the
+    entities that refer to them. The sets of identifiers are created by an
+    IdentifierStore: a SqliteIdentifierStore keeps them on disk, for more
+    patients or visits than fit in memory, a CompactIdentifierStore stores
+    digests of the identifiers. Observations usually share their patient,
+    concept, trial visit or visit with the previous observation, which
+    are then not looked up again. All errors are collected in a single
+    pass: the number of errors is counted, the messages of the first
+    max_errors errors are kept.
     """
+    max_errors = 100
+
+    def add_error(self, message: str) -> None:
+        self.error_count = self.error_count + 1
+        if len(self.errors) < self.max_errors:
+            self.errors.append(message)
+
+    def check_patient(self, patient: Patient, referrer: str) -> None:
+        if patient.identifier not in self.patients:
+            self.add_error('{} refers to unknown patient {}'.format(
+                referrer, patient.identifier))
+
+    def check_visit(self, visit: Visit, referrer: str) -> None:
+        if visit.identifier not in self.visits:
+            self.add_error('{} refers to unknown visit {}'.format(
+                referrer, visit.identifier))
+
+    def check_trial_visit(self, trial_visit: TrialVisit,
+                          referrer: str) -> None:
+        if (trial_visit.study.study_id, trial_visit.rel_time_label) \
+                not in self.trial_visits:
+            self.add_error('{} refers to unknown trial visit {} of study {}'
+                           .format(referrer, trial_visit.rel_time_label,
+                                   trial_visit.study.study_id))
+
+    def check_concept(self, concept: Concept, referrer: str) -> None:
+        if concept.concept_code not in self.concepts:
+            self.add_error('{} refers to unknown concept {}'.format(
+                referrer, concept.concept_code))
+
+    def check_modifier(self, modifier: Modifier, referrer: str) -> None:
+        if modifier.modifier_code not in self.modifiers:
+            self.add_error('{} refers to unknown modifier {}'.format(
+                referrer, modifier.modifier_code))
 
     def visit_relation(self, relation: Relation) -> None:
-        pass
+        referrer = 'Relation {} of patient {}'.format(
+            relation.relation_type.label, relation.left.identifier)
+        self.check_patient(relation.left, referrer)
+        self.check_patient(relation.right, referrer)
+        if relation.relation_type.label not in self.relation_types:
+            self.add_error('{} refers to unknown relation type {}'.format(
+                referrer, relation.relation_type.label))
 
     def visit_relation_type(self, relation_type: RelationType) -> None:
-        pass
+        self.relation_types.add(relation_type.label)
 
     def visit_concept(self, concept: Concept) -> None:
-        pass
+        self.concepts.add(concept.concept_code)
 
     def visit_modifier(self, modifier: Modifier) -> None:
-        pass
+        self.modifiers.add(modifier.modifier_code)
 
     def visit_dimension(self, dimension: Dimension) -> None:
-        pass
+        if dimension.modifier is not None:
+            self.check_modifier(dimension.modifier,
+                                'Dimension {}'.format(dimension.name))
 
     def visit_study(self, study: Study) -> None:
-        pass
+        self.studies.add(study.study_id)
 
     def visit_trial_visit(self, trial_visit: TrialVisit) -> None:
-        pass
+        if trial_visit.study.study_id not in self.studies:
+            self.add_error('Trial visit {} refers to unknown study {}'.format(
+                trial_visit.rel_time_label, trial_visit.study.study_id))
+        self.trial_visits.add(
+            (trial_visit.study.study_id, trial_visit.rel_time_label))
 
     def visit_visit(self, visit: Visit) -> None:
-        pass
+        self.check_patient(visit.patient,
+                           'Visit {}'.format(visit.identifier))
+        self.visits.add(visit.identifier)
 
     def visit_patient(self, patient: Patient) -> None:
-        pass
+        self.patients.add(patient.identifier)
 
     def visit_observation(self, observation: Observation) -> None:
-        pass
+        # The message is only formatted for invalid observations
+        referrer = None
+        if observation.patient is not self.last_patient:
+            if observation.patient.identifier in self.patients:
+                self.last_patient = observation.patient
+            else:
+                referrer = observation_referrer(observation)
+                self.check_patient(observation.patient, referrer)
+        if observation.concept is not self.last_concept:
+            if observation.concept.concept_code in self.concepts:
+                self.last_concept = observation.concept
+            else:
+                referrer = referrer or observation_referrer(observation)
+                self.check_concept(observation.concept, referrer)
+        if observation.trial_visit is not self.last_trial_visit:
+            trial_visit = observation.trial_visit
+            if (trial_visit.study.study_id, trial_visit.rel_time_label) \
+                    in self.trial_visits:
+                self.last_trial_visit = trial_visit
+            else:
+                referrer = referrer or observation_referrer(observation)
+                self.check_trial_visit(trial_visit, referrer)
+        if observation.visit is not None \
+                and observation.visit is not self.last_visit:
+            if observation.visit.identifier in self.visits:
+                self.last_visit = observation.visit
+            else:
+                referrer = referrer or observation_referrer(observation)
+                self.check_visit(observation.visit, referrer)
+        if observation.metadata:
+            for modifier in observation.metadata.values:
+                if modifier.modifier_code not in self.modifiers:
+                    referrer = referrer or observation_referrer(observation)
+                    self.check_modifier(modifier, referrer)
+
+    def visit_observation_batch(self, batch: ObservationBatch) -> None:
+        referrer = 'Observation batch'
+        for patient in batch.patients:
+            self.check_patient(patient, referrer)
+        for concept in batch.concepts:
+            self.check_concept(concept, referrer)
+        for trial_visit in batch.trial_visits:
+            self.check_trial_visit(trial_visit, referrer)
+        for visit in batch.visits:
+            self.check_visit(visit, referrer)
+        self.check_batch_index(batch.patient_index, len(batch.patients),
+                               'patient', 0)
+        self.check_batch_index(batch.concept_index, len(batch.concepts),
+                               'concept', 0)
+        self.check_batch_index(batch.trial_visit_index,
+                               len(batch.trial_visits), 'trial visit', 0)
+        self.check_batch_index(batch.visit_index, len(batch.visits),
+                               'visit', -1)
+
+    def check_batch_index(self, index, size: int, name: str,
+                          minimum: int) -> None:
+        """ Checks that the indexes of an observation batch column are
+        within the bounds of the sequence of entities they refer to.
+
+        :param index: the array of indexes.
+        :param size: the number of entities.
+        :param name: the name of the entities in the error message.
+        :param minimum: the minimum index, -1 if the entity is optional.
+        """
+        if len(index) == 0:
+            return
+        low = int(index.min())
+        high = int(index.max())
+        if low < minimum or high >= size:
+            self.add_error(
+                'Observation batch has {} index {} out of range [{}, {})'
+                .format(name, low if low < minimum else high, minimum, size))
+
+    def check_node(self, node: TreeNode) -> None:
+        if isinstance(node, ConceptNode):
+            self.check_concept(node.concept, 'Node {}'.format(node.name))
+        elif isinstance(node, StudyNode):
+            if node.study.study_id not in self.studies:
+                self.add_error('Node {} refers to unknown study {}'.format(
+                    node.name, node.study.study_id))
 
     def visit_node(self, node: TreeNode) -> None:
         if node.parent is not None:
-            self.errors.append(
-                'Node {} is not a root node'.format(node.name))
+            self.add_error('Node {} is not a root node'.format(node.name))
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            self.check_node(node)
+            stack.extend(node.children)
+
+    def valid_items(self, items: Iterable[T],
+                    check: Callable[[T], None]) -> Iterator[T]:
+        """ Yields the items that pass the check function, such that
+        invalid items are skipped while the remaining errors are collected.
+        """
+        for item in items:
+            count = self.error_count
+            check(item)
+            if self.error_count == count:
+                yield item
+
+    def close(self) -> None:
+        """ Closes the sets of identifiers, e.g., their databases.
+        """
+        for identifiers in [self.concepts, self.modifiers, self.studies,
+                            self.trial_visits, self.patients, self.visits,
+                            self.relation_types]:
+            if hasattr(identifiers, 'close'):
+                identifiers.close()
 
-    def __init__(self):
+    def __init__(self, identifier_store: Optional[IdentifierStore] = None):
+        """
+        :param identifier_store: the store that creates the sets of
+                                 identifiers of the visited entities,
+                                 in memory by default.
+        """
+        store = identifier_store or IdentifierStore()
         self.errors: List[str] = []
+        self.error_count = 0
+        self.concepts: MutableSet[Key] = store.create_set(
+            'validated_concepts')
+        self.modifiers: MutableSet[Key] = store.create_set(
+            'validated_modifiers')
+        self.studies: MutableSet[Key] = store.create_set('validated_studies')
+        self.trial_visits: MutableSet[Key] = store.create_set(
+            'validated_trial_visits')
+        self.patients: MutableSet[Key] = store.create_set(
+            'validated_patients')
+        self.visits: MutableSet[Key] = store.create_set('validated_visits')
+        self.relation_types: MutableSet[Key] = store.create_set(
+            'validated_relation_types')
+        self.last_patient: Optional[Patient] = None
+        self.last_concept: Optional[Concept] = None
+        self.last_trial_visit: Optional[TrialVisit] = None
+        self.last_visit: Optional[Visit] = None
 
-    @staticmethod
-    def validate(collection: DataCollection):
-        validator = CollectionValidator()
-        validator.visit(collection)
-        if len(validator.errors) is not 0:
-            for error in validator.errors:
+    def report(self) -> None:
+        """ Prints the collected errors and fails if there are any.
+        """
+        if len(self.errors) != 0:
+            for error in self.errors:
                 Console.error(error)
+            if self.error_count > len(self.errors):
+                Console.error('... and {} more errors'.format(
+                    self.error_count - len(self.errors)))
             raise LoaderException('Invalid collection')
+
+    def validated(self, collection: DataCollection) -> DataCollection:
+        """ Wraps a collection in a collection that validates the entities
+        while they are being iterated. This allows validation and writing
+        in a single pass over the collection, which is required when the
+        collection contains iterables that can only be consumed once.
+        Entities with errors are skipped, such that all errors are
+        collected. Call report() after the collection has been consumed.
+
+        :param collection: the collection to validate.
+        :return: a collection with the same entities.
+        """
+        return DataCollection(
+            self.valid_items(collection.concepts, self.visit_concept),
+            self.valid_items(collection.modifiers, self.visit_modifier),
+            self.valid_items(collection.dimensions, self.visit_dimension),
+            self.valid_items(collection.studies, self.visit_study),
+            self.valid_items(collection.trial_visits,
+                             self.visit_trial_visit),
+            self.valid_items(collection.visits, self.visit_visit),
+            self.valid_items(collection.ontology, self.visit_node),
+            self.valid_items(collection.patients, self.visit_patient),
+            self.valid_items(collection.observations,
+                             self.visit_observation),
+            self.valid_items(collection.relation_types,
+                             self.visit_relation_type),
+            self.valid_items(collection.relations, self.visit_relation),
+            self.valid_items(collection.observation_batches,
+                             self.visit_observation_batch))
+
+    @staticmethod
+    def validate(collection: DataCollection,
+                 identifier_store: Optional[IdentifierStore] = None):
+        validator = CollectionValidator(identifier_store)
+        try:
+            validator.visit(collection)
+        finally:
+            validator.close()
+        validator.report()
@@ -1,9 +1,9 @@
 from abc import abstractmethod
-from typing import Optional
+from typing import Optional, Iterable
 
 from transmart_loader.transmart import DataCollection, Concept, Patient, \
     Observation, TreeNode, Visit, TrialVisit, Study, Modifier, Dimension, \
-    Relation, RelationType
+    Relation, RelationType, ObservationBatch
 
 
 class CollectionVisitor:
@@ -47,6 +47,10 @@ class CollectionVisitor:
     def visit_observation(self, observation: Observation) -> None:
         pass
 
+    @abstractmethod
+    def visit_observation_batch(self, batch: ObservationBatch) -> None:
+        pass
+
     @abstractmethod
     def visit_relation_type(self, relation_type: RelationType) -> None:
         pass
@@ -55,6 +59,10 @@ class CollectionVisitor:
     def visit_relation(self, relation: Relation) -> None:
         pass
 
+    def visit_observations(self, observations: Iterable[Observation]) -> None:
+        for observation in observations:
+            self.visit_observation(observation)
+
     def visit(self, collection: Optional[DataCollection]) -> None:
         if collection is None:
             return
@@ -74,8 +82,9 @@ class CollectionVisitor:
             self.visit_visit(visit)
         for node in collection.ontology:
             self.visit_node(node)
-        for observation in collection.observations:
-            self.visit_observation(observation)
+        self.visit_observations(collection.observations)
+        for batch in collection.observation_batches:
+            self.visit_observation_batch(batch)
         for relation_type in collection.relation_types:
             self.visit_relation_type(relation_type)
         for relation in collection.relations:
@@ -0,0 +1,111 @@
+import gzip
+import io
+from enum import Enum
+from typing import Optional, TextIO, Any
+
+from transmart_loader.background_file import BackgroundFile
+from transmart_loader.loader_exception import LoaderException
+
+try:
+    import zstandard
+except ImportError:  # zstandard is only required for zstd compression
+    zstandard = None
+
+
+class CompressionFormat(Enum):
+    """
+    Compression format of an output file
+    """
+    Gzip = 'gz'
+    Zstd = 'zst'
+
+
+class Compression:
+    def __init__(self,
+                 compression_format: CompressionFormat,
+                 level: Optional[int] = None):
+        """
+        Compression settings of an output file
+
+        :param compression_format: the compression format.
+        :param level: the compression level. Defaults to 6 for gzip
+                      and 3 for zstd.
+        """
+        self.compression_format = compression_format
+        self.level = level
+
+    @property
+    def extension(self) -> str:
+        return '.' + self.compression_format.value
+
+
+class CompressedFile(BackgroundFile):
+    """
+    Text file that is compressed in a background thread.
+
+    The compression thread falls behind by at most queue_size buffers.
+    Creates a new file when initialised and fails when the file
+    already exists, unless append is set. Appended data is written
+    as a new gzip member or zstd frame.
+    """
+    def open_stream(self) -> Any:
+        compression = self.compression
+        if compression.compression_format is CompressionFormat.Gzip:
+            level = 6 if compression.level is None else compression.level
+            return gzip.GzipFile(
+                fileobj=self.raw, mode='wb', compresslevel=level, mtime=0)
+        if compression.compression_format is CompressionFormat.Zstd:
+            if zstandard is None:
+                raise LoaderException(
+                    'Zstd compression requires the zstandard package')
+            level = 3 if compression.level is None else compression.level
+            return zstandard.ZstdCompressor(
+                level=level).stream_writer(self.raw)
+        raise LoaderException('Compression format not supported: {}'.format(
+            compression.compression_format))
+
+    def end_segment(self) -> int:
+        """ Ends the current gzip member or zstd frame.
+        """
+        if self.compression.compression_format is CompressionFormat.Gzip:
+            self.stream.close()
+            size = self.raw.tell()
+            # The header of the next member is written immediately
+            self.stream = self.open_stream()
+        else:
+            self.stream.flush(zstandard.FLUSH_FRAME)
+            size = self.raw.tell()
+        return size
+
+    def __init__(self,
+                 path: str,
+                 compression: Compression,
+                 buffer_size: int = 1 << 20,
+                 queue_size: int = 4,
+                 append: bool = False,
+                 binary: bool = False):
+        self.compression = compression
+        super().__init__(path, buffer_size, queue_size, append, binary)
+
+
+def open_compressed(path: str, compression: Optional[Compression]) -> TextIO:
+    """ Opens a text file, that may be compressed, for reading.
+    Files with multiple gzip members or zstd frames are read completely.
+
+    :param path: the path of the file, including the compression extension.
+    :param compression: the compression settings, or None.
+    :return: the text stream.
+    """
+    if compression is None:
+        return open(path, newline='')
+    if compression.compression_format is CompressionFormat.Gzip:
+        return gzip.open(path, 'rt', newline='')
+    if compression.compression_format is CompressionFormat.Zstd:
+        if zstandard is None:
+            raise LoaderException(
+                'Zstd compression requires the zstandard package')
+        stream = zstandard.ZstdDecompressor().stream_reader(
+            open(path, 'rb'), read_across_frames=True, closefd=True)
+        return io.TextIOWrapper(stream, newline='')
+    raise LoaderException('Compression format not supported: {}'.format(
+        compression.compression_format))
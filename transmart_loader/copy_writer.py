@@ -1,19 +1,44 @@
+import csv
+import multiprocessing
 import os
-from datetime import date, datetime, timezone
+import pickle
+import shutil
+import sys
+import tempfile
+from collections import deque, abc
+from datetime import date, datetime, timezone, timedelta
 from enum import Enum
+from functools import lru_cache
 from os import path
-from typing import Set, Tuple, Dict, Optional
+from typing import Tuple, Dict, Optional, Any, Iterable, List, Deque, \
+    Iterator, MutableMapping, MutableSet, Sequence, Collection
 
+from transmart_loader.checkpoint import CheckpointTracker
 from transmart_loader.collection_validator import CollectionValidator
 from transmart_loader.collection_visitor import CollectionVisitor
+from transmart_loader.compression import Compression, open_compressed
 from transmart_loader.console import Console
+from transmart_loader.duplicate_filter import DuplicateFilter, DuplicateMode
+from transmart_loader.identifier_store import IdentifierStore
 from transmart_loader.loader_exception import LoaderException
+from transmart_loader.metrics import Metrics
+from transmart_loader.pg_binary_writer import PgBinaryWriter, PgType
+from transmart_loader.progress import ProgressReporter
+from transmart_loader.row_encoder import format_field
+from transmart_loader.sink import Sink, FileSink, OutputFormat
+from transmart_loader.sorting_writer import SortingWriter, SortKey
 from transmart_loader.transmart import DataCollection, Concept, Observation, \
     Patient, TreeNode, Visit, TrialVisit, Study, ValueType, StudyNode, \
     ConceptNode, Dimension, Modifier, Value, DimensionType, \
-    Relation, RelationType, TreeNodeMetadata
+    Relation, RelationType, TreeNodeMetadata, ObservationBatch, is_interned
+from transmart_loader.csv_types import CsvWriter
 from transmart_loader.tsv_writer import TsvWriter
 
+try:
+    import numpy as np
+except ImportError:  # numpy is only required for observation batches
+    np = None
+
 
 class VisualAttribute(Enum):
     """
@@ -30,12 +55,24 @@ class VisualAttribute(Enum):
 
 
 class TagKey:
+    __slots__ = ('node_path', 'tag_type')
+
     def __init__(self,
                  node_path: str,
                  tag_type: str):
         self.node_path = node_path
         self.tag_type = tag_type
 
+    def __eq__(self, other: object) -> bool:
+        return isinstance(other, TagKey) \
+            and self.node_path == other.node_path \
+            and self.tag_type == other.tag_type
+
+    def __hash__(self) -> int:
+        return hash((self.node_path, self.tag_type))
+
+
+EncodedValue = Tuple[str, Optional[str], Optional[Any], Optional[str]]
 
 ValueTypeToVisualAttribute = {
     ValueType.Numeric: 'N',
@@ -119,12 +156,20 @@ def get_folder_node_row(node: TreeNode, level, node_path):
     return row
 
 
+date_cache_size = 65536
+"""
+Maximum number of cached date conversions per conversion function.
+"""
+
+
+@lru_cache(maxsize=date_cache_size, typed=True)
 def to_utc(value: date) -> date:
     if isinstance(value, datetime):
         return value.astimezone(timezone.utc).replace(tzinfo=None)
     return value
 
 
+@lru_cache(maxsize=date_cache_size, typed=True)
 def format_date(value: Optional[date]) -> Optional[str]:
     if value is None:
         return None
@@ -132,6 +177,15 @@ def format_date(value: Optional[date]) -> Optional[str]:
 
 
 def microseconds(value: date) -> float:
+    # Equal datetimes with different UTC offsets have different wall-clock
+    # fields, so the offset is part of the cache key.
+    utc_offset = value.utcoffset() if isinstance(value, datetime) else None
+    return wall_clock_timestamp(value, utc_offset)
+
+
+@lru_cache(maxsize=date_cache_size, typed=True)
+def wall_clock_timestamp(value: date,
+                         _utc_offset: Optional[timedelta]) -> float:
     # numerical value is the timestamp in microseconds
     if isinstance(value, datetime):
         dt: datetime = datetime(value.year, value.month, value.day,
@@ -143,15 +197,258 @@ def microseconds(value: date) -> float:
     return dt.timestamp() * 1000
 
 
+def format_date_array(values):
+    """ Formats an array of UTC dates the way format_date formats dates.
+    Day precision datetime64 arrays are formatted as dates,
+    other datetime64 arrays and int64 arrays of microseconds since the epoch
+    are formatted as datetimes. Missing dates (NaT or
+    ObservationBatch.missing_date) are formatted as empty strings.
+    Requires numpy.
+
+    :param values: the datetime64 or int64 array.
+    :return: the array of formatted dates.
+    """
+    values = np.asarray(values)
+    if values.dtype.kind == 'M' and np.datetime_data(values.dtype)[0] in [
+            'Y', 'M', 'W', 'D']:
+        dates = values.astype('datetime64[D]')
+        result = np.datetime_as_string(dates, unit='D')
+        result[np.isnat(dates)] = ''
+        return result
+    values = ObservationBatch.epoch_microseconds(values, len(values))
+    dates = values.view('datetime64[us]')
+    result = np.datetime_as_string(dates, unit='us')
+    whole_seconds = values % 1000000 == 0
+    result[whole_seconds] = np.datetime_as_string(
+        dates[whole_seconds], unit='s')
+    result = np.char.replace(result, 'T', ' ')
+    result[values == ObservationBatch.missing_date] = ''
+    return result
+
+
+def microseconds_array(values):
+    """ Converts an array of UTC dates to timestamps the way microseconds
+    converts dates. Missing dates are converted to NaN. Requires numpy.
+
+    :param values: the datetime64 array, or int64 array of microseconds
+                   since the epoch.
+    :return: the float64 array of timestamps.
+    """
+    values = np.asarray(values)
+    if values.dtype.kind != 'M':
+        values = values.astype(np.int64).view('datetime64[us]')
+    seconds = values.astype('datetime64[s]')
+    result = seconds.astype(np.int64) * 1000.0
+    result[np.isnat(seconds)] = np.nan
+    return result
+
+
+def quote_strings(values):
+    """ Formats an array of strings the way csv.writer does: None is
+    written as an empty string, strings that contain a tab, newline or
+    quote character are quoted. The result is an object array, such that
+    the strings are not padded to the length of the longest string.
+    """
+    return np.frompyfunc(format_field, 1, 1)(
+        np.asarray(values, dtype=object)).astype(object)
+
+
+def join_columns(columns) -> str:
+    """ Joins arrays of formatted values to tab-separated rows.
+    The rows are joined per row, with str.join.
+    """
+    rows = zip(*[column.tolist() for column in columns])
+    return '\r\n'.join(['\t'.join(row) for row in rows]) + '\r\n'
+
+
 def format_bool(value: Optional[bool]) -> Optional[str]:
     if value is None:
         return None
     return 't' if value else 'f'
 
 
+def observation_sort_key(row: Sequence[Any]) -> Tuple[int, str, str, int]:
+    """ The sort key of an observation_fact row: patient_num, concept_cd,
+    start_date and instance_num. Rows without start date come first.
+    """
+    return int(row[1]), row[2], row[4] or '', int(row[7])
+
+
+shard_writer: Optional['TransmartCopyWriter'] = None
+"""
+The copy of the writer used by an observation shard worker process.
+"""
+
+shard_observations: Optional[Sequence[Observation]] = None
+"""
+The observations written in parallel. The shard worker processes are
+forked while it is set, such that they inherit the observations instead
+of receiving copies.
+"""
+
+
+def init_shard_writer(writer_state: bytes) -> None:
+    """ Initialises a worker process with a copy of the writer.
+    The copy is unpickled explicitly, such that the worker does not share
+    the open files of the writer, also when the process is forked.
+    """
+    global shard_writer
+    shard_writer = pickle.loads(writer_state)
+
+
+def write_observation_shard(shard_path: str,
+                            instance_num: int,
+                            start: int,
+                            stop: int) -> str:
+    """ Writes a range of the observations to a shard file in a worker
+    process.
+
+    :param shard_path: the path of the shard file.
+    :param instance_num: the instance number of the first observation.
+    :param start: the index of the first observation.
+    :param stop: the index after the last observation.
+    :return: the path of the shard file.
+    """
+    writer = shard_writer
+    observations = shard_observations
+    writer.observations_writer = TsvWriter(shard_path)
+    writer.instance_num = instance_num
+    try:
+        for index in range(start, stop):
+            writer.visit_observation(observations[index])
+    finally:
+        writer.observations_writer.close()
+    return shard_path
+
+
+class ExcludedTableWriter(CsvWriter):
+    """
+    Writer of a table that is excluded from the output, see the tables
+    argument of TransmartCopyWriter. Writing rows raises a LoaderException.
+    """
+    path = None
+
+    def writerow(self, row: Sequence[Any]) -> None:
+        raise LoaderException(
+            'Table {} is excluded from the output'.format(self.table))
+
+    def writerows(self, rows: Sequence[Sequence[Any]]) -> None:
+        for row in rows:
+            self.writerow(row)
+
+    def write(self, data: str) -> None:
+        self.writerow([data])
+
+    def close(self) -> None:
+        pass
+
+    def __init__(self, table: str):
+        self.table = table
+
+
 class TransmartCopyWriter(CollectionVisitor):
     """ Writes TranSMART data collections to a folder with files
     that can be loaded into a TranSMART database using transmart-copy.
+
+    If multiple workers are specified, observations are written in parallel
+    by a pool of worker processes. The observations are split in shards of
+    shard_size observations, each shard is written to a separate file
+    by a worker and the shard files are appended to the observations file
+    in order. The output is the same as when written by a single process.
+    The workers are forked and read their shards from the observations they
+    inherit, so the observations must be a sequence, e.g., a list, and the
+    platform must support the fork start method. Other observations, e.g.,
+    generators, are written by a single process, as are the observations
+    of collections that are validated while streaming or tracked for
+    progress reports.
+
+    The tables are written to a sink, by default a FileSink that writes
+    the files to the output directory using the compression, threaded and
+    output_format arguments. Other sinks, e.g., a FifoSink or a MemorySink,
+    support neither append mode nor checkpoints.
+
+    The output files can be compressed. The compression applies to all
+    tables, unless specified otherwise for a table in table_compression,
+    a map from table name (e.g., 'observation_fact') to compression settings.
+
+    If metrics are specified, the visit methods and table writers
+    are instrumented to record call counts, time, rows and bytes written
+    and deduplication hits.
+
+    If a progress reporter is specified, the progress of writing
+    a collection is reported periodically.
+
+    In append mode, the writer continues writing to the files in an existing
+    output directory. The identifier maps and the instance number are
+    restored from the existing files, so that only rows for new entities
+    are written and new identifiers continue the existing sequences.
+    The files must have been written with the same compression settings.
+
+    If a checkpoint interval is specified, a checkpoint is saved to the output
+    directory periodically while writing a collection, with the identifier
+    maps, the instance number, the size of each output file and the number
+    of entities written per collection field. If writing is interrupted,
+    a writer created with resume set truncates the files to the sizes of the
+    last checkpoint and, when the same collection is passed to
+    write_collection, skips the entities that were written before the
+    checkpoint. The checkpoint is removed when the writer is closed after
+    the collection has been written. Checkpoints require a single worker.
+
+    The maps from patient and visit identifiers to numbers and the sets of
+    concept codes, modifier codes, ontology paths and tags are created by
+    the identifier store, as are the sets of identifiers of the
+    CollectionValidator. The default store keeps them in memory. Use a
+    SqliteIdentifierStore to keep them on disk, for more patients, visits
+    or ontology nodes than fit in memory, and a CompactIdentifierStore to
+    store digests of the codes and paths.
+
+    With the PgBinary output format, tables are written in PostgreSQL binary
+    COPY format, to files with extension '.bin', which PostgreSQL loads
+    without parsing text. The column types are taken from column_types
+    and table_column_types, for the columns in the table headers, and
+    follow the TranSMART 17.1 schema. Append mode requires tab-separated
+    output.
+
+    If threaded is set, uncompressed output files are written by background
+    threads, like compressed files, such that formatting rows overlaps with
+    writing them. Each file has a writer thread that receives chunks of
+    encoded rows through a bounded queue: when a writer thread falls behind,
+    the visitor waits until a chunk has been written. An error in a writer
+    thread is raised in the visitor at the next chunk, checkpoint or when
+    the writer is closed. Closing the writer writes the remaining rows and
+    waits for the writer threads to finish.
+
+    If sort_observations is set, the observation_fact table is written in
+    the order of patient_num, concept_cd, start_date and instance_num, which
+    makes loading and indexing the table faster and groups the observations
+    of a patient. The rows are sorted with an external merge sort: at most
+    sort_memory bytes of rows are kept in memory, sorted runs are spilled to
+    temporary files in the output directory and merged when the writer is
+    closed, such that the table is only written when the writer is closed.
+    Sorted output supports neither append mode nor checkpoints.
+
+    If tables is specified, only those tables are created, e.g., for
+    writing parts of a collection that only produce rows in some tables.
+    Writing a row to another table raises a LoaderException.
+
+    If duplicates is specified, observations with the same patient,
+    concept, start date, trial visit, modifiers and values are detected with
+    a DuplicateFilter, using at most duplicate_memory bytes of memory and
+    bucket files in the output directory. The duplicates are reported per
+    concept when the writer is closed, and dropped or raised as a
+    LoaderException depending on the DuplicateMode, keeping the order of
+    the observations. Duplicates of
+    observations written before, in append mode, are not detected.
+    Duplicate detection does not support checkpoints.
+    """
+
+    checkpoint_file = 'checkpoint.pickle'
+
+    checkpoint_maps = ['concepts', 'modifiers', 'dimensions', 'studies',
+                       'trial_visits', 'patients', 'relation_types', 'visits',
+                       'paths', 'tags']
+    """
+    The identifier maps that are saved in a checkpoint.
     """
 
     concepts_header = ['concept_cd', 'concept_path', 'name_char']
@@ -230,6 +527,71 @@ class TransmartCopyWriter(CollectionVisitor):
                         'biological',
                         'share_household']
 
+    column_types: Dict[str, PgType] = {
+        'encounter_num': PgType.Numeric,
+        'patient_num': PgType.Numeric,
+        'instance_num': PgType.Numeric,
+        'trial_visit_num': PgType.Numeric,
+        'study_num': PgType.Numeric,
+        'nval_num': PgType.Numeric,
+        'rel_time_num': PgType.Numeric,
+        'length_of_stay': PgType.Numeric,
+        'c_hlevel': PgType.Numeric,
+        'left_subject_id': PgType.Numeric,
+        'right_subject_id': PgType.Numeric,
+        'id': PgType.Int4,
+        'sort_index': PgType.Int4,
+        'dimension_description_id': PgType.Int4,
+        'tag_id': PgType.Int4,
+        'tags_idx': PgType.Int4,
+        'relation_type_id': PgType.Int4,
+        'start_date': PgType.Timestamp,
+        'end_date': PgType.Timestamp,
+        'symmetrical': PgType.Bool,
+        'biological': PgType.Bool,
+        'share_household': PgType.Bool
+    }
+    """
+    The types of the columns in binary output, by column name.
+    Other columns are written as text.
+    """
+
+    table_column_types: Dict[str, Dict[str, PgType]] = {
+        'i2b2demodata/patient_mapping': {'patient_num': PgType.Int4},
+        'i2b2demodata/encounter_mapping': {'encounter_num': PgType.Int4},
+        'i2b2metadata/study_dimension_descriptions': {
+            'study_id': PgType.Numeric}
+    }
+    """
+    The types of columns in binary output that differ from column_types,
+    by table.
+    """
+
+    instrumented_methods: Dict[str, Optional[str]] = {
+        'visit_concept': 'concepts',
+        'visit_modifier': 'modifiers',
+        'visit_dimension': 'dimensions',
+        'visit_study': 'studies',
+        'visit_trial_visit': 'trial_visits',
+        'visit_patient': 'patients',
+        'visit_visit': 'visits',
+        'visit_node': None,
+        'visit_tree_node': None,
+        'write_node': None,
+        'write_tree_node': 'paths',
+        'write_tree_node_tags': 'tags',
+        'visit_observations': None,
+        'visit_observation': None,
+        'write_observation': None,
+        'visit_observation_batch': None,
+        'visit_relation_type': 'relation_types',
+        'visit_relation': None
+    }
+    """
+    The methods instrumented when metrics are enabled, with the identifier
+    map used to count deduplication hits.
+    """
+
     def visit_concept(self, concept: Concept) -> None:
         """ Serialises a Concept entity to a TSV file.
 
@@ -317,21 +679,27 @@ class TransmartCopyWriter(CollectionVisitor):
 
     def write_tree_node_tags(self, metadata: TreeNodeMetadata, node_path: str):
         for tag_type, tag in metadata.values.items():
-            tag_key = TagKey(node_path, tag_type)
+            tag_key = (node_path, tag_type)
             if tag_key not in self.tags:
-                tag_id = len(self.tags)
+                tag_id = self.first_tag_id + len(self.tags)
                 row = get_tree_node_tag_row(tag_id, node_path, tag, tag_type)
                 self.tree_node_tags_writer.writerow(row)
-                self.tags.add(TagKey(node_path, tag_type))
+                self.tags.add(tag_key)
 
-    def visit_tree_node(self, node: TreeNode, level=0, parent_path='\\'):
-        """ Serialises a TreeNode entity and its children to a TSV file.
+    def write_tree_node(self, row: List[Any], node_path: str) -> None:
+        if node_path not in self.paths:
+            if len(node_path) > 900:
+                Console.warning("Path too long: " + node_path)
+            self.tree_nodes_writer.writerow(row)
+            self.paths.add(node_path)
 
-        :param node: the TreeNode entity
-        :param level: the hierarchy level of the node
-        :param parent_path: the path of the parent node.
+    def write_node(self, node: TreeNode, level: int,
+                   parent_path: str) -> Optional[str]:
+        """ Serialises a TreeNode entity, without its children.
+
+        :return: the path of the node, or None if the node is skipped.
         """
-        node_path = parent_path + node.name + '\\'
+        node_path = sys.intern(parent_path + node.name + '\\')
 
         if node.metadata:
             self.write_tree_node_tags(node.metadata, node_path)
@@ -344,14 +712,37 @@ class TransmartCopyWriter(CollectionVisitor):
             row = get_folder_node_row(node, level, node_path)
         else:
             Console.warning('Skipping node {}'.format(node_path))
+            return None
+        self.write_tree_node(row, node_path)
+        return node_path
+
+    def visit_tree_node(self, node: TreeNode, level=0, parent_path='\\'):
+        """ Serialises a TreeNode entity and its descendants to a TSV file,
+        in depth-first order.
+
+        The tree is traversed with an explicit stack of child iterators,
+        so the depth of the tree is not limited by the recursion limit and
+        the stack takes memory proportional to the depth.
+        Node paths are interned, so equal paths share one string.
+
+        :param node: the TreeNode entity
+        :param level: the hierarchy level of the node
+        :param parent_path: the path of the parent node.
+        """
+        node_path = self.write_node(node, level, parent_path)
+        if node_path is None:
             return
-        if node_path not in self.paths:
-            if len(node_path) > 900:
-                Console.warning("Path too long: " + node_path)
-            self.tree_nodes_writer.writerow(row)
-            self.paths.add(node_path)
-        for child in node.children:
-            self.visit_tree_node(child, level + 1, node_path)
+        stack = [(iter(node.children), level + 1, node_path)]
+        while stack:
+            children, child_level, path = stack[-1]
+            child = next(children, None)
+            if child is None:
+                stack.pop()
+                continue
+            child_path = self.write_node(child, child_level, path)
+            if child_path is not None and child.children:
+                stack.append(
+                    (iter(child.children), child_level + 1, child_path))
 
     def visit_node(self, node: TreeNode) -> None:
         self.visit_tree_node(node)
@@ -382,17 +773,17 @@ class TransmartCopyWriter(CollectionVisitor):
         ValueType.Text: 'B'
     }
 
-    def write_observation(self,
-                          observation: Observation,
-                          value: Value,
-                          modifier: Modifier = None) -> None:
-        trial_visit_id = (observation.trial_visit.study.study_id,
-                          observation.trial_visit.rel_time_label)
-        visit_index = None
-        if observation.visit:
-            visit_index = self.visits[observation.visit.identifier]
-        if visit_index is None:
-            visit_index = -1
+    def encode_value(self, value: Value) -> EncodedValue:
+        """ Encodes a value to the value type code, text value,
+        number value and blob value columns of an observation.
+        The columns of interned values are cached.
+
+        :param value: the value
+        :return: the encoded value columns
+        """
+        encoded_value = self.encoded_values.get(value)
+        if encoded_value is not None:
+            return encoded_value
         text_value = None
         number_value = None
         blob_value = None
@@ -412,21 +803,58 @@ class TransmartCopyWriter(CollectionVisitor):
         else:
             raise LoaderException(
                 'Value type not supported: {}'.format(value.value_type))
+        encoded_value = (TransmartCopyWriter.value_type_codes[value_type],
+                         text_value,
+                         number_value,
+                         blob_value)
+        if is_interned(value):
+            self.encoded_values[value] = encoded_value
+        return encoded_value
 
-        row = [visit_index,
-               self.patients[observation.patient.identifier],
-               observation.concept.concept_code,
-               '@',
-               format_date(observation.start_date),
-               format_date(observation.end_date),
-               modifier.modifier_code if modifier else '@',
-               self.instance_num,
-               self.trial_visits[trial_visit_id],
-               TransmartCopyWriter.value_type_codes[value_type],
-               text_value,
-               number_value,
-               blob_value]
-        self.observations_writer.writerow(row)
+    def write_observation(self,
+                          observation: Observation,
+                          value: Value,
+                          modifier: Modifier = None) -> None:
+        self.observations_writer.writerow(self.observation_row(
+            observation, value, modifier, self.instance_num))
+
+    def observation_row(self,
+                        observation: Observation,
+                        value: Value,
+                        modifier: Optional[Modifier],
+                        instance_num: int) -> List[Any]:
+        """ Encodes an observation value to an observation_fact row,
+        with the identifiers of the patient, visit and trial visit.
+
+        :param observation: the observation.
+        :param value: the value of the observation or of a modifier.
+        :param modifier: the modifier of the value, if any.
+        :param instance_num: the instance number of the observation.
+        :return: the row.
+        """
+        trial_visit_id = (observation.trial_visit.study.study_id,
+                          observation.trial_visit.rel_time_label)
+        visit_index = None
+        if observation.visit:
+            visit_index = self.visits[observation.visit.identifier]
+        if visit_index is None:
+            visit_index = -1
+        value_type_code, text_value, number_value, blob_value = \
+            self.encode_value(value)
+
+        return [visit_index,
+                self.patients[observation.patient.identifier],
+                observation.concept.concept_code,
+                '@',
+                format_date(observation.start_date),
+                format_date(observation.end_date),
+                modifier.modifier_code if modifier else '@',
+                instance_num,
+                self.trial_visits[trial_visit_id],
+                value_type_code,
+                text_value,
+                number_value,
+                blob_value]
 
     def visit_observation(self, observation: Observation) -> None:
         """ Serialises an Observation entity to a TSV file.
@@ -439,6 +867,145 @@ class TransmartCopyWriter(CollectionVisitor):
                 self.write_observation(observation, value, modifier)
         self.instance_num = self.instance_num + 1
 
+    def visit_observations(self, observations: Iterable[Observation]) -> None:
+        if self.workers > 1:
+            if isinstance(observations, abc.Sequence) \
+                    and 'fork' in multiprocessing.get_all_start_methods():
+                self.write_observation_shards(observations)
+                return
+            if not self.serial_warning_shown:
+                self.serial_warning_shown = True
+                Console.warning(
+                    'Observations are written by a single process, '
+                    'parallel writing requires a sequence of observations '
+                    'and the fork start method')
+        super().visit_observations(observations)
+
+    def write_observation_shards(self,
+                                 observations: Sequence[Observation]) -> None:
+        """ Writes observations in parallel, using a pool of worker processes.
+        The dimension tables have been written already when the observations
+        are visited. The workers are forked, such that they inherit the
+        observations, and are sent ranges of observation indexes. Sending
+        the observations themselves to the workers, which requires pickling
+        them, takes longer than writing them. The workers use a copy of the
+        identifier maps.
+
+        :param observations: the observations.
+        """
+        global shard_observations
+        shard_dir = tempfile.mkdtemp(prefix='shards', dir=self.output_dir)
+        pending: Deque[Any] = deque()
+        shard_observations = observations
+        try:
+            context = multiprocessing.get_context('fork')
+            with context.Pool(self.workers,
+                              initializer=init_shard_writer,
+                              initargs=(pickle.dumps(self),)) as pool:
+                for index, start in enumerate(
+                        range(0, len(observations), self.shard_size)):
+                    stop = min(start + self.shard_size, len(observations))
+                    shard_path = path.join(shard_dir, '{}.tsv'.format(index))
+                    pending.append(pool.apply_async(
+                        write_observation_shard,
+                        (shard_path, self.instance_num, start, stop)))
+                    self.instance_num = self.instance_num + stop - start
+                    if len(pending) >= 2 * self.workers:
+                        self.append_observation_shard(pending.popleft().get())
+                while pending:
+                    self.append_observation_shard(pending.popleft().get())
+        finally:
+            shard_observations = None
+            shutil.rmtree(shard_dir)
+
+    def append_observation_shard(self, shard_path: str) -> None:
+        with open(shard_path, newline='') as shard:
+            if isinstance(self.observations_writer,
+                          (PgBinaryWriter, SortingWriter, DuplicateFilter)):
+                # Binary, sorting and filtering writers parse the
+                # tab-separated rows, which requires complete rows
+                self.observations_writer.write(shard.read())
+            else:
+                shutil.copyfileobj(shard, self.observations_writer)
+        os.remove(shard_path)
+
+    def __getstate__(self) -> Dict[str, Any]:
+        """ Only the identifier maps needed for writing observations
+        are copied to the observation shard worker processes.
+        """
+        return {
+            'output_dir': self.output_dir,
+            'patients': self.patients,
+            'visits': self.visits,
+            'trial_visits': self.trial_visits,
+            'encoded_values': {}
+        }
+
+    def visit_observation_batch(self, batch: ObservationBatch) -> None:
+        """ Serialises a batch of observations to a TSV file.
+
+        The identifiers of the patients, concepts, trial visits and visits
+        are looked up once per batch. The indexes, instance numbers, value
+        types, numbers and dates are formatted with numpy array operations.
+        Text values are formatted per value with format_field and the rows
+        are joined with str.join: numpy string operations on variable-width
+        strings were about twice as slow for these columns.
+
+        :param batch: the ObservationBatch
+        """
+        size = len(batch)
+        if size == 0:
+            return
+        value_types = batch.value_type
+        value_type_codes = np.full(max(t.value for t in ValueType) + 1, '')
+        for value_type, code in TransmartCopyWriter.value_type_codes.items():
+            value_type_codes[value_type.value] = code
+        supported = (value_types > 0) & (value_types < len(value_type_codes))
+        if not supported.all():
+            raise LoaderException('Value type not supported: {}'.format(
+                value_types[~supported][0]))
+
+        visit_nums = np.array(
+            [self.visits[visit.identifier] for visit in batch.visits] + [-1])
+        patient_nums = np.array(
+            [self.patients[patient.identifier] for patient in batch.patients],
+            dtype=np.int64)
+        concept_codes = quote_strings(
+            [concept.concept_code for concept in batch.concepts])
+        trial_visit_nums = np.array(
+            [self.trial_visits[(trial_visit.study.study_id,
+                                trial_visit.rel_time_label)]
+             for trial_visit in batch.trial_visits], dtype=np.int64)
+
+        is_date = value_types == ValueType.Date.value
+        is_number = is_date | (value_types == ValueType.Numeric.value)
+        numbers = np.where(is_date,
+                           np.floor(batch.numeric_value / 1000000) * 1000,
+                           batch.numeric_value)
+        number_values = numbers.astype(str)
+        number_values[~is_number | np.isnan(numbers)] = ''
+        texts = quote_strings(batch.text_value)
+        text_values = np.where(
+            value_types == ValueType.Categorical.value, texts, '')
+        blob_values = np.where(value_types == ValueType.Text.value, texts, '')
+
+        columns = [
+            visit_nums[batch.visit_index].astype(str),
+            patient_nums[batch.patient_index].astype(str),
+            concept_codes[batch.concept_index],
+            np.full(size, '@'),
+            format_date_array(batch.start_date),
+            format_date_array(batch.end_date),
+            np.full(size, '@'),
+            np.arange(self.instance_num, self.instance_num + size).astype(str),
+            trial_visit_nums[batch.trial_visit_index].astype(str),
+            value_type_codes[value_types],
+            text_values,
+            number_values,
+            blob_values]
+        self.observations_writer.write(join_columns(columns))
+        self.instance_num = self.instance_num + size
+
     def visit_relation_type(self, relation_type: RelationType) -> None:
         """ Serialises a relation type to a TSV file.
 
@@ -502,14 +1069,105 @@ class TransmartCopyWriter(CollectionVisitor):
         for dimension in default_dimensions:
             self.visit_dimension(dimension)
 
-    def write_collection(self, collection: DataCollection) -> None:
-        CollectionValidator.validate(collection)
-        self.write_default_dimensions()
-        self.visit(collection)
+    def write_collection(self,
+                         collection: DataCollection,
+                         streaming: bool = False) -> None:
+        """ Validates the collection and writes it to the output directory.
+
+        By default, the collection is validated completely before
+        anything is written, which requires the collection fields to be
+        iterated twice. In streaming mode, every entity is validated just
+        before it is written, so that each field is iterated only once.
+        This allows passing generators instead of lists, e.g., for
+        observations. Entities that refer to missing entities are skipped
+        and validation errors are raised after the collection has been
+        written. When resuming from a checkpoint, the entities that were
+        written before the checkpoint are validated as well, to index them.
+
+        :param collection: the collection to write.
+        :param streaming: whether to validate and write in a single pass.
+        """
+        if streaming:
+            validator = CollectionValidator(self.identifier_store)
+            self.write_default_dimensions()
+            try:
+                self.visit(self.tracked(collection, validator))
+            finally:
+                validator.close()
+            validator.report()
+        else:
+            CollectionValidator.validate(collection, self.identifier_store)
+            self.write_default_dimensions()
+            self.visit(self.tracked(collection))
+        if self.progress is not None:
+            self.progress.report()
+        self.completed = True
+
+    def tracked(self, collection: DataCollection,
+                validator: Optional[CollectionValidator] = None
+                ) -> DataCollection:
+        if self.progress is not None:
+            collection = self.progress.tracked(collection)
+        if validator is not None:
+            collection = validator.validated(collection)
+        if self.checkpoints is not None:
+            collection = self.checkpoints.tracked(collection)
+        return collection
+
+    def save_checkpoint(self, positions: Dict[str, int]) -> None:
+        """ Writes the buffered rows to the output files and saves
+        a checkpoint. The checkpoint file is replaced atomically.
+
+        :param positions: the number of entities written per collection field.
+        """
+        checkpoint = {
+            'positions': positions,
+            'sizes': {path.relpath(writer.path, self.output_dir): writer.sync()
+                      for writer in self.writers},
+            'instance_num': self.instance_num,
+            'maps': {name: getattr(self, name)
+                     for name in self.checkpoint_maps}
+        }
+        checkpoint_path = path.join(self.output_dir, self.checkpoint_file)
+        with open(checkpoint_path + '.tmp', 'wb') as checkpoint_file:
+            pickle.dump(checkpoint, checkpoint_file, pickle.HIGHEST_PROTOCOL)
+        os.replace(checkpoint_path + '.tmp', checkpoint_path)
+
+    def restore_checkpoint(self) -> Dict[str, int]:
+        """ Restores the identifier maps and instance number from the
+        checkpoint and truncates the output files to the checkpoint sizes.
+
+        :return: the number of entities written per collection field.
+        """
+        checkpoint_path = path.join(self.output_dir, self.checkpoint_file)
+        if not path.exists(checkpoint_path):
+            raise LoaderException(
+                'No checkpoint found in {}'.format(self.output_dir))
+        with open(checkpoint_path, 'rb') as checkpoint_file:
+            checkpoint = pickle.load(checkpoint_file)
+        for file_name, size in checkpoint['sizes'].items():
+            file_path = path.join(self.output_dir, file_name)
+            if not path.exists(file_path) or path.getsize(file_path) < size:
+                raise LoaderException(
+                    'Output file does not match checkpoint: {}'.format(
+                        file_path))
+            os.truncate(file_path, size)
+        for name, values in checkpoint['maps'].items():
+            setattr(self, name, values)
+        self.instance_num = checkpoint['instance_num']
+        return checkpoint['positions']
+
+    def bytes_written(self) -> int:
+        """ Returns the size of the output files. Buffered data
+        is not included.
+        """
+        return sum(path.getsize(writer.path) for writer in self.writers
+                   if writer.path is not None and path.isfile(writer.path))
 
     def prepare_output_dir(self) -> None:
         """ Creates an output directory if it does not exist.
-        Fails if the output directory exists and is not empty.
+        Fails if the output directory exists and is not empty,
+        unless in append or resume mode.
         """
         output_dir = self.output_dir
         if not path.exists(output_dir):
@@ -518,65 +1176,259 @@ class TransmartCopyWriter(CollectionVisitor):
         if not path.isdir(output_dir):
             raise LoaderException(
                 'Path is not a directory: {}'.format(output_dir))
+        if self.append or self.resume:
+            os.makedirs(output_dir + '/i2b2metadata', exist_ok=True)
+            os.makedirs(output_dir + '/i2b2demodata', exist_ok=True)
+            return
         if os.listdir(output_dir):
             raise LoaderException(
                 'Directory is not empty: {}'.format(output_dir))
         os.mkdir(output_dir + '/i2b2metadata')
         os.mkdir(output_dir + '/i2b2demodata')
 
+    def table_file(self, table: str) -> Tuple[str, Optional[Compression]]:
+        """ Returns the path of the file of a table, without compression
+        extension, and the compression settings for the table.
+        Requires a file sink.
+        """
+        return self.sink.table_file(table)
+
+    def read_table(self,
+                   table: str,
+                   header: List[str]) -> Iterator[List[str]]:
+        """ Reads the rows of an existing table file, if it exists.
+
+        :param table: the schema and table name.
+        :param header: the expected column names.
+        :return: the rows, without the header.
+        """
+        file_path, compression = self.table_file(table)
+        if compression is not None:
+            file_path = file_path + compression.extension
+        if not path.exists(file_path):
+            return
+        with open_compressed(file_path, compression) as table_file:
+            reader = csv.reader(table_file, dialect='excel-tab')
+            file_header = next(reader, None)
+            if file_header is None:
+                return
+            if file_header != header:
+                raise LoaderException(
+                    'Unexpected header in {}: {}'.format(file_path,
+                                                         file_header))
+            yield from reader
+
+    def restore_state(self) -> None:
+        """ Restores the identifier maps and the instance number
+        from the files in the output directory.
+        """
+        for row in self.read_table('i2b2demodata/concept_dimension',
+                                   self.concepts_header):
+            self.concepts.add(row[0])
+        for row in self.read_table('i2b2demodata/modifier_dimension',
+                                   self.modifiers_header):
+            self.modifiers.add(row[0])
+        study_ids: Dict[str, str] = {}
+        for row in self.read_table('i2b2demodata/study',
+                                   self.studies_header):
+            self.studies[row[1]] = int(row[0])
+            study_ids[row[0]] = row[1]
+        for row in self.read_table('i2b2metadata/dimension_description',
+                                   self.dimensions_header):
+            self.dimensions[row[1]] = int(row[0])
+        for row in self.read_table('i2b2demodata/trial_visit_dimension',
+                                   self.trial_visits_header):
+            self.trial_visits[(study_ids[row[1]], row[4])] = int(row[0])
+        for row in self.read_table('i2b2demodata/patient_mapping',
+                                   self.patient_mappings_header):
+            if row[1] == 'SUBJ_ID':
+                self.patients[row[0]] = int(row[2])
+        for row in self.read_table('i2b2demodata/encounter_mapping',
+                                   self.encounter_mappings_header):
+            if row[1] == 'VISIT_ID':
+                self.visits[row[0]] = int(row[2])
+        for row in self.read_table('i2b2metadata/i2b2_secure',
+                                   self.tree_nodes_header):
+            self.paths.add(row[1])
+        for row in self.read_table('i2b2metadata/i2b2_tags',
+                                   self.tree_node_tags_header):
+            self.tags.add((row[1], row[3]))
+        for row in self.read_table('i2b2demodata/relation_types',
+                                   self.relation_types_header):
+            self.relation_types[row[1]] = int(row[0])
+        for row in self.read_table('i2b2demodata/observation_fact',
+                                   self.observations_header):
+            self.instance_num = max(self.instance_num, int(row[7]) + 1)
+
+    def get_column_types(self, table: str,
+                         header: List[str]) -> List[PgType]:
+        """ Returns the types of the columns of a table in binary output.
+        """
+        table_types = self.table_column_types.get(table, {})
+        return [table_types.get(column,
+                                self.column_types.get(column, PgType.Text))
+                for column in header]
+
+    def create_writer(self, table: str, header: List[str],
+                      sort_key: Optional[SortKey] = None) -> CsvWriter:
+        """ Creates the writer for a table in the sink, which writes
+        the header. In append mode, an existing file is opened for appending
+        instead. In binary output, the header is the PGCOPY signature and
+        the column types are derived from the column names.
+
+        :param table: the schema and table name, e.g.,
+                      'i2b2demodata/observation_fact'.
+        :param header: the column names.
+        :param sort_key: if specified, the rows are sorted by this key
+                         before they are written.
+        :return: the writer for the table.
+        """
+        if self.tables is not None and table not in self.tables:
+            return ExcludedTableWriter(table)
+        writer = self.sink.create_writer(
+            table, header, self.get_column_types(table, header))
+        if self.metrics is not None:
+            self.metrics.instrument_writer(table, writer)
+        if sort_key is not None:
+            writer = SortingWriter(writer, sort_key, self.sort_memory,
+                                   self.output_dir)
+        self.writers.append(writer)
+        return writer
+
+    def close(self) -> None:
+        """ Closes the output files. Compressed output files are only
+        complete after they have been closed. All files are closed
+        before an error writing one of them is raised. The sink is told
+        whether the collection has been written completely, e.g.,
+        a PostgresSink only commits the tables of a complete collection.
+        """
+        error: Optional[Exception] = None
+        for writer in self.writers:
+            try:
+                writer.close()
+            except Exception as e:
+                error = error or e
+        try:
+            self.sink.close(self.completed and error is None)
+        except Exception as e:
+            error = error or e
+        for identifiers in [self.patients, self.visits, self.concepts,
+                            self.modifiers, self.paths, self.tags]:
+            if hasattr(identifiers, 'close'):
+                identifiers.close()
+        checkpoint_path = path.join(self.output_dir, self.checkpoint_file)
+        if self.completed and path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
+        if error is not None:
+            raise error
+
     def init_writers(self) -> None:
         """ Creates files and initialises writers for the output files
         in transmart-copy format.
         """
-        self.concepts_writer = TsvWriter(
-            self.output_dir + '/i2b2demodata/concept_dimension.tsv')
-        self.concepts_writer.writerow(self.concepts_header)
-        self.modifiers_writer = TsvWriter(
-            self.output_dir + '/i2b2demodata/modifier_dimension.tsv')
-        self.modifiers_writer.writerow(self.modifiers_header)
-        self.studies_writer = TsvWriter(
-            self.output_dir + '/i2b2demodata/study.tsv')
-        self.studies_writer.writerow(self.studies_header)
-        self.dimensions_writer = TsvWriter(
-            self.output_dir + '/i2b2metadata/dimension_description.tsv')
-        self.dimensions_writer.writerow(self.dimensions_header)
-        self.study_dimensions_writer = TsvWriter(
-            self.output_dir + '/i2b2metadata/study_dimension_descriptions.tsv')
-        self.study_dimensions_writer.writerow(self.study_dimensions_header)
-        self.trial_visits_writer = TsvWriter(
-            self.output_dir + '/i2b2demodata/trial_visit_dimension.tsv')
-        self.trial_visits_writer.writerow(self.trial_visits_header)
-        self.patient_mappings_writer = TsvWriter(
-            self.output_dir + '/i2b2demodata/patient_mapping.tsv')
-        self.patient_mappings_writer.writerow(self.patient_mappings_header)
-        self.patients_writer = TsvWriter(
-            self.output_dir + '/i2b2demodata/patient_dimension.tsv')
-        self.patients_writer.writerow(self.patients_header)
-        self.encounter_mappings_writer = TsvWriter(
-            self.output_dir + '/i2b2demodata/encounter_mapping.tsv')
-        self.encounter_mappings_writer.writerow(self.encounter_mappings_header)
-        self.visits_writer = TsvWriter(
-            self.output_dir + '/i2b2demodata/visit_dimension.tsv')
-        self.visits_writer.writerow(self.visits_header)
-        self.tree_nodes_writer = TsvWriter(
-            self.output_dir + '/i2b2metadata/i2b2_secure.tsv')
-        self.tree_nodes_writer.writerow(self.tree_nodes_header)
-        self.tree_node_tags_writer = TsvWriter(
-            self.output_dir + '/i2b2metadata/i2b2_tags.tsv')
-        self.tree_node_tags_writer.writerow(self.tree_node_tags_header)
-        self.observations_writer = TsvWriter(
-            self.output_dir + '/i2b2demodata/observation_fact.tsv')
-        self.observations_writer.writerow(self.observations_header)
-        self.relation_types_writer = TsvWriter(
-            self.output_dir + '/i2b2demodata/relation_types.tsv')
-        self.relation_types_writer.writerow(self.relation_types_header)
-        self.relations_writer = TsvWriter(
-            self.output_dir + '/i2b2demodata/relations.tsv')
-        self.relations_writer.writerow(self.relations_header)
-
-    def __init__(self, output_dir: str):
+        self.concepts_writer = self.create_writer(
+            'i2b2demodata/concept_dimension', self.concepts_header)
+        self.modifiers_writer = self.create_writer(
+            'i2b2demodata/modifier_dimension', self.modifiers_header)
+        self.studies_writer = self.create_writer(
+            'i2b2demodata/study', self.studies_header)
+        self.dimensions_writer = self.create_writer(
+            'i2b2metadata/dimension_description', self.dimensions_header)
+        self.study_dimensions_writer = self.create_writer(
+            'i2b2metadata/study_dimension_descriptions',
+            self.study_dimensions_header)
+        self.trial_visits_writer = self.create_writer(
+            'i2b2demodata/trial_visit_dimension', self.trial_visits_header)
+        self.patient_mappings_writer = self.create_writer(
+            'i2b2demodata/patient_mapping', self.patient_mappings_header)
+        self.patients_writer = self.create_writer(
+            'i2b2demodata/patient_dimension', self.patients_header)
+        self.encounter_mappings_writer = self.create_writer(
+            'i2b2demodata/encounter_mapping', self.encounter_mappings_header)
+        self.visits_writer = self.create_writer(
+            'i2b2demodata/visit_dimension', self.visits_header)
+        self.tree_nodes_writer = self.create_writer(
+            'i2b2metadata/i2b2_secure', self.tree_nodes_header)
+        self.tree_node_tags_writer = self.create_writer(
+            'i2b2metadata/i2b2_tags', self.tree_node_tags_header)
+        self.observations_writer = self.create_writer(
+            'i2b2demodata/observation_fact', self.observations_header,
+            observation_sort_key if self.sort_observations else None)
+        if self.duplicate_mode is not None and not isinstance(
+                self.observations_writer, ExcludedTableWriter):
+            # The filter is closed instead of the writer it wraps
+            index = self.writers.index(self.observations_writer)
+            self.observations_writer = self.writers[index] = DuplicateFilter(
+                self.observations_writer, self.duplicate_mode,
+                self.duplicate_memory, self.output_dir)
+        self.relation_types_writer = self.create_writer(
+            'i2b2demodata/relation_types', self.relation_types_header)
+        self.relations_writer = self.create_writer(
+            'i2b2demodata/relations', self.relations_header)
+
+    def __init__(self,
+                 output_dir: str,
+                 workers: int = 1,
+                 shard_size: int = 100000,
+                 compression: Optional[Compression] = None,
+                 table_compression: Optional[
+                     Dict[str, Optional[Compression]]] = None,
+                 metrics: Optional[Metrics] = None,
+                 progress: Optional[ProgressReporter] = None,
+                 append: bool = False,
+                 checkpoint_interval: Optional[float] = None,
+                 resume: bool = False,
+                 identifier_store: Optional[IdentifierStore] = None,
+                 threaded: bool = False,
+                 output_format: OutputFormat = OutputFormat.Tsv,
+                 sink: Optional[Sink] = None,
+                 sort_observations: bool = False,
+                 sort_memory: int = 1 << 28,
+                 duplicates: Optional[DuplicateMode] = None,
+                 duplicate_memory: int = 1 << 28,
+                 tables: Optional[Collection[str]] = None):
         self.output_dir = output_dir
+        self.workers = workers
+        self.shard_size = shard_size
+        self.serial_warning_shown = False
+        self.metrics = metrics
+        self.progress = progress
+        self.append = append
+        self.resume = resume
+        self.sink = sink or FileSink(output_dir, output_format, compression,
+                                     table_compression, threaded,
+                                     append or resume)
+        self.completed = False
+        if (append or resume or checkpoint_interval is not None) \
+                and not self.sink.persistent:
+            raise LoaderException(
+                'Append mode and checkpoints require a file sink')
+        if append and self.sink.output_format is not OutputFormat.Tsv:
+            raise LoaderException(
+                'Append mode requires tab-separated output')
+        if checkpoint_interval is not None and workers > 1:
+            raise LoaderException(
+                'Checkpoints are not supported with multiple workers')
+        if resume and checkpoint_interval is None:
+            raise LoaderException('Resuming requires a checkpoint interval')
+        if sort_observations \
+                and (append or resume or checkpoint_interval is not None):
+            raise LoaderException(
+                'Sorted output does not support append mode or checkpoints')
+        if duplicates is not None \
+                and (resume or checkpoint_interval is not None):
+            raise LoaderException(
+                'Duplicate detection does not support checkpoints')
+        self.sort_observations = sort_observations
+        self.sort_memory = sort_memory
+        self.duplicate_mode = duplicates
+        self.duplicate_memory = duplicate_memory
+        self.tables = tables
+        self.identifier_store = identifier_store
+        if progress is not None:
+            progress.bytes_written = self.bytes_written
         self.prepare_output_dir()
+        self.writers: List[CsvWriter] = []
         self.concepts_writer: Optional[TsvWriter] = None
         self.modifiers_writer: Optional[TsvWriter] = None
         self.studies_writer: Optional[TsvWriter] = None
@@ -592,17 +1444,44 @@ class TransmartCopyWriter(CollectionVisitor):
         self.observations_writer: Optional[TsvWriter] = None
         self.relation_types_writer: Optional[TsvWriter] = None
         self.relations_writer: Optional[TsvWriter] = None
-        self.init_writers()
 
-        self.concepts: Set[str] = set()
-        self.modifiers: Set[str] = set()
+        self.concepts: MutableSet[str] = set()
+        self.modifiers: MutableSet[str] = set()
         self.dimensions: Dict[str, int] = {}
         self.studies: Dict[str, int] = {}
         self.trial_visits: Dict[Tuple[str, str], int] = {}
-        self.patients: Dict[str, int] = {}
+        self.patients: MutableMapping[str, int] = {}
         self.relation_types: Dict[str, int] = {}
-        self.visits: Dict[str, int] = {}
-        self.paths: Set[str] = set()
-        self.tags: Set[TagKey] = set()
+        self.visits: MutableMapping[str, int] = {}
+        self.paths: MutableSet[str] = set()
+        self.tags: MutableSet[Tuple[str, str]] = set()
+        self.encoded_values: Dict[Value, EncodedValue] = {}
 
         self.instance_num = 0
+        self.first_tag_id = 0
+        positions: Dict[str, int] = {}
+        if resume:
+            positions = self.restore_checkpoint()
+        else:
+            store = identifier_store or IdentifierStore()
+            self.patients = store.create_map('patients')
+            self.visits = store.create_map('visits')
+            self.concepts = store.create_set('concepts')
+            self.modifiers = store.create_set('modifiers')
+            self.paths = store.create_set('paths')
+            self.tags = store.create_set('tags')
+            if append:
+                self.restore_state()
+        self.init_writers()
+        self.checkpoints: Optional[CheckpointTracker] = None
+        if checkpoint_interval is not None:
+            self.checkpoints = CheckpointTracker(
+                self.save_checkpoint, checkpoint_interval, positions=positions)
+
+        if metrics is not None:
+            for method, dedup_map in self.instrumented_methods.items():
+                metrics.instrument_method(self, method, dedup_map)
+            metrics.instrument_cache('to_utc', to_utc)
+            metrics.instrument_cache('format_date', format_date)
+            metrics.instrument_cache('wall_clock_timestamp',
+                                     wall_clock_timestamp)
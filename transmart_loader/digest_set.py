@@ -0,0 +1,121 @@
+from hashlib import blake2b
+from typing import Union, Tuple, Optional, MutableSet
+
+from transmart_loader.loader_exception import LoaderException
+
+Key = Union[str, Tuple[str, ...]]
+
+digest_size = 16
+"""
+The size of the digests in bytes (128 bits).
+"""
+
+empty_slot = bytes(digest_size)
+
+
+def digest(key: Key) -> bytes:
+    """ Computes the 128-bit BLAKE2b digest of a string or a tuple
+    of strings. The all-zero digest is reserved for empty slots.
+    """
+    if not isinstance(key, str):
+        key = '\x1f'.join(key)
+    value = blake2b(key.encode('utf-8'), digest_size=digest_size).digest()
+    if value == empty_slot:
+        return bytes(digest_size - 1) + b'\x01'
+    return value
+
+
+class DigestSet:
+    """
+    Set of strings that stores only 128-bit digests of the strings,
+    in an open-addressing hash table with linear probing in a bytearray.
+    An entry takes 16 bytes and the table is resized when it is half full,
+    so the set takes 32 to 64 bytes per entry, independent of the length
+    of the strings.
+
+    The set cannot be iterated and entries cannot be removed.
+
+    Different strings with the same digest are considered equal. For n
+    strings, the probability that any two of them have the same digest is
+    at most n * (n - 1) / 2 ** 129, e.g., less than 1e-20 for a billion
+    strings. If a verification set is specified, the strings are also added
+    to that set (e.g., a SqliteKeySet on disk) and a matching digest is only
+    accepted if the string is in the verification set, which makes the set
+    exact at the cost of a lookup per match.
+    """
+    def __contains__(self, key: Key) -> bool:
+        _, found = self.find(digest(key))
+        if found and self.verification is not None:
+            return key in self.verification
+        return found
+
+    def add(self, key: Key) -> None:
+        key_digest = digest(key)
+        index, found = self.find(key_digest)
+        if found:
+            if self.verification is None or key in self.verification:
+                return
+            # A different string with the same digest
+            self.collisions = self.collisions + 1
+        else:
+            offset = index * digest_size
+            self.table[offset:offset + digest_size] = key_digest
+            self.used = self.used + 1
+            if self.used * 2 > self.capacity:
+                self.resize(self.capacity * 2)
+        if self.verification is not None:
+            self.verification.add(key)
+        self.size = self.size + 1
+
+    def find(self, key_digest: bytes) -> Tuple[int, bool]:
+        """ Finds the slot of a digest.
+
+        :return: the slot index, and whether the slot contains the digest
+                 or is the empty slot where the digest can be stored.
+        """
+        mask = self.capacity - 1
+        index = int.from_bytes(key_digest[:8], 'little') & mask
+        table = self.table
+        while True:
+            offset = index * digest_size
+            slot = table[offset:offset + digest_size]
+            if slot == key_digest:
+                return index, True
+            if slot == empty_slot:
+                return index, False
+            index = (index + 1) & mask
+
+    def resize(self, capacity: int) -> None:
+        table = self.table
+        self.capacity = capacity
+        self.table = bytearray(capacity * digest_size)
+        for offset in range(0, len(table), digest_size):
+            key_digest = bytes(table[offset:offset + digest_size])
+            if key_digest != empty_slot:
+                index, _ = self.find(key_digest)
+                self.table[index * digest_size:
+                           (index + 1) * digest_size] = key_digest
+
+    def __len__(self) -> int:
+        return self.size
+
+    def close(self) -> None:
+        if hasattr(self.verification, 'close'):
+            self.verification.close()
+
+    def __init__(self,
+                 capacity: int = 1024,
+                 verification: Optional[MutableSet[Key]] = None):
+        """
+        :param capacity: the initial number of slots, a power of two.
+        :param verification: a set that stores the strings, used to verify
+                             matching digests.
+        """
+        if capacity < 2 or capacity & (capacity - 1):
+            raise LoaderException('Capacity must be a power of two')
+        self.capacity = capacity
+        self.table = bytearray(capacity * digest_size)
+        self.used = 0
+        self.size = 0
+        self.collisions = 0
+        self.verification = verification
@@ -0,0 +1,357 @@
+import csv
+import io
+import os
+import pickle
+import shutil
+import tempfile
+from array import array
+from collections import Counter
+from enum import Enum
+from typing import Sequence, Any, List, Iterable, Optional, Tuple, \
+    BinaryIO
+
+from transmart_loader.console import Console
+from transmart_loader.csv_types import CsvWriter
+from transmart_loader.digest_set import DigestSet, digest
+from transmart_loader.loader_exception import LoaderException
+from transmart_loader.row_encoder import format_field
+from transmart_loader.sorting_writer import read_run
+
+
+class DuplicateMode(Enum):
+    """
+    What to do with duplicate observations
+    """
+    Report = 'report'
+    Drop = 'drop'
+    Fail = 'fail'
+
+
+Row = Sequence[Any]
+
+
+observation_columns = [1, 2, 4, 8]
+"""
+The columns of observation_fact that identify an observation:
+patient_num, concept_cd, start_date and trial_visit_num.
+"""
+
+fact_columns = [6, 9, 10, 11, 12]
+"""
+The columns of the rows of an observation that are compared:
+modifier_cd, valtype_cd, tval_char, nval_num and observation_blob.
+"""
+
+instance_column = 7
+concept_column = 2
+
+
+def observation_key(rows: List[Row]) -> str:
+    """ Computes the key of an observation: the patient, concept, start date
+    and trial visit, and the modifier and value of each of its rows. Rows
+    that are written as values and as tab-separated text have the same key.
+
+    :param rows: the observation_fact rows of the observation.
+    :return: the key, formatted as tab-separated text.
+    """
+    fields = [rows[0][column] for column in observation_columns]
+    for row in rows:
+        fields.extend(row[column] for column in fact_columns)
+    return '\t'.join([format_field(value) for value in fields])
+
+
+class Buckets:
+    """
+    Hash partitions entries to bucket files, by a byte of the digest
+    of the entries. The entries are pickled in chunks.
+    """
+    chunk_size = 1000
+
+    def add(self, digest: bytes, value: Any) -> None:
+        index = digest[self.level] % len(self.chunks)
+        chunk = self.chunks[index]
+        chunk.append((digest, value))
+        self.counts[index] = self.counts[index] + 1
+        if len(chunk) >= self.chunk_size:
+            self.dump(index)
+
+    def dump(self, index: int) -> None:
+        file = self.files[index]
+        if file is None:
+            file = open(self.paths[index], 'wb')
+            self.files[index] = file
+        pickle.dump(self.chunks[index], file, pickle.HIGHEST_PROTOCOL)
+        self.chunks[index] = []
+
+    def close(self) -> List[Tuple[str, int]]:
+        """ Writes the remaining entries and closes the bucket files.
+
+        :return: the paths of the non-empty bucket files and the number of
+                 entries in each.
+        """
+        for index, chunk in enumerate(self.chunks):
+            if chunk:
+                self.dump(index)
+        for file in self.files:
+            if file is not None:
+                file.close()
+        return [(self.paths[index], count)
+                for index, count in enumerate(self.counts) if count > 0]
+
+    def __init__(self, prefix: str, level: int, count: int):
+        """
+        :param prefix: the path prefix of the bucket files.
+        :param level: the index of the digest byte used for partitioning.
+        :param count: the number of buckets.
+        """
+        self.level = level
+        self.paths = ['{}-{}'.format(prefix, index) for index in range(count)]
+        self.chunks: List[List[Tuple[bytes, Any]]] = [[] for _ in range(count)]
+        self.counts = [0] * count
+        self.files: List[Optional[BinaryIO]] = [None] * count
+
+
+class DuplicateFilter(CsvWriter):
+    """
+    Detects duplicate observations in the rows written to observation_fact:
+    observations with the same patient, concept, start date, trial visit,
+    modifiers and values, that differ only in instance number and visit.
+
+    The rows of an observation, which share an instance number and are
+    written consecutively, are grouped. Each observation is checked while
+    it is written, against a DigestSet with the keys of the observations
+    before it. Observations are written to the target writer in the order
+    in which they are written to the filter. In Drop mode, only the first
+    occurrence of an observation is written; in Fail mode, a
+    LoaderException is raised at the first duplicate.
+
+    When the digest set has reached the memory budget, it is no longer
+    extended. Later observations are still checked against it, and their
+    digests are partitioned by hash to bucket files on disk. When the
+    filter is closed, the bucket files are read one at a time and the
+    duplicates in each bucket are found with a set of digests. A bucket
+    with more entries than fit in the memory budget is partitioned again,
+    by the next byte of the digest, so that memory use is bounded by the
+    budget regardless of the number of observations. In Drop mode, these
+    observations are spooled to disk and written without the duplicates
+    from the buckets when the filter is closed, in their original order.
+    In Fail mode, duplicates in the buckets are raised when the filter is
+    closed.
+
+    Digests are 16 bytes, the probability of a false duplicate is
+    negligible. The number of duplicates per concept is reported when the
+    filter is closed.
+    """
+    buckets = 64
+    entry_size = 100
+    """
+    The estimated memory use of a digest in the set of digests of a bucket,
+    in bytes.
+    """
+    digest_entry_size = 64
+    """
+    The maximum memory use of a key in the DigestSet, in bytes.
+    """
+    max_reported = 20
+
+    def add_duplicate(self, rows: List[Row]) -> None:
+        concept_code = rows[0][concept_column]
+        self.duplicates[concept_code] += 1
+        if self.mode is DuplicateMode.Fail:
+            self.failed = True
+            raise LoaderException(
+                'Duplicate observation of concept {} of patient number {}'
+                .format(concept_code, rows[0][1]))
+
+    def add_observation(self, rows: List[Row]) -> None:
+        key = observation_key(rows)
+        if key in self.digests:
+            self.add_duplicate(rows)
+            if self.mode is DuplicateMode.Report:
+                self.writer.writerows(rows)
+        elif self.bucket_files is None:
+            self.digests.add(key)
+            if len(self.digests) * self.digest_entry_size >= self.memory:
+                self.start_spilling()
+            self.writer.writerows(rows)
+        elif self.mode is DuplicateMode.Drop:
+            self.bucket_files.add(
+                digest(key), (self.spooled, rows[0][concept_column]))
+            self.spool_observation(rows)
+        else:
+            self.bucket_files.add(digest(key), rows[0][concept_column])
+            self.writer.writerows(rows)
+
+    def writerow(self, row: Row) -> None:
+        if self.observation \
+                and row[instance_column] \
+                != self.observation[0][instance_column]:
+            observation = self.observation
+            self.observation = []
+            self.add_observation(observation)
+        self.observation.append(row)
+
+    def writerows(self, rows: Iterable[Row]) -> None:
+        for row in rows:
+            self.writerow(row)
+
+    def write(self, data: str) -> None:
+        """ Writes data that is formatted as tab-separated rows.
+        """
+        self.writerows(csv.reader(io.StringIO(data, newline=''),
+                                  dialect='excel-tab'))
+
+    def flush(self) -> None:
+        pass
+
+    def start_spilling(self) -> None:
+        """ Partitions the digests of the next observations to bucket
+        files, and in Drop mode spools the observations to disk.
+        """
+        self.bucket_dir = tempfile.mkdtemp(prefix='duplicates',
+                                           dir=self.temp_dir)
+        self.bucket_files = self.create_buckets(0)
+        if self.mode is DuplicateMode.Drop:
+            self.spool_path = os.path.join(self.bucket_dir, 'observations')
+            self.spool_file = open(self.spool_path, 'wb')
+
+    def spool_observation(self, rows: List[Row]) -> None:
+        self.spool_chunk.append(rows)
+        self.spooled = self.spooled + 1
+        if len(self.spool_chunk) >= Buckets.chunk_size:
+            self.dump_spool()
+
+    def dump_spool(self) -> None:
+        pickle.dump(self.spool_chunk, self.spool_file, pickle.HIGHEST_PROTOCOL)
+        self.spool_chunk = []
+
+    def create_buckets(self, level: int) -> Buckets:
+        self.bucket_count = self.bucket_count + 1
+        prefix = os.path.join(self.bucket_dir,
+                              'bucket{}'.format(self.bucket_count))
+        return Buckets(prefix, level, self.buckets)
+
+    def filter_bucket(self, bucket_path: str, count: int, level: int) -> None:
+        """ Counts the duplicates in a bucket file and, in Drop mode,
+        collects the spool positions of the duplicates. The first
+        occurrence of an observation comes first in the bucket file.
+        Partitions the bucket first if it does not fit in memory.
+        """
+        if count * self.entry_size > self.memory and level < 15:
+            buckets = self.create_buckets(level + 1)
+            for entry_digest, value in read_run(bucket_path):
+                buckets.add(entry_digest, value)
+            os.remove(bucket_path)
+            for sub_bucket_path, sub_count in buckets.close():
+                self.filter_bucket(sub_bucket_path, sub_count, level + 1)
+            return
+        digests = set()
+        for entry_digest, value in read_run(bucket_path):
+            if entry_digest in digests:
+                if self.mode is DuplicateMode.Drop:
+                    position, concept_code = value
+                    self.dropped.append(position)
+                else:
+                    concept_code = value
+                self.duplicates[concept_code] += 1
+            else:
+                digests.add(entry_digest)
+        os.remove(bucket_path)
+
+    def write_spool(self) -> None:
+        """ Writes the spooled observations, except the duplicates.
+        """
+        dropped = iter(sorted(self.dropped))
+        next_dropped = next(dropped, -1)
+        for position, rows in enumerate(read_run(self.spool_path)):
+            if position == next_dropped:
+                next_dropped = next(dropped, -1)
+            else:
+                self.writer.writerows(rows)
+
+    def report(self) -> None:
+        total = sum(self.duplicates.values())
+        if total == 0:
+            return
+        Console.warning('{} {} duplicate observations of {} concepts'.format(
+            'Dropped' if self.mode is DuplicateMode.Drop else 'Found',
+            total, len(self.duplicates)))
+        for concept_code, count in self.duplicates.most_common(
+                self.max_reported):
+            Console.info('  {}: {}'.format(concept_code, count))
+        if len(self.duplicates) > self.max_reported:
+            Console.info('  ... and {} more concepts'.format(
+                len(self.duplicates) - self.max_reported))
+
+    def close(self) -> None:
+        """ Finds the duplicates in the bucket files, writes the remaining
+        rows to the target writer and closes it.
+
+        :raises LoaderException: in Fail mode, if there are duplicates.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            if self.observation and not self.failed:
+                observation = self.observation
+                self.observation = []
+                self.add_observation(observation)
+            # Release the digests before the buckets are filtered
+            self.digests = DigestSet()
+            if self.bucket_files is not None and not self.failed:
+                if self.spool_file is not None:
+                    if self.spool_chunk:
+                        self.dump_spool()
+                    self.spool_file.close()
+                for bucket_path, count in self.bucket_files.close():
+                    self.filter_bucket(bucket_path, count, 0)
+                if self.spool_file is not None:
+                    self.write_spool()
+        finally:
+            if self.spool_file is not None:
+                self.spool_file.close()
+            if self.bucket_files is not None:
+                self.bucket_files.close()
+                shutil.rmtree(self.bucket_dir)
+            self.writer.close()
+        self.report()
+        if self.mode is DuplicateMode.Fail and self.duplicates \
+                and not self.failed:
+            raise LoaderException(
+                'Found {} duplicate observations'.format(
+                    sum(self.duplicates.values())))
+
+    @property
+    def path(self) -> Optional[str]:
+        return self.writer.path
+
+    def __init__(self,
+                 writer: CsvWriter,
+                 mode: DuplicateMode = DuplicateMode.Report,
+                 memory: int = 1 << 28,
+                 temp_dir: Optional[str] = None):
+        """
+        :param writer: the writer of the observation_fact rows.
+        :param mode: what to do with duplicate observations.
+        :param memory: the memory budget for the digests in bytes.
+        :param temp_dir: the directory for bucket files,
+                         by default the system temporary directory.
+        """
+        self.writer = writer
+        self.mode = mode
+        self.memory = memory
+        self.temp_dir = temp_dir
+        self.closed = False
+        self.failed = False
+        self.observation: List[Row] = []
+        self.duplicates: Counter = Counter()
+        self.digests = DigestSet()
+        self.bucket_dir: Optional[str] = None
+        self.bucket_count = 0
+        self.bucket_files: Optional[Buckets] = None
+        self.spool_path: Optional[str] = None
+        self.spool_file: Optional[BinaryIO] = None
+        self.spool_chunk: List[List[Row]] = []
+        self.spooled = 0
+        self.dropped = array('q')
@@ -0,0 +1,339 @@
+import os
+import sqlite3
+from collections import OrderedDict
+from typing import MutableMapping, Iterator, Dict, Any, MutableSet, \
+    Optional
+
+from transmart_loader.digest_set import DigestSet, Key
+from transmart_loader.loader_exception import LoaderException
+
+
+def remove_database(path: str) -> None:
+    for file_path in [path, path + '-wal', path + '-shm']:
+        if os.path.exists(file_path):
+            os.remove(file_path)
+
+
+def connect(path: str) -> sqlite3.Connection:
+    connection = sqlite3.connect(path, check_same_thread=False)
+    connection.execute('PRAGMA journal_mode = WAL')
+    connection.execute('PRAGMA synchronous = OFF')
+    return connection
+
+
+class IdentifierStore:
+    """
+    Creates the maps from entity identifiers to the numbers assigned by
+    the writer, for patients and visits, and the sets of identifiers
+    that have been written, for concepts, modifiers, ontology paths and tags.
+    The default store keeps the maps and sets in memory.
+    """
+    def create_map(self, name: str) -> MutableMapping[str, int]:
+        """ Creates a map from identifiers to numbers.
+
+        :param name: the name of the map, e.g., 'patients'.
+        :return: the map.
+        """
+        return {}
+
+    def create_set(self, name: str) -> MutableSet[Key]:
+        """ Creates a set of identifiers.
+
+        :param name: the name of the set, e.g., 'paths'.
+        :return: the set.
+        """
+        return set()
+
+
+class SqliteIdentifierMap(MutableMapping[str, int]):
+    """
+    Map from identifiers to sequential numbers, stored in an SQLite database.
+
+    Recently used entries are kept in an LRU cache of cache_size entries.
+    New entries are inserted in batches of batch_size entries. The memory
+    usage is bounded by the cache and batch sizes, independent of the number
+    of entries.
+
+    The numbers must be assigned sequentially, starting at 0, which allows
+    restoring the map to an earlier size: when a pickled map is restored,
+    the entries added after pickling are removed. Entries cannot be changed
+    or removed otherwise.
+    """
+    def __getitem__(self, identifier: str) -> int:
+        number = self.cache.get(identifier)
+        if number is not None:
+            self.cache.move_to_end(identifier)
+            return number
+        number = self.pending.get(identifier)
+        if number is None:
+            row = self.connection.execute(
+                'SELECT number FROM identifiers WHERE identifier = ?',
+                (identifier,)).fetchone()
+            if row is None:
+                raise KeyError(identifier)
+            number = row[0]
+        self.cache_entry(identifier, number)
+        return number
+
+    def __contains__(self, identifier: object) -> bool:
+        try:
+            self[identifier]
+        except KeyError:
+            return False
+        return True
+
+    def __setitem__(self, identifier: str, number: int) -> None:
+        if number != self.length:
+            raise LoaderException(
+                'Identifier numbers must be sequential: {} for {}'.format(
+                    number, identifier))
+        self.pending[identifier] = number
+        self.length = self.length + 1
+        self.cache_entry(identifier, number)
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def __delitem__(self, identifier: str) -> None:
+        raise LoaderException('Identifiers cannot be removed')
+
+    def __len__(self) -> int:
+        return self.length
+
+    def __iter__(self) -> Iterator[str]:
+        self.flush()
+        for row in self.connection.execute(
+                'SELECT identifier FROM identifiers ORDER BY number'):
+            yield row[0]
+
+    def cache_entry(self, identifier: str, number: int) -> None:
+        self.cache[identifier] = number
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def flush(self) -> None:
+        """ Inserts the pending entries into the database.
+        """
+        if self.pending:
+            with self.connection:
+                self.connection.executemany(
+                    'INSERT INTO identifiers (identifier, number) '
+                    'VALUES (?, ?)', self.pending.items())
+            self.pending = {}
+
+    def close(self) -> None:
+        self.flush()
+        self.connection.close()
+
+    def truncate(self, length: int) -> None:
+        """ Removes the entries with numbers from length onwards.
+        """
+        self.flush()
+        if length < self.length:
+            with self.connection:
+                self.connection.execute(
+                    'DELETE FROM identifiers WHERE number >= ?', (length,))
+            self.cache.clear()
+            self.length = length
+
+    def __getstate__(self) -> Dict[str, Any]:
+        self.flush()
+        return {
+            'path': self.path,
+            'cache_size': self.cache_size,
+            'batch_size': self.batch_size,
+            'length': self.length
+        }
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        self.__init__(state['path'], state['cache_size'], state['batch_size'])
+        self.truncate(state['length'])
+
+    def __init__(self,
+                 path: str,
+                 cache_size: int = 100000,
+                 batch_size: int = 10000):
+        """
+        :param path: the database file. Is created if it does not exist.
+        :param cache_size: the maximum number of cached entries.
+        :param batch_size: the number of entries inserted at once.
+        """
+        self.path = path
+        self.cache_size = cache_size
+        self.batch_size = batch_size
+        self.connection = connect(path)
+        with self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS identifiers ('
+                'number INTEGER PRIMARY KEY, '
+                'identifier TEXT NOT NULL UNIQUE)')
+        last = self.connection.execute(
+            'SELECT max(number) FROM identifiers').fetchone()[0]
+        self.length = 0 if last is None else last + 1
+        self.cache: 'OrderedDict[str, int]' = OrderedDict()
+        self.pending: Dict[str, int] = {}
+
+
+class SqliteIdentifierStore(IdentifierStore):
+    """
+    Stores the identifier maps and sets in SQLite databases in a directory,
+    for collections with more patients, visits, concepts or ontology nodes
+    than fit in memory. Existing databases are replaced when a map or set is
+    created. A map or set restored from a checkpoint reopens its database.
+    """
+    def create_map(self, name: str) -> MutableMapping[str, int]:
+        path = os.path.join(self.directory, name + '.sqlite')
+        remove_database(path)
+        return SqliteIdentifierMap(path, self.cache_size, self.batch_size)
+
+    def create_set(self, name: str) -> MutableSet[Key]:
+        path = os.path.join(self.directory, name + '.keys.sqlite')
+        remove_database(path)
+        return SqliteKeySet(path, self.batch_size)
+
+    def __init__(self,
+                 directory: str,
+                 cache_size: int = 100000,
+                 batch_size: int = 10000):
+        """
+        :param directory: the directory for the database files.
+        :param cache_size: the maximum number of cached entries per map.
+        :param batch_size: the number of entries inserted at once.
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.cache_size = cache_size
+        self.batch_size = batch_size
+
+
+def key_text(key: Key) -> str:
+    return key if isinstance(key, str) else '\x1f'.join(key)
+
+
+class SqliteKeySet(MutableSet[Key]):
+    """
+    Set of strings, or tuples of strings, stored in an SQLite database,
+    for sets with more identifiers than fit in memory, and to verify the
+    matches of a DigestSet. New keys are inserted in batches of batch_size
+    keys, in the order in which they are added. Tuples are stored as
+    strings, joined by the unit separator, and are iterated as such.
+
+    The keys are numbered in the order in which they are inserted, which
+    allows restoring the set to an earlier size: when a pickled set is
+    restored, the keys added after pickling are removed. Keys cannot be
+    removed otherwise.
+    """
+    def __contains__(self, key: object) -> bool:
+        text = key_text(key)
+        if text in self.pending:
+            return True
+        return self.connection.execute(
+            'SELECT 1 FROM keys WHERE key = ?', (text,)).fetchone() is not None
+
+    def add(self, key: Key) -> None:
+        self.pending[key_text(key)] = None
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def discard(self, key: Key) -> None:
+        raise LoaderException('Identifiers cannot be removed')
+
+    def __len__(self) -> int:
+        """ The number of keys. Keys that are added again before the
+        pending keys are inserted are counted twice until then.
+        """
+        return self.length + len(self.pending)
+
+    def __iter__(self) -> Iterator[str]:
+        self.flush()
+        for row in self.connection.execute(
+                'SELECT key FROM keys ORDER BY number'):
+            yield row[0]
+
+    def flush(self) -> None:
+        if self.pending:
+            changes = self.connection.total_changes
+            with self.connection:
+                self.connection.executemany(
+                    'INSERT OR IGNORE INTO keys (key) VALUES (?)',
+                    ((key,) for key in self.pending))
+            self.length = self.length + \
+                self.connection.total_changes - changes
+            self.pending = {}
+
+    def close(self) -> None:
+        self.flush()
+        self.connection.close()
+
+    def truncate(self, length: int) -> None:
+        """ Removes the keys inserted after the first length keys.
+        """
+        self.flush()
+        if length < self.length:
+            with self.connection:
+                self.connection.execute(
+                    'DELETE FROM keys WHERE number > ?', (length,))
+            self.length = length
+
+    def __getstate__(self) -> Dict[str, Any]:
+        self.flush()
+        return {'path': self.path, 'batch_size': self.batch_size,
+                'length': self.length}
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        self.__init__(state['path'], state['batch_size'])
+        self.truncate(state['length'])
+
+    def __init__(self, path: str, batch_size: int = 10000):
+        """
+        :param path: the database file. Is created if it does not exist.
+        :param batch_size: the number of keys inserted at once.
+        """
+        self.path = path
+        self.batch_size = batch_size
+        self.connection = connect(path)
+        with self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS keys ('
+                'number INTEGER PRIMARY KEY, '
+                'key TEXT NOT NULL UNIQUE)')
+        self.length = self.connection.execute(
+            'SELECT count(*) FROM keys').fetchone()[0]
+        # Keys in insertion order
+        self.pending: Dict[str, None] = {}
+
+
+class CompactIdentifierStore(IdentifierStore):
+    """
+    Stores the sets of identifiers as DigestSets, which store 128-bit
+    digests instead of the identifiers. This reduces the memory needed for
+    long identifiers, such as ontology paths, by an order of magnitude.
+    The maps are created by the maps store, in memory by default.
+
+    If a verification directory is specified, the identifiers are also
+    stored in SQLite databases in that directory, to verify matching
+    digests.
+    """
+    def create_map(self, name: str) -> MutableMapping[str, int]:
+        return self.maps.create_map(name)
+
+    def create_set(self, name: str) -> MutableSet[Key]:
+        verification = None
+        if self.verification_directory is not None:
+            path = os.path.join(self.verification_directory,
+                                name + '.keys.sqlite')
+            remove_database(path)
+            verification = SqliteKeySet(path)
+        return DigestSet(verification=verification)
+
+    def __init__(self,
+                 maps: Optional[IdentifierStore] = None,
+                 verification_directory: Optional[str] = None):
+        """
+        :param maps: the store for the identifier maps.
+        :param verification_directory: the directory for the databases
+                                       used to verify matching digests.
+        """
+        self.maps = maps or IdentifierStore()
+        if verification_directory is not None:
+            os.makedirs(verification_directory, exist_ok=True)
+        self.verification_directory = verification_directory
@@ -0,0 +1,219 @@
+import json
+import os
+from time import perf_counter
+from typing import Dict, Optional, Any, Callable, AnyStr, Tuple
+
+from transmart_loader.tsv_writer import TsvWriter
+
+
+def count_rows(data: str, quoted: bool) -> Tuple[int, bool]:
+    """ Counts the rows that end in tab-separated data, the way csv.reader
+    with the excel-tab dialect reads them: line breaks in quoted fields
+    do not end a row. Quotes in a quoted field are doubled, so every quote
+    character toggles between quoted and unquoted text.
+
+    :param data: the data, which may start or end within a row.
+    :param quoted: whether the data starts within a quoted field.
+    :return: the number of rows that end in the data, and whether the data
+             ends within a quoted field.
+    """
+    if '"' not in data:
+        return (0 if quoted else data.count('\n')), quoted
+    parts = data.split('"')
+    first = 1 if quoted else 0
+    rows = sum(part.count('\n') for part in parts[first::2])
+    return rows, quoted != (len(parts) % 2 == 0)
+
+
+class MethodMetrics:
+    """
+    Metrics of a writer method. The time of a recursive method includes
+    the time of the nested calls.
+    """
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0.0
+        self.dedup_hits = 0
+
+
+class TableMetrics:
+    """
+    Metrics of the writer of a table. The rows exclude the header.
+    The time includes the time of formatting rows, write_seconds only
+    the time of writing to the file.
+    """
+    def __init__(self):
+        self.calls = 0
+        self.rows = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        self.write_seconds = 0.0
+
+
+class InstrumentedFile:
+    """
+    Counts the bytes written to a file and the time spent writing.
+    """
+    def write(self, data: AnyStr) -> None:
+        start = perf_counter()
+        self.file.write(data)
+        self.metrics.write_seconds += perf_counter() - start
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self.metrics.bytes += len(data)
+
+    def close(self) -> None:
+        self.file.close()
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.file, name)
+
+    def __init__(self, file: Any, metrics: TableMetrics):
+        self.file = file
+        self.metrics = metrics
+
+
+class Metrics:
+    """
+    Collects metrics of a TransmartCopyWriter: call counts, time and
+    deduplication hits per method, rows, bytes and time per table and
+    the hits and misses of the date conversion caches.
+
+    Methods and writers are instrumented by replacing them on the
+    instance, so a writer without metrics runs without overhead.
+    """
+    def instrument_method(self,
+                          target: Any,
+                          name: str,
+                          dedup_map: Optional[str] = None) -> None:
+        """ Replaces a method of an object with a method that counts calls
+        and time. If dedup_map is specified, a call is counted as
+        deduplication hit if it does not change the size of that map.
+
+        :param target: the object.
+        :param name: the method name.
+        :param dedup_map: the name of a dict or set attribute of the object.
+        """
+        method = getattr(target, name)
+        metrics = self.methods.setdefault(name, MethodMetrics())
+        if dedup_map is None:
+            def instrumented(*args, **kwargs):
+                start = perf_counter()
+                try:
+                    return method(*args, **kwargs)
+                finally:
+                    metrics.calls += 1
+                    metrics.seconds += perf_counter() - start
+        else:
+            entries = getattr(target, dedup_map)
+
+            def instrumented(*args, **kwargs):
+                size = len(entries)
+                start = perf_counter()
+                try:
+                    return method(*args, **kwargs)
+                finally:
+                    metrics.calls += 1
+                    metrics.seconds += perf_counter() - start
+                    if len(entries) == size:
+                        metrics.dedup_hits += 1
+        setattr(target, name, instrumented)
+
+    def instrument_writer(self, table: str, writer: TsvWriter) -> None:
+        """ Instruments a table writer to count rows, bytes and time.
+        """
+        metrics = self.tables.setdefault(table, TableMetrics())
+        writerow = writer.writerow
+        write = writer.write
+        quoted = False
+
+        def instrumented_writerow(row):
+            start = perf_counter()
+            writerow(row)
+            metrics.calls += 1
+            metrics.rows += 1
+            metrics.seconds += perf_counter() - start
+
+        def instrumented_write(data: str):
+            nonlocal quoted
+            start = perf_counter()
+            write(data)
+            metrics.calls += 1
+            rows, quoted = count_rows(data, quoted)
+            metrics.rows += rows
+            metrics.seconds += perf_counter() - start
+
+        writer.writerow = instrumented_writerow
+        writer.write = instrumented_write
+        writer.file = InstrumentedFile(writer.file, metrics)
+
+    def instrument_cache(self, name: str, function: Callable) -> None:
+        """ Records the cache statistics of a function decorated with
+        functools.lru_cache, to report the hits and misses from now on.
+        """
+        self.caches[name] = (function, function.cache_info())
+
+    def report(self) -> Dict[str, Any]:
+        """ Returns the metrics as a dictionary.
+        """
+        caches = {}
+        for name, (function, start_info) in self.caches.items():
+            info = function.cache_info()
+            caches[name] = {'hits': info.hits - start_info.hits,
+                            'misses': info.misses - start_info.misses}
+        return {
+            'methods': {name: vars(metrics)
+                        for name, metrics in sorted(self.methods.items())},
+            'tables': {table: vars(metrics)
+                       for table, metrics in sorted(self.tables.items())},
+            'caches': caches
+        }
+
+    def write_json(self, path: str) -> None:
+        """ Writes the metrics report as JSON.
+        """
+        with open(path, 'w') as file:
+            json.dump(self.report(), file, indent=2)
+
+    def write_prometheus(self, path: str) -> None:
+        """ Writes the metrics in the Prometheus text format, e.g., for the
+        textfile collector of the node exporter. The file is written to a
+        temporary file first and then renamed.
+        """
+        report = self.report()
+        metrics = [
+            ('method_calls_total', 'methods', 'method', 'calls',
+             'Number of calls of a writer method.'),
+            ('method_seconds_total', 'methods', 'method', 'seconds',
+             'Time spent in a writer method.'),
+            ('method_dedup_hits_total', 'methods', 'method', 'dedup_hits',
+             'Number of calls for entities that were already written.'),
+            ('table_rows_total', 'tables', 'table', 'rows',
+             'Number of rows written to a table.'),
+            ('table_bytes_total', 'tables', 'table', 'bytes',
+             'Number of bytes written to a table.'),
+            ('table_seconds_total', 'tables', 'table', 'seconds',
+             'Time spent formatting and writing rows of a table.'),
+            ('table_write_seconds_total', 'tables', 'table', 'write_seconds',
+             'Time spent writing to the file of a table.'),
+            ('cache_hits_total', 'caches', 'function', 'hits',
+             'Number of date conversion cache hits.'),
+            ('cache_misses_total', 'caches', 'function', 'misses',
+             'Number of date conversion cache misses.')]
+        lines = []
+        for name, section, label, field, description in metrics:
+            name = 'transmart_loader_' + name
+            lines.append('# HELP {} {}'.format(name, description))
+            lines.append('# TYPE {} counter'.format(name))
+            for key, values in report[section].items():
+                lines.append('{}{{{}="{}"}} {}'.format(
+                    name, label, key, values[field]))
+        temp_path = path + '.tmp'
+        with open(temp_path, 'w') as file:
+            file.write('\n'.join(lines) + '\n')
+        os.replace(temp_path, path)
+
+    def __init__(self):
+        self.methods: Dict[str, MethodMetrics] = {}
+        self.tables: Dict[str, TableMetrics] = {}
+        self.caches: Dict[str, Any] = {}
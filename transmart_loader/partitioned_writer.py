@@ -0,0 +1,382 @@
+import multiprocessing
+import os
+import pickle
+import shutil
+import tempfile
+from os import path
+from typing import Dict, List, Optional, Tuple, Any, Set, Iterator
+from urllib.parse import quote
+
+from transmart_loader.collection_validator import CollectionValidator
+from transmart_loader.compression import Compression
+from transmart_loader.copy_writer import TransmartCopyWriter
+from transmart_loader.identifier_store import IdentifierStore
+from transmart_loader.loader_exception import LoaderException
+from transmart_loader.sink import OutputFormat
+from transmart_loader.sorting_writer import read_run
+from transmart_loader.transmart import DataCollection, Observation, \
+    ObservationBatch, TreeNode, StudyNode, ConceptNode, Study
+
+PlacedNode = Tuple[TreeNode, int, str]
+"""
+An ontology node with its hierarchy level and the path of its parent.
+"""
+
+
+class Partition:
+    def __init__(self, study_id: str, spool_dir: str):
+        """
+        The ontology subtrees and observations of a study. The
+        observation_fact rows of the observations and the observation
+        batches are spooled to files in the spool directory. The instance
+        numbers of the rows are relative to the first instance number of
+        the partition.
+
+        :param study_id: the study identifier.
+        :param spool_dir: the directory of the spool files.
+        """
+        self.study_id = study_id
+        self.nodes: List[PlacedNode] = []
+        self.skip_paths: Set[str] = set()
+        self.skip_tags: Set[Tuple[str, str]] = set()
+        name = quote(study_id, safe='')
+        self.observations_path = path.join(
+            spool_dir, '{}.observations'.format(name))
+        self.batches_path = path.join(spool_dir, '{}.batches'.format(name))
+        self.rows: List[List[Any]] = []
+        self.observation_count = 0
+        self.tag_count = 0
+        self.first_instance_num = 0
+        self.first_tag_id = 0
+
+    def add_observation(self, writer: TransmartCopyWriter,
+                        observation: Observation) -> None:
+        """ Adds the rows of an observation and its modifiers, encoded
+        with the identifier maps of the writer.
+        """
+        instance_num = self.observation_count
+        self.rows.append(writer.observation_row(
+            observation, observation.value, None, instance_num))
+        if observation.metadata:
+            for modifier, value in observation.metadata.values.items():
+                self.rows.append(writer.observation_row(
+                    observation, value, modifier, instance_num))
+        self.observation_count = self.observation_count + 1
+        if len(self.rows) >= spool_chunk_size:
+            self.flush()
+
+    def add_observation_batch(self, batch: ObservationBatch) -> None:
+        with open(self.batches_path, 'ab') as file:
+            pickle.dump([batch], file, pickle.HIGHEST_PROTOCOL)
+        self.observation_count = self.observation_count + len(batch)
+
+    def flush(self) -> None:
+        """ Appends the rows in memory to the spool file.
+        """
+        if self.rows:
+            with open(self.observations_path, 'ab') as file:
+                pickle.dump(self.rows, file, pickle.HIGHEST_PROTOCOL)
+            self.rows = []
+
+    def read_rows(self) -> Iterator[List[Any]]:
+        if path.exists(self.observations_path):
+            yield from read_run(self.observations_path)
+
+    def read_observation_batches(self) -> Iterator[ObservationBatch]:
+        if path.exists(self.batches_path):
+            yield from read_run(self.batches_path)
+
+
+spool_chunk_size = 10000
+"""
+The number of observation_fact rows per partition that are kept in memory
+before they are appended to the spool file of the partition.
+"""
+
+partition_state: Optional[Dict[str, Any]] = None
+"""
+The identifier maps and writer options used by a partition worker process.
+"""
+
+partition_tables = ['i2b2metadata/i2b2_secure',
+                    'i2b2metadata/i2b2_tags',
+                    'i2b2demodata/observation_fact']
+"""
+The tables written per partition.
+"""
+
+
+def init_partition_writer(state: bytes) -> None:
+    """ Initialises a worker process with the shared identifier maps.
+    """
+    global partition_state
+    partition_state = pickle.loads(state)
+
+
+def write_partition(output_dir: str, partition: Partition) -> str:
+    """ Writes the ontology subtrees and observations of a study to
+    a separate output directory, with the shared identifier maps.
+
+    :param output_dir: the output directory of the partition.
+    :param partition: the partition.
+    :return: the study identifier.
+    """
+    state = partition_state
+    writer = TransmartCopyWriter(output_dir, tables=partition_tables,
+                                 **state['options'])
+    try:
+        for name, values in state['maps'].items():
+            setattr(writer, name, values)
+        # Paths and tags written by other partitions are skipped
+        writer.paths |= partition.skip_paths
+        writer.tags |= partition.skip_tags
+        writer.instance_num = partition.first_instance_num
+        writer.first_tag_id = partition.first_tag_id
+        for node, level, parent_path in partition.nodes:
+            writer.write_node(node, level, parent_path)
+        observations_writer = writer.observations_writer
+        first_instance_num = partition.first_instance_num
+        for row in partition.read_rows():
+            row[7] = first_instance_num + row[7]
+            observations_writer.writerow(row)
+        for batch in partition.read_observation_batches():
+            writer.visit_observation_batch(batch)
+        writer.completed = True
+    finally:
+        writer.close()
+    return partition.study_id
+
+
+class PartitionedWriter:
+    """
+    Writes a data collection partitioned by study, with the tables of each
+    study in a separate directory, written in parallel by a pool of worker
+    processes.
+
+    The entities shared by studies are written first, to the 'shared'
+    directory: concepts, modifiers, dimensions, studies, trial visits,
+    patients, visits, relations and the ontology nodes outside study
+    nodes. This assigns the identifiers, such as patient and trial visit
+    numbers, that are then used by all partitions. The subtrees of study
+    nodes and the observations of each study, by the study of their trial
+    visit, are written to 'studies/<study id>' by the workers. Instance
+    numbers and tag ids are assigned in disjoint ranges per partition.
+    Observation batches with trial visits of multiple studies are written
+    to the shared directory.
+
+    The shared directory must be loaded before the study directories,
+    which can be loaded in any order. The study directories only contain
+    the i2b2_secure, i2b2_tags and observation_fact tables.
+
+    The collection is read in a single pass, in the order of the
+    collection fields, and validated while it is read, so the fields can
+    be generators. The shared entities that precede the ontology are
+    written first. The ontology is split before any of it is written,
+    such that every path and tag is written only once, by the shared writer
+    or the partition where it occurs first in depth-first order, as when
+    written by a single TransmartCopyWriter. The observations are encoded
+    to observation_fact rows by the parent process, with the identifiers of
+    the shared writer, and the rows and the observation batches of each
+    study are spooled to a temporary file per partition, such that memory
+    use does not depend on the number of observations. The worker of the
+    partition reads them back and only assigns instance numbers and
+    formats the rows, so the observations themselves need not be
+    picklable. The identifier maps are copied to the workers for the
+    observation batches.
+    """
+    shared_dir = 'shared'
+    studies_dir = 'studies'
+
+    def partition_dir(self, study_id: str) -> str:
+        """ Returns the output directory of the partition of a study.
+        """
+        return path.join(self.output_dir, self.studies_dir,
+                         quote(study_id, safe=''))
+
+    def split(self, collection: DataCollection, spool_dir: str) -> Tuple[
+            List[Partition], Partition, List[ObservationBatch]]:
+        """ Writes the shared entities that precede the ontology in the
+        collection and splits the ontology and observations of the
+        collection by study, in a single pass. The observations are encoded
+        to observation_fact rows with the identifiers of the shared writer.
+        The shared ontology nodes, outside study nodes, are collected in
+        a partition for the shared writer.
+
+        :param collection: the collection.
+        :param spool_dir: the directory for the spooled observations.
+        :return: the partitions, the partition of the shared ontology nodes
+                 and the observation batches of multiple studies.
+        """
+        partitions: Dict[str, Partition] = {}
+        shared = Partition(self.shared_dir, spool_dir)
+
+        def partition(study_id: str) -> Partition:
+            if study_id not in partitions:
+                partitions[study_id] = Partition(study_id, spool_dir)
+            return partitions[study_id]
+
+        def partitioned_studies() -> Iterator[Study]:
+            for study in collection.studies:
+                partition(study.study_id)
+                yield study
+
+        writer = self.shared_writer
+        writer.write_default_dimensions()
+        writer.visit(DataCollection(
+            collection.concepts, collection.modifiers, collection.dimensions,
+            partitioned_studies(), collection.trial_visits, collection.visits,
+            [], collection.patients, [], [], [], []))
+        path_owners: Dict[str, Partition] = {}
+        tag_owners: Dict[Tuple[str, str], Partition] = {}
+        stack: List[Tuple[TreeNode, int, str, Partition]] = [
+            (node, 0, '\\', shared)
+            for node in reversed(list(collection.ontology))]
+        while stack:
+            node, level, parent_path, owner = stack.pop()
+            if isinstance(node, StudyNode):
+                owner = partition(node.study.study_id)
+            owner.nodes.append((node, level, parent_path))
+            node_path = parent_path + node.name + '\\'
+            if node.metadata:
+                for tag_type in node.metadata.values:
+                    tag_key = (node_path, tag_type)
+                    if tag_key not in tag_owners:
+                        tag_owners[tag_key] = owner
+                        owner.tag_count = owner.tag_count + 1
+                    elif tag_owners[tag_key] is not owner:
+                        owner.skip_tags.add(tag_key)
+            # Leaf folder nodes are skipped by the writer
+            if not isinstance(node, (StudyNode, ConceptNode)) \
+                    and not node.children:
+                continue
+            if node_path not in path_owners:
+                path_owners[node_path] = owner
+            elif path_owners[node_path] is not owner:
+                owner.skip_paths.add(node_path)
+            stack.extend((child, level + 1, node_path, owner)
+                         for child in reversed(node.children))
+        for observation in collection.observations:
+            partition(observation.trial_visit.study.study_id) \
+                .add_observation(writer, observation)
+        shared_batches: List[ObservationBatch] = []
+        for batch in collection.observation_batches:
+            study_ids = {trial_visit.study.study_id
+                         for trial_visit in batch.trial_visits}
+            if len(study_ids) == 1:
+                partition(study_ids.pop()).add_observation_batch(batch)
+            else:
+                shared_batches.append(batch)
+        for study_partition in partitions.values():
+            study_partition.flush()
+        return list(partitions.values()), shared, shared_batches
+
+    def write_shared(self,
+                     collection: DataCollection,
+                     shared: Partition,
+                     shared_batches: List[ObservationBatch]) -> None:
+        """ Writes the shared entities that follow the observations in the
+        collection, the observation batches of multiple studies and the
+        shared ontology nodes.
+        """
+        writer = self.shared_writer
+        writer.visit(DataCollection(
+            [], [], [], [], [], [], [], [], [], collection.relation_types,
+            collection.relations, shared_batches))
+        # Paths and tags written by partitions are skipped
+        writer.paths |= shared.skip_paths
+        writer.tags |= shared.skip_tags
+        for node, level, parent_path in shared.nodes:
+            writer.write_node(node, level, parent_path)
+
+    def write_collection(self, collection: DataCollection) -> None:
+        """ Validates the collection and writes it to the output directory.
+
+        Every field of the collection is iterated once, so the fields
+        can be iterables that can only be consumed once, e.g., generators.
+        The entities are validated while they are iterated. Entities that
+        refer to missing entities are skipped and validation errors are
+        raised before the partitions are written.
+
+        :param collection: the collection to write.
+        """
+        validator = CollectionValidator(self.identifier_store)
+        spool_dir = tempfile.mkdtemp(prefix='partitions', dir=self.output_dir)
+        try:
+            validated = validator.validated(collection)
+            partitions, shared, shared_batches = self.split(
+                validated, spool_dir)
+            self.write_shared(validated, shared, shared_batches)
+            validator.report()
+            instance_num = self.shared_writer.instance_num
+            tag_id = len(self.shared_writer.tags)
+            for partition in partitions:
+                partition.first_instance_num = instance_num
+                partition.first_tag_id = tag_id
+                instance_num = instance_num + partition.observation_count
+                # Skipped tags take tag ids as well
+                tag_id = tag_id + partition.tag_count \
+                    + len(partition.skip_tags)
+            self.shared_writer.instance_num = instance_num
+            state = pickle.dumps({
+                'options': self.options,
+                'maps': {name: getattr(self.shared_writer, name)
+                         for name in TransmartCopyWriter.checkpoint_maps
+                         if name not in ['paths', 'tags']}
+            })
+            os.makedirs(path.join(self.output_dir, self.studies_dir))
+            tasks = [(self.partition_dir(partition.study_id), partition)
+                     for partition in partitions]
+            if self.workers > 1:
+                with multiprocessing.Pool(self.workers,
+                                          initializer=init_partition_writer,
+                                          initargs=(state,)) as pool:
+                    pool.starmap(write_partition, tasks, chunksize=1)
+            else:
+                init_partition_writer(state)
+                for task in tasks:
+                    write_partition(*task)
+        finally:
+            validator.close()
+            shutil.rmtree(spool_dir)
+        self.shared_writer.completed = True
+
+    def close(self) -> None:
+        """ Closes the output files of the shared entities.
+        """
+        self.shared_writer.close()
+
+    def __init__(self,
+                 output_dir: str,
+                 workers: Optional[int] = None,
+                 compression: Optional[Compression] = None,
+                 table_compression: Optional[
+                     Dict[str, Optional[Compression]]] = None,
+                 output_format: OutputFormat = OutputFormat.Tsv,
+                 threaded: bool = False,
+                 identifier_store: Optional[IdentifierStore] = None):
+        """
+        :param output_dir: the output directory, must be empty or not exist.
+        :param workers: the number of worker processes,
+                        by default the number of CPUs.
+        :param compression: the compression of the output files.
+        :param table_compression: the compression per table name.
+        :param output_format: the format of the output files.
+        :param threaded: whether to write uncompressed files
+                         in background threads.
+        :param identifier_store: the store of the shared identifier maps.
+        """
+        if path.exists(output_dir) and os.listdir(output_dir):
+            raise LoaderException(
+                'Output directory is not empty: {}'.format(output_dir))
+        self.output_dir = output_dir
+        self.workers = workers or os.cpu_count() or 1
+        self.options = {
+            'compression': compression,
+            'table_compression': table_compression,
+            'output_format': output_format,
+            'threaded': threaded
+        }
+        self.identifier_store = identifier_store
+        self.shared_writer = TransmartCopyWriter(
+            path.join(output_dir, self.shared_dir),
+            identifier_store=identifier_store, **self.options)
@@ -0,0 +1,286 @@
+import csv
+import io
+import os
+import struct
+from datetime import datetime
+from decimal import Decimal
+from enum import Enum
+from functools import lru_cache
+from typing import Sequence, Any, Optional, List, Callable, Tuple
+
+from transmart_loader.background_file import BackgroundFile
+from transmart_loader.compression import Compression, CompressedFile
+from transmart_loader.csv_types import CsvWriter
+from transmart_loader.loader_exception import LoaderException
+
+signature = b'PGCOPY\n\xff\r\n\x00'
+"""
+The signature at the start of a file in PostgreSQL binary COPY format.
+"""
+
+header = signature + struct.pack('>ii', 0, 0)
+"""
+The signature, followed by the flags field and the length of the header
+extension area, both zero.
+"""
+
+trailer = struct.pack('>h', -1)
+
+null_field = struct.pack('>i', -1)
+
+pg_epoch = datetime(2000, 1, 1)
+
+numeric_positive = 0x0000
+numeric_negative = 0x4000
+numeric_nan = 0xC000
+
+
+class PgType(Enum):
+    """
+    PostgreSQL type of a column in binary COPY format
+    """
+    Int4 = 'integer'
+    Int8 = 'bigint'
+    Numeric = 'numeric'
+    Timestamp = 'timestamp'
+    Bool = 'boolean'
+    Text = 'text'
+
+
+FieldEncoder = Callable[[Any], bytes]
+
+
+def encode_int4(value: Any) -> bytes:
+    if value is None or value == '':
+        return null_field
+    return struct.pack('>ii', 4, int(value))
+
+
+def encode_int8(value: Any) -> bytes:
+    if value is None or value == '':
+        return null_field
+    return struct.pack('>iq', 8, int(value))
+
+
+def numeric_digits(value: Any) -> Tuple[int, int, int, List[int]]:
+    """ Converts a number to the sign, weight, display scale and base 10000
+    digits of the PostgreSQL numeric representation. Integers are
+    converted directly, other numbers via their decimal string
+    representation, such that floats are written as in text format.
+    """
+    if isinstance(value, int) and not isinstance(value, bool):
+        sign = numeric_negative if value < 0 else numeric_positive
+        number = abs(value)
+        digits = []
+        while number:
+            number, digit = divmod(number, 10000)
+            digits.append(digit)
+        digits.reverse()
+        weight = len(digits) - 1
+        while digits and digits[-1] == 0:
+            digits.pop()
+        return sign, weight if digits else 0, 0, digits
+    decimal = value if isinstance(value, Decimal) else Decimal(str(value))
+    if decimal.is_nan():
+        return numeric_nan, 0, 0, []
+    if not decimal.is_finite():
+        raise LoaderException(
+            'Infinite numeric value not supported: {}'.format(value))
+    decimal_sign, decimal_digits, exponent = decimal.as_tuple()
+    sign = numeric_negative if decimal_sign else numeric_positive
+    text = ''.join(map(str, decimal_digits))
+    if exponent >= 0:
+        integer_part = text + '0' * exponent
+        fraction_part = ''
+    else:
+        integer_part = text[:exponent]
+        fraction_part = text[exponent:].rjust(-exponent, '0')
+    integer_part = integer_part.lstrip('0')
+    integer_part = integer_part.rjust(-(-len(integer_part) // 4) * 4, '0')
+    fraction_part = fraction_part.ljust(-(-len(fraction_part) // 4) * 4, '0')
+    digit_text = integer_part + fraction_part
+    digits = [int(digit_text[index:index + 4])
+              for index in range(0, len(digit_text), 4)]
+    weight = len(integer_part) // 4 - 1
+    while digits and digits[0] == 0:
+        digits.pop(0)
+        weight = weight - 1
+    while digits and digits[-1] == 0:
+        digits.pop()
+    return sign, weight if digits else 0, max(0, -exponent), digits
+
+
+def encode_numeric(value: Any) -> bytes:
+    if value is None or value == '':
+        return null_field
+    sign, weight, scale, digits = numeric_digits(value)
+    return struct.pack('>ihhHH{}H'.format(len(digits)),
+                       8 + 2 * len(digits), len(digits), weight, sign, scale,
+                       *digits)
+
+
+@lru_cache(maxsize=100000)
+def parse_timestamp(value: str) -> datetime:
+    return datetime.fromisoformat(value)
+
+
+def encode_timestamp(value: Any) -> bytes:
+    """ Encodes a timestamp without time zone, given as a datetime, date or
+    string in ISO format, as microseconds since 2000-01-01.
+    """
+    if value is None or value == '':
+        return null_field
+    if isinstance(value, str):
+        value = parse_timestamp(value)
+    elif not isinstance(value, datetime):
+        value = datetime(value.year, value.month, value.day)
+    delta = value.replace(tzinfo=None) - pg_epoch
+    microseconds = (delta.days * 86400 + delta.seconds) * 1000000 \
+        + delta.microseconds
+    return struct.pack('>iq', 8, microseconds)
+
+
+def encode_bool(value: Any) -> bytes:
+    if value is None or value == '':
+        return null_field
+    if isinstance(value, str):
+        value = value == 't'
+    return struct.pack('>i?', 1, value)
+
+
+def encode_text(value: Any) -> bytes:
+    if value is None or value == '':
+        return null_field
+    if not isinstance(value, str):
+        value = str(value)
+    data = value.encode('utf-8')
+    return struct.pack('>i', len(data)) + data
+
+
+field_encoders = {
+    PgType.Int4: encode_int4,
+    PgType.Int8: encode_int8,
+    PgType.Numeric: encode_numeric,
+    PgType.Timestamp: encode_timestamp,
+    PgType.Bool: encode_bool,
+    PgType.Text: encode_text
+}
+
+
+class PgBinaryWriter(CsvWriter):
+    """
+    Writer of files in PostgreSQL binary COPY format, which can be loaded
+    with COPY ... FROM ... WITH (FORMAT binary). Creates a new file when
+    initialised and fails when the file already exists, unless append
+    is set. If compression is specified, the compression extension is
+    appended to the path and the file is compressed in a background thread.
+
+    Fields are encoded by the type of their column. Values can be Python
+    values or text in the format written by TsvWriter, e.g., dates as
+    'YYYY-MM-DD HH:MM:SS' and booleans as 't' or 'f'. As in the
+    tab-separated output, None and empty strings are written as NULL.
+    The types must match the column types of the database table exactly,
+    because PostgreSQL does not convert binary values.
+
+    The file header is written by write_header, the trailer when the file
+    is closed. In append mode, rows are appended to a file without trailer,
+    e.g., a file truncated to a size returned by sync.
+    """
+    def write_header(self) -> None:
+        """ Writes the file header, before the first row.
+        """
+        self.file.write(header)
+
+    def writerow(self, row: Sequence[Any]) -> None:
+        if len(row) != len(self.encoders):
+            raise LoaderException('Expected {} fields, got {}: {}'.format(
+                len(self.encoders), len(row), row))
+        self.buffer.append(self.field_count)
+        self.buffer.extend([encode(value) for encode, value
+                            in zip(self.encoders, row)])
+        self.buffered_rows = self.buffered_rows + 1
+        if self.buffered_rows >= self.buffer_rows:
+            self.flush()
+
+    def writerows(self, rows: Sequence[Sequence[Any]]) -> None:
+        for row in rows:
+            self.writerow(row)
+
+    def write(self, data: str) -> None:
+        """ Writes data that is formatted as tab-separated rows, as written
+        by TsvWriter, e.g., observation shards and batches.
+        """
+        self.writerows(csv.reader(io.StringIO(data, newline=''),
+                                  dialect='excel-tab'))
+
+    def flush(self) -> None:
+        """ Writes the buffered rows to the file.
+        """
+        if self.buffer:
+            self.file.write(b''.join(self.buffer))
+            self.buffer = []
+            self.buffered_rows = 0
+
+    def sync(self) -> int:
+        """ Writes the buffered rows and flushes the file, such that
+        the file can be truncated to the returned size and appended to later.
+
+        :return: the size of the file in bytes, without trailer.
+        """
+        self.flush()
+        if hasattr(self.file, 'sync'):
+            return self.file.sync()
+        self.file.flush()
+        return os.fstat(self.file.fileno()).st_size
+
+    def close(self) -> None:
+        if self.file:
+            try:
+                self.flush()
+                self.file.write(trailer)
+            finally:
+                file = self.file
+                self.file = None
+                file.close()
+
+    def __init__(self,
+                 path: Optional[str],
+                 column_types: Sequence[PgType],
+                 compression: Optional[Compression] = None,
+                 buffer_rows: int = 10000,
+                 append: bool = False,
+                 threaded: bool = False,
+                 file: Optional[Any] = None):
+        """
+        :param path: the file path, without compression extension.
+        :param column_types: the types of the columns.
+        :param compression: the compression settings.
+        :param buffer_rows: the number of rows written at once.
+        :param append: whether to append to an existing file.
+        :param threaded: whether to write an uncompressed file
+                         in a background thread.
+        :param file: an open binary file to write to, instead of the file
+                     at the path.
+        """
+        self.file = None
+        if compression is not None:
+            path = path + compression.extension
+        self.path = path
+        if file is not None:
+            self.file = file
+        elif compression is None and threaded:
+            self.file = BackgroundFile(path, append=append, binary=True)
+        elif compression is None:
+            self.file = open(path, 'ab' if append else 'xb')
+        else:
+            self.file = CompressedFile(path, compression, append=append,
+                                       binary=True)
+        self.encoders: List[FieldEncoder] = [
+            field_encoders[column_type] for column_type in column_types]
+        self.field_count = struct.pack('>h', len(self.encoders))
+        self.buffer_rows = buffer_rows
+        self.buffer: List[bytes] = []
+        self.buffered_rows = 0
+
+    def __del__(self):
+        self.close()
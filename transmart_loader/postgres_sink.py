@@ -0,0 +1,358 @@
+import tempfile
+from typing import List, Optional, Any, AnyStr, Callable, Dict, Iterator
+
+from transmart_loader.csv_types import CsvWriter
+from transmart_loader.loader_exception import LoaderException
+from transmart_loader.pg_binary_writer import PgType, PgBinaryWriter, \
+    header as pg_binary_header, trailer as pg_binary_trailer
+from transmart_loader.sink import Sink, OutputFormat
+from transmart_loader.tsv_writer import TsvWriter
+
+try:
+    import psycopg
+except ImportError:  # psycopg is only required for the PostgreSQL sink
+    psycopg = None
+
+
+def quote_identifier(name: str) -> str:
+    return '"{}"'.format(name.replace('"', '""'))
+
+
+def copy_statement(table: str,
+                   header: List[str],
+                   output_format: OutputFormat) -> str:
+    """ Returns the COPY FROM STDIN statement for a table, e.g.,
+    'i2b2demodata/observation_fact', with the columns of the header.
+    """
+    options = "FORMAT csv, DELIMITER E'\\t'" \
+        if output_format is OutputFormat.Tsv else 'FORMAT binary'
+    return 'COPY {} ({}) FROM STDIN WITH ({})'.format(
+        '.'.join(quote_identifier(name) for name in table.split('/')),
+        ', '.join(quote_identifier(column) for column in header),
+        options)
+
+
+class CopyStream:
+    """
+    Binary file that receives the data of a table and sends it to
+    PostgreSQL with COPY FROM STDIN.
+
+    Data is spooled, in memory up to spool_memory bytes and in a temporary
+    file beyond that, until the sink loads it with load. Data written after
+    a load is spooled again and sent with another COPY statement by the
+    next load. Once the stream is started, the spooled data and all data
+    written afterwards are sent directly, in chunks of chunk_size bytes,
+    in a single COPY statement that is completed by finish.
+
+    In binary format, the header is sent at the start of every COPY
+    statement, so the writer must not write it. A segment that only
+    contains the trailer is not sent, PostgreSQL accepts binary data
+    without trailer.
+    """
+    def write(self, data: AnyStr) -> None:
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        if self.copy is None:
+            self.spool.write(data)
+            return
+        self.buffer += data
+        if len(self.buffer) >= self.chunk_size:
+            self.send()
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+    def send(self) -> None:
+        if self.buffer:
+            self.copy.write(bytes(self.buffer))
+            self.buffer = bytearray()
+
+    def spooled_chunks(self) -> Iterator[bytes]:
+        self.spool.seek(0)
+        chunk = self.spool.read(self.chunk_size)
+        while chunk:
+            yield chunk
+            chunk = self.spool.read(self.chunk_size)
+        self.spool.seek(0)
+        self.spool.truncate()
+
+    def has_data(self) -> bool:
+        size = self.spool.tell()
+        if size == len(self.trailer) and self.trailer:
+            self.spool.seek(0)
+            if self.spool.read() == self.trailer:
+                self.spool.seek(0)
+                self.spool.truncate()
+                return False
+        return size > 0
+
+    def load(self, cursor: Any) -> None:
+        """ Sends the spooled data with a COPY statement, if any.
+        """
+        if not self.has_data():
+            return
+        with cursor.copy(self.statement) as copy:
+            copy.write(self.header)
+            for chunk in self.spooled_chunks():
+                copy.write(chunk)
+
+    def start(self, cursor: Any) -> None:
+        """ Starts a COPY statement that the spooled data and all data
+        written from now on is sent to.
+        """
+        self.copy_context = cursor.copy(self.statement)
+        self.copy = self.copy_context.__enter__()
+        self.buffer += self.header
+        for chunk in self.spooled_chunks():
+            self.buffer += chunk
+            self.send()
+
+    def finish(self, error: Optional[BaseException] = None) -> None:
+        """ Completes the COPY statement, or aborts it if there is an error.
+        """
+        context = self.copy_context
+        if context is None:
+            return
+        self.copy_context = None
+        if error is None:
+            self.send()
+            self.copy = None
+            context.__exit__(None, None, None)
+        else:
+            self.copy = None
+            context.__exit__(type(error), error, error.__traceback__)
+
+    def discard(self) -> None:
+        self.spool.close()
+
+    def __init__(self,
+                 statement: str,
+                 spool_memory: int,
+                 chunk_size: int,
+                 header: bytes = b'',
+                 trailer: bytes = b''):
+        """
+        :param statement: the COPY FROM STDIN statement.
+        :param spool_memory: the number of bytes spooled in memory.
+        :param chunk_size: the number of bytes sent at once.
+        :param header: the data sent at the start of every COPY statement.
+        :param trailer: the data at the end of the table, which is not
+                        sent on its own.
+        """
+        self.statement = statement
+        self.chunk_size = chunk_size
+        self.header = header
+        self.trailer = trailer
+        self.spool = tempfile.SpooledTemporaryFile(max_size=spool_memory)
+        self.copy_context: Any = None
+        self.copy: Any = None
+        self.buffer = bytearray()
+
+
+class LiveCopyStream(CopyStream):
+    """
+    Copy stream that is started when the first data is written to it,
+    after the start callback has loaded the tables it depends on.
+    """
+    def write(self, data: AnyStr) -> None:
+        if self.error is not None:
+            # The transaction is rolled back when the sink is closed
+            return
+        try:
+            if not self.started:
+                self.started = True
+                self.start(self.before_start())
+            super().write(data)
+        except Exception as error:
+            self.error = error
+            if isinstance(error, LoaderException):
+                raise
+            raise LoaderException(
+                'Loading into PostgreSQL failed: {}'.format(error)) \
+                from error
+
+    def __init__(self,
+                 statement: str,
+                 spool_memory: int,
+                 chunk_size: int,
+                 before_start: Callable[[], Any],
+                 header: bytes = b'',
+                 trailer: bytes = b''):
+        """
+        :param before_start: loads the tables the table depends on and
+                             returns the cursor for the COPY statement.
+        """
+        super().__init__(statement, spool_memory, chunk_size, header,
+                         trailer)
+        self.before_start = before_start
+        self.started = False
+        self.error: Optional[Exception] = None
+
+
+class PostgresSink(Sink):
+    """
+    Loads the tables directly into a PostgreSQL database with
+    COPY ... FROM STDIN, without writing output files, on a single
+    connection in a single transaction.
+
+    The observation_fact table (streamed_table) is streamed to the server
+    while it is written. The tables that precede it in table_order are
+    written before the observations are visited (see Sink). When the first
+    observation rows are written, the buffered rows of those tables are
+    flushed and the tables are copied, in the order of table_order, such
+    that referenced rows are loaded before the rows that refer to them, as
+    required by foreign key constraints. Then a COPY statement for the
+    observations is started, which receives the observation rows as they
+    are written. While it is in progress, no other statement can be sent,
+    so the rows of the other tables, e.g., relations, are spooled, in memory
+    up to spool_memory bytes per table and in temporary files beyond that.
+    They are copied when the sink is closed, after the observations, as are
+    rows written to the preceding tables after the observations started.
+
+    The transaction is committed when the sink is closed after the
+    collection has been written completely, and rolled back if loading any
+    table fails or the collection was not written completely, so that
+    either all or none of the tables of a load are visible.
+
+    Rows are sent in CSV format with tab as delimiter, the format of the
+    output files, or in binary format. Requires the psycopg package:
+    pip install transmart-loader[postgres]
+    """
+    table_order = [
+        'i2b2demodata/concept_dimension',
+        'i2b2demodata/modifier_dimension',
+        'i2b2metadata/dimension_description',
+        'i2b2demodata/study',
+        'i2b2metadata/study_dimension_descriptions',
+        'i2b2demodata/trial_visit_dimension',
+        'i2b2demodata/patient_dimension',
+        'i2b2demodata/patient_mapping',
+        'i2b2demodata/visit_dimension',
+        'i2b2demodata/encounter_mapping',
+        'i2b2metadata/i2b2_secure',
+        'i2b2metadata/i2b2_tags',
+        'i2b2demodata/observation_fact',
+        'i2b2demodata/relation_types',
+        'i2b2demodata/relations'
+    ]
+    """
+    The order in which tables are loaded. Other tables are loaded last,
+    in the order in which their writers were created.
+    """
+
+    streamed_table = 'i2b2demodata/observation_fact'
+
+    def create_writer(self,
+                      table: str,
+                      header: List[str],
+                      column_types: List[PgType]) -> CsvWriter:
+        statement = copy_statement(table, header, self.output_format)
+        binary = self.output_format is OutputFormat.PgBinary
+        stream_header = pg_binary_header if binary else b''
+        stream_trailer = pg_binary_trailer if binary else b''
+        if table == self.streamed_table:
+            stream: CopyStream = LiveCopyStream(
+                statement, self.spool_memory, self.chunk_size,
+                self.load_dependencies, stream_header, stream_trailer)
+        else:
+            stream = CopyStream(statement, self.spool_memory,
+                                self.chunk_size, stream_header,
+                                stream_trailer)
+        self.streams[table] = stream
+        # The header of binary data is sent by the stream
+        writer: CsvWriter = PgBinaryWriter(None, column_types, file=stream) \
+            if binary else TsvWriter(None, file=stream)
+        self.writers[table] = writer
+        return writer
+
+    def ordered_tables(self) -> List[str]:
+        order = {table: index for index, table in enumerate(self.table_order)}
+        return sorted(self.streams, key=lambda table: order.get(
+            table, len(order)))
+
+    def load(self, tables: List[str]) -> None:
+        try:
+            for table in tables:
+                self.streams[table].load(self.cursor)
+        except Exception as error:
+            raise LoaderException(
+                'Loading into PostgreSQL failed: {}'.format(error)) \
+                from error
+
+    def load_dependencies(self) -> Any:
+        """ Flushes the writers of the tables that precede the streamed
+        table and copies those tables.
+
+        :return: the cursor for the COPY statement of the streamed table.
+        """
+        tables = self.ordered_tables()
+        dependencies = tables[:tables.index(self.streamed_table)]
+        for table in dependencies:
+            self.writers[table].flush()
+        self.load(dependencies)
+        return self.cursor
+
+    def close(self, completed: bool = True) -> None:
+        """ Completes the streamed table, copies the remaining tables and
+        commits the transaction. If the tables are incomplete, the
+        transaction is rolled back.
+
+        :param completed: whether all tables have been written completely.
+        """
+        connection = self.connection
+        try:
+            if not completed:
+                for stream in self.streams.values():
+                    try:
+                        stream.finish(LoaderException('Incomplete tables'))
+                    except Exception:
+                        pass
+                connection.rollback()
+                return
+            try:
+                for stream in self.streams.values():
+                    stream.finish()
+                self.load(self.ordered_tables())
+                connection.commit()
+            except Exception as error:
+                connection.rollback()
+                raise LoaderException(
+                    'Loading into PostgreSQL failed, the transaction '
+                    'has been rolled back: {}'.format(error)) from error
+        finally:
+            for stream in self.streams.values():
+                stream.discard()
+            connection.close()
+
+    def __init__(self,
+                 conninfo: str = '',
+                 chunk_size: int = 1 << 20,
+                 spool_memory: int = 1 << 24,
+                 output_format: OutputFormat = OutputFormat.Tsv,
+                 connect: Optional[Callable[[], Any]] = None):
+        """
+        :param conninfo: the libpq connection string, e.g.,
+                         'host=localhost dbname=transmart'.
+        :param chunk_size: the number of bytes sent at once.
+        :param spool_memory: the number of bytes per table that are
+                             spooled in memory instead of a temporary file.
+        :param output_format: the format of the rows sent.
+        :param connect: creates a connection, by default with psycopg.
+        """
+        if connect is None:
+            if psycopg is None:
+                raise LoaderException(
+                    'The PostgreSQL sink requires the psycopg package')
+
+            def connect():
+                return psycopg.connect(conninfo)
+        self.output_format = output_format
+        self.chunk_size = chunk_size
+        self.spool_memory = spool_memory
+        self.streams: Dict[str, CopyStream] = {}
+        self.writers: Dict[str, CsvWriter] = {}
+        self.connection = connect()
+        self.cursor = self.connection.cursor()
@@ -0,0 +1,198 @@
+import operator
+from time import perf_counter
+from typing import Callable, Optional, Iterable, Iterator, TypeVar, Dict, \
+    Generic
+
+from transmart_loader.console import Console
+from transmart_loader.transmart import DataCollection, collection_fields
+
+T = TypeVar('T')
+
+
+def format_bytes(count: int) -> str:
+    size = float(count)
+    for unit in ['B', 'kB', 'MB', 'GB']:
+        if size < 1000:
+            return '{:.1f} {}'.format(size, unit)
+        size = size / 1000
+    return '{:.1f} TB'.format(size)
+
+
+def format_duration(seconds: float) -> str:
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return '{}:{:02}:{:02}'.format(hours, minutes, seconds)
+
+
+class Progress:
+    def __init__(self,
+                 field: str,
+                 counts: Dict[str, int],
+                 totals: Dict[str, Optional[int]],
+                 rate: float,
+                 field_seconds: float,
+                 seconds: float,
+                 bytes_written: Optional[int]):
+        """
+        Progress of writing a data collection
+
+        :param field: the collection field that is being processed.
+        :param counts: the number of entities processed per field.
+        :param totals: the number of entities per field, if known.
+        :param rate: the number of entities of the current field processed
+                     per second since the previous report.
+        :param field_seconds: the time spent on the current field.
+        :param seconds: the time since the start of writing.
+        :param bytes_written: the number of bytes written to the output files.
+        """
+        self.field = field
+        self.counts = counts
+        self.totals = totals
+        self.rate = rate
+        self.field_seconds = field_seconds
+        self.seconds = seconds
+        self.bytes_written = bytes_written
+
+    @property
+    def eta(self) -> Optional[float]:
+        """ The estimated number of seconds until the current field is
+        completed, based on the average rate for the field. None if the
+        number of entities of the field is unknown.
+        """
+        count = self.counts.get(self.field, 0)
+        total = self.totals.get(self.field)
+        if total is None or count == 0:
+            return None
+        remaining = max(0, total - count)
+        return remaining * self.field_seconds / count
+
+    def __str__(self) -> str:
+        count = self.counts.get(self.field, 0)
+        total = self.totals.get(self.field)
+        message = '{}: {}'.format(self.field, count)
+        if total:
+            message += '/{} ({:.0%})'.format(total, min(1.0, count / total))
+        message += ', {:.0f}/s'.format(self.rate)
+        if self.bytes_written is not None:
+            message += ', {} written'.format(format_bytes(self.bytes_written))
+        message += ', elapsed {}'.format(format_duration(self.seconds))
+        eta = self.eta
+        if eta is not None:
+            message += ', ETA {}'.format(format_duration(eta))
+        return message
+
+
+def print_progress(progress: Progress) -> None:
+    Console.info(str(progress))
+
+
+class Tracked(Generic[T]):
+    """
+    An iterable that counts the items of a collection field while they are
+    iterated. Can be iterated multiple times if the underlying iterable can.
+    """
+    def __init__(self, reporter: 'ProgressReporter', field: str,
+                 items: Iterable[T]):
+        self.reporter = reporter
+        self.field = field
+        self.items = items
+
+    def __iter__(self) -> Iterator[T]:
+        return self.reporter.tracking(self.field, self.items)
+
+    def __length_hint__(self) -> int:
+        return operator.length_hint(self.items)
+
+
+class ProgressReporter:
+    """
+    Reports the progress of writing a data collection.
+
+    The number of entities processed is counted per collection field.
+    The elapsed time is checked every check_items entities, and a report is
+    passed to the callback when the time since the previous report
+    exceeds the interval. The total number of entities of a field is taken
+    from its length or length hint, if available, to estimate the
+    remaining time.
+    """
+    check_items = 256
+
+    def tracking(self, field: str, items: Iterable[T]) -> Iterator[T]:
+        """ Yields the items, counting them for the field.
+        """
+        self.start_field(field)
+        check_mask = self.check_items - 1
+        count = 0
+        for count, item in enumerate(items, 1):
+            if not count & check_mask:
+                self.counts[field] = count
+                self.check()
+            yield item
+        self.counts[field] = count
+        self.check()
+
+    def tracked(self, collection: DataCollection) -> DataCollection:
+        """ Wraps the fields of a collection in iterables that
+        count the entities and report the progress.
+
+        :param collection: the collection.
+        :return: a collection with the same entities.
+        """
+        fields = {}
+        for field in collection_fields:
+            items = getattr(collection, field)
+            total = operator.length_hint(items, -1)
+            self.totals[field] = total if total >= 0 else None
+            fields[field] = Tracked(self, field, items)
+        return DataCollection(**fields)
+
+    def start_field(self, field: str) -> None:
+        now = perf_counter()
+        if self.start is None:
+            self.start = now
+            self.last_report = now
+        self.field = field
+        self.field_start = now
+        self.last_count = 0
+        self.counts[field] = 0
+
+    def check(self) -> None:
+        if perf_counter() - self.last_report >= self.interval:
+            self.report()
+
+    def report(self) -> None:
+        """ Passes the current progress to the callback.
+        """
+        now = perf_counter()
+        count = self.counts.get(self.field, 0)
+        elapsed = now - max(self.last_report, self.field_start)
+        rate = (count - self.last_count) / elapsed if elapsed > 0 else 0.0
+        self.last_report = now
+        self.last_count = count
+        self.callback(Progress(
+            self.field,
+            dict(self.counts),
+            self.totals,
+            rate,
+            now - self.field_start,
+            now - self.start if self.start is not None else 0.0,
+            self.bytes_written() if self.bytes_written else None))
+
+    def __init__(self,
+                 callback: Callable[[Progress], None] = print_progress,
+                 interval: float = 10.0):
+        """
+        :param callback: the function that receives the progress reports,
+                         by default the reports are printed to the console.
+        :param interval: the minimum number of seconds between reports.
+        """
+        self.callback = callback
+        self.interval = interval
+        self.bytes_written: Optional[Callable[[], int]] = None
+        self.counts: Dict[str, int] = {}
+        self.totals: Dict[str, Optional[int]] = {}
+        self.field: Optional[str] = None
+        self.start: Optional[float] = None
+        self.field_start = 0.0
+        self.last_report = 0.0
+        self.last_count = 0
@@ -0,0 +1,61 @@
+from functools import lru_cache
+from typing import Callable, Sequence, Any, Optional
+
+RowEncoder = Callable[[Sequence[Any]], Optional[str]]
+
+special_characters = ['"', '\n', '\r']
+
+
+def format_field(value: Any) -> str:
+    """ Formats a field the way csv.writer does with the tab-separated
+    excel dialect: None is written as an empty string, fields containing
+    a tab, quote or line break are quoted and quotes are doubled.
+    """
+    if value is None:
+        return ''
+    text = value if isinstance(value, str) else str(value)
+    if '\t' in text or '"' in text or '\n' in text or '\r' in text:
+        return '"' + text.replace('"', '""') + '"'
+    return text
+
+
+def format_row(row: Sequence[Any]) -> str:
+    """ Formats a row the way csv.writer does, without line terminator.
+    """
+    if len(row) == 1 and (row[0] is None or row[0] == ''):
+        return '""'
+    return '\t'.join([format_field(value) for value in row])
+
+
+@lru_cache(maxsize=None)
+def row_encoder(column_count: int) -> RowEncoder:
+    """ Compiles a row encoder for rows with a fixed number of columns.
+
+    The encoder formats the row as a tab-separated line, without line
+    terminator. Instead of checking every field for characters that
+    need quoting, the joined line is checked once. If a field needs
+    quoting, the encoder returns None and the row should be formatted
+    with format_row. Rows of a different length raise a ValueError.
+
+    :param column_count: the number of columns.
+    :return: the row encoder.
+    """
+    if column_count < 2:
+        return format_row
+    names = ['f{}'.format(index) for index in range(column_count)]
+    fields = ["('' if {0} is None else {0} if isinstance({0}, str) "
+              "else str({0}))".format(name) for name in names]
+    source = '\n'.join([
+        'def encode_row(row):',
+        '    {}, = row'.format(', '.join(names)),
+        "    line = '\\t'.join(({},))".format(', '.join(fields)),
+        "    if line.count('\\t') != {} or {}:".format(
+            column_count - 1,
+            ' or '.join('{!r} in line'.format(c) for c in special_characters)),
+        '        return None',
+        '    return line',
+        ''])
+    namespace = {}
+    exec(compile(source, '<row_encoder_{}>'.format(column_count), 'exec'),
+         namespace)
+    return namespace['encode_row']
@@ -0,0 +1,267 @@
+import csv
+import io
+import os
+import stat
+from abc import ABC, abstractmethod
+from enum import Enum
+from os import path
+from typing import List, Optional, Tuple, Dict, Sequence, Any
+
+from transmart_loader.compression import Compression
+from transmart_loader.csv_types import CsvWriter
+from transmart_loader.loader_exception import LoaderException
+from transmart_loader.pg_binary_writer import PgType, PgBinaryWriter
+from transmart_loader.row_encoder import format_row
+from transmart_loader.tsv_writer import TsvWriter
+
+
+class OutputFormat(Enum):
+    """
+    Format of the output files, the value is the file extension
+    """
+    Tsv = 'tsv'
+    PgBinary = 'bin'
+
+
+class Sink(ABC):
+    """
+    Destination of the tables written by a TransmartCopyWriter.
+
+    The writer creates a CsvWriter per table with create_writer, in the
+    order of TransmartCopyWriter.init_writers, before any rows are written.
+    Rows are written in the order of the collection fields (concepts,
+    modifiers, dimensions, studies, trial visits, patients, visits,
+    ontology, observations, relation types, relations). The rows of the
+    tables of one field are interleaved, e.g., patient_mapping and
+    patient_dimension, i2b2_secure and i2b2_tags, and study and
+    study_dimension_descriptions. Dimension rows are also written while
+    visiting the ontology and observations, e.g., concepts of ontology nodes
+    and visits of observations. All table writers are closed when the
+    TransmartCopyWriter is closed, followed by the sink, which is told
+    whether the collection has been written completely.
+    """
+    persistent = False
+    """
+    Whether the tables are stored in files that can be read back and
+    truncated, as required for append mode and checkpoints.
+    """
+
+    output_format = OutputFormat.Tsv
+
+    @abstractmethod
+    def create_writer(self,
+                      table: str,
+                      header: List[str],
+                      column_types: List[PgType]) -> CsvWriter:
+        """ Creates the writer for a table and writes the header.
+
+        :param table: the schema and table name, e.g.,
+                      'i2b2demodata/observation_fact'.
+        :param header: the column names.
+        :param column_types: the column types in binary output.
+        :return: the writer for the table.
+        """
+        pass
+
+    def close(self, completed: bool = True) -> None:
+        """ Completes the output, after the table writers have been closed.
+
+        :param completed: whether all tables have been written completely,
+                          a transactional sink discards incomplete tables.
+        """
+        pass
+
+
+class FileSink(Sink):
+    """
+    Writes the tables to files in a directory, in transmart-copy format:
+    a directory per schema with a file per table. The files can be
+    compressed per table, see TransmartCopyWriter.
+
+    In append mode, existing non-empty files are opened for appending.
+    """
+    persistent = True
+
+    def table_file(self, table: str) -> Tuple[str, Optional[Compression]]:
+        """ Returns the path of the file of a table, without compression
+        extension, and the compression settings for the table.
+        """
+        table_name = table.split('/')[-1]
+        compression = self.table_compression.get(table_name, self.compression)
+        return path.join(self.directory, '{}.{}'.format(
+            table, self.output_format.value)), compression
+
+    def open_writer(self,
+                    file_path: str,
+                    compression: Optional[Compression],
+                    header: List[str],
+                    column_types: List[PgType],
+                    append: bool) -> CsvWriter:
+        """ Opens the writer for a file and writes the header,
+        unless appending.
+        """
+        if self.output_format is OutputFormat.PgBinary:
+            writer = PgBinaryWriter(file_path, column_types, compression,
+                                    append=append, threaded=self.threaded)
+            if not append:
+                writer.write_header()
+        else:
+            writer = TsvWriter(file_path, compression, append=append,
+                               threaded=self.threaded)
+            if not append:
+                writer.writerow(header)
+        return writer
+
+    def create_writer(self,
+                      table: str,
+                      header: List[str],
+                      column_types: List[PgType]) -> CsvWriter:
+        file_path, compression = self.table_file(table)
+        existing_path = file_path + (
+            compression.extension if compression is not None else '')
+        append = self.append \
+            and path.exists(existing_path) \
+            and path.getsize(existing_path) > 0
+        return self.open_writer(
+            file_path, compression, header, column_types, append)
+
+    def __init__(self,
+                 directory: str,
+                 output_format: OutputFormat = OutputFormat.Tsv,
+                 compression: Optional[Compression] = None,
+                 table_compression: Optional[
+                     Dict[str, Optional[Compression]]] = None,
+                 threaded: bool = False,
+                 append: bool = False):
+        """
+        :param directory: the output directory.
+        :param output_format: the format of the files.
+        :param compression: the compression of the files.
+        :param table_compression: the compression per table name,
+                                  e.g., 'observation_fact'.
+        :param threaded: whether to write uncompressed files
+                         in background threads.
+        :param append: whether to append to existing files.
+        """
+        self.directory = directory
+        self.output_format = output_format
+        self.compression = compression
+        self.table_compression = table_compression or {}
+        self.threaded = threaded
+        self.append = append
+
+
+class FifoSink(FileSink):
+    """
+    Writes the tables to named pipes (FIFOs) in a directory, with the same
+    paths as a FileSink, so that a loader can consume the tables while they
+    are being written.
+
+    The FIFOs are created and opened for writing when the writers are
+    created, in the order of TransmartCopyWriter.init_writers. Opening a
+    FIFO blocks until the consumer opens it for reading, so the consumer
+    must open the FIFOs in that order, or concurrently. Because the rows of
+    different tables are interleaved (see Sink) and a FIFO only buffers a
+    limited amount of data, writing blocks when the consumer does not read a
+    table. Consumers must therefore read all tables concurrently, e.g., with
+    a process per table, to avoid deadlock. The end of a table is signalled
+    when the TransmartCopyWriter is closed.
+    """
+    persistent = False
+
+    def create_writer(self,
+                      table: str,
+                      header: List[str],
+                      column_types: List[PgType]) -> CsvWriter:
+        file_path, compression = self.table_file(table)
+        fifo_path = file_path + (
+            compression.extension if compression is not None else '')
+        os.makedirs(path.dirname(fifo_path), exist_ok=True)
+        if not path.exists(fifo_path):
+            os.mkfifo(fifo_path, 0o600)
+        elif not stat.S_ISFIFO(os.stat(fifo_path).st_mode):
+            raise LoaderException(
+                'Path is not a named pipe: {}'.format(fifo_path))
+        # Opened in append mode, because the named pipe already exists
+        writer = self.open_writer(
+            file_path, compression, header, column_types, True)
+        if self.output_format is OutputFormat.PgBinary:
+            writer.write_header()
+        else:
+            writer.writerow(header)
+        return writer
+
+    def __init__(self,
+                 directory: str,
+                 output_format: OutputFormat = OutputFormat.Tsv,
+                 compression: Optional[Compression] = None,
+                 table_compression: Optional[
+                     Dict[str, Optional[Compression]]] = None,
+                 threaded: bool = False):
+        """
+        :param directory: the directory for the named pipes.
+        :param output_format: the format of the tables.
+        :param compression: the compression of the tables.
+        :param table_compression: the compression per table name,
+                                  e.g., 'observation_fact'.
+        :param threaded: whether to write uncompressed tables
+                         in background threads.
+        """
+        super().__init__(directory, output_format, compression,
+                         table_compression, threaded)
+
+
+class MemoryWriter(CsvWriter):
+    """
+    Writes tab-separated rows to a string buffer, as TsvWriter does to a
+    file. The text remains available after the writer is closed.
+    """
+    def writerow(self, row: Sequence[Any]) -> None:
+        self.file.write(format_row(row) + '\r\n')
+
+    def writerows(self, rows: Sequence[Sequence[Any]]) -> None:
+        for row in rows:
+            self.writerow(row)
+
+    def write(self, data: str) -> None:
+        """ Writes data that is already formatted as tab-separated rows.
+        """
+        self.file.write(data)
+
+    def sync(self) -> int:
+        return len(self.text.encode('utf-8'))
+
+    def close(self) -> None:
+        pass
+
+    @property
+    def text(self) -> str:
+        return self.file.getvalue()
+
+    @property
+    def rows(self) -> List[List[str]]:
+        """ The rows written, including the header, as read by csv.reader.
+        """
+        return list(csv.reader(io.StringIO(self.text, newline=''),
+                               dialect='excel-tab'))
+
+    def __init__(self):
+        self.path: Optional[str] = None
+        self.file = io.StringIO(newline='')
+
+
+class MemorySink(Sink):
+    """
+    Keeps the tables in memory as tab-separated text, e.g., for tests.
+    """
+    def create_writer(self,
+                      table: str,
+                      header: List[str],
+                      column_types: List[PgType]) -> CsvWriter:
+        writer = MemoryWriter()
+        writer.writerow(header)
+        self.tables[table] = writer
+        return writer
+
+    def __init__(self):
+        self.tables: Dict[str, MemoryWriter] = {}
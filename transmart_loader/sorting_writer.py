@@ -0,0 +1,180 @@
+import csv
+import heapq
+import io
+import os
+import pickle
+import shutil
+import sys
+import tempfile
+from typing import Sequence, Any, Callable, List, Iterator, Iterable, \
+    Optional
+
+from transmart_loader.csv_types import CsvWriter
+
+SortKey = Callable[[Sequence[Any]], Any]
+
+
+def read_run(run_path: str) -> Iterator[Sequence[Any]]:
+    """ Reads the rows of a sorted run file, in chunks.
+    """
+    with open(run_path, 'rb') as run_file:
+        while True:
+            try:
+                chunk = pickle.load(run_file)
+            except EOFError:
+                return
+            yield from chunk
+
+
+class SortingWriter(CsvWriter):
+    """
+    Writes rows to another writer in the order of a sort key, with an
+    external merge sort.
+
+    Rows are collected in memory until their estimated size exceeds the
+    memory budget. The rows are then sorted and spilled to a temporary run
+    file. When the writer is closed, the runs and the remaining rows are
+    merged in a k-way merge and written to the target writer. If there are
+    more than fan_in runs, the runs are merged in passes, in which
+    consecutive groups of fan_in runs are merged into longer runs, such that
+    the number of open run files is bounded and every row is written once
+    per pass.
+
+    The sort is stable: rows with equal keys are written in the order in
+    which they were written to this writer. The size of the rows is
+    estimated from a sample of sample_rows rows per run.
+    """
+    sample_rows = 1000
+    chunk_rows = 1000
+    fan_in = 64
+
+    def writerow(self, row: Sequence[Any]) -> None:
+        self.rows.append(row)
+        if len(self.rows) >= self.run_rows:
+            if self.run_rows == self.sample_rows:
+                self.run_rows = max(self.sample_rows, self.estimate_rows())
+                if len(self.rows) < self.run_rows:
+                    return
+            self.spill()
+
+    def writerows(self, rows: Iterable[Sequence[Any]]) -> None:
+        for row in rows:
+            self.writerow(row)
+
+    def write(self, data: str) -> None:
+        """ Writes data that is formatted as tab-separated rows.
+        """
+        self.writerows(csv.reader(io.StringIO(data, newline=''),
+                                  dialect='excel-tab'))
+
+    def estimate_rows(self) -> int:
+        """ Estimates the number of rows that fit in the memory budget,
+        from the size of the rows in memory.
+        """
+        size = sum(sys.getsizeof(row) + sum(sys.getsizeof(value)
+                                            for value in row)
+                   for row in self.rows)
+        return int(self.memory * len(self.rows) / max(1, size))
+
+    def write_run(self, rows: Iterable[Sequence[Any]]) -> str:
+        """ Writes sorted rows to a new run file.
+
+        :return: the path of the run file.
+        """
+        if self.run_dir is None:
+            self.run_dir = tempfile.mkdtemp(prefix='sort', dir=self.temp_dir)
+        run_path = os.path.join(self.run_dir,
+                                'run{}'.format(self.run_count))
+        self.run_count = self.run_count + 1
+        chunk: List[Sequence[Any]] = []
+        with open(run_path, 'wb') as run_file:
+            for row in rows:
+                chunk.append(row)
+                if len(chunk) >= self.chunk_rows:
+                    pickle.dump(chunk, run_file, pickle.HIGHEST_PROTOCOL)
+                    chunk = []
+            if chunk:
+                pickle.dump(chunk, run_file, pickle.HIGHEST_PROTOCOL)
+        return run_path
+
+    def spill(self) -> None:
+        """ Sorts the rows in memory and writes them to a run file.
+        """
+        self.rows.sort(key=self.key)
+        self.runs.append(self.write_run(self.rows))
+        self.rows = []
+        self.run_rows = self.sample_rows
+
+    def merge(self, runs: List[str]) -> Iterator[Sequence[Any]]:
+        return heapq.merge(*[read_run(run) for run in runs], key=self.key)
+
+    def merge_pass(self, runs: List[str]) -> List[str]:
+        """ Merges consecutive groups of fan_in runs into longer runs,
+        such that every row is read and written once per pass.
+
+        :return: the paths of the merged runs, in the order of the groups.
+        """
+        merged = []
+        for start in range(0, len(runs), self.fan_in):
+            group = runs[start:start + self.fan_in]
+            if len(group) == 1:
+                merged.extend(group)
+                continue
+            merged.append(self.write_run(self.merge(group)))
+            for run in group:
+                os.remove(run)
+        return merged
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        """ Merges the runs and the rows in memory, writes them to the
+        target writer and closes it.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.rows.sort(key=self.key)
+            runs = self.runs
+            while len(runs) >= self.fan_in:
+                runs = self.merge_pass(runs)
+            if runs:
+                self.writer.writerows(heapq.merge(
+                    *[read_run(run) for run in runs], self.rows,
+                    key=self.key))
+            else:
+                self.writer.writerows(self.rows)
+            self.rows = []
+        finally:
+            if self.run_dir is not None:
+                shutil.rmtree(self.run_dir)
+            self.writer.close()
+
+    @property
+    def path(self) -> Optional[str]:
+        return self.writer.path
+
+    def __init__(self,
+                 writer: CsvWriter,
+                 key: SortKey,
+                 memory: int = 1 << 28,
+                 temp_dir: Optional[str] = None):
+        """
+        :param writer: the writer of the sorted rows.
+        :param key: the sort key of a row.
+        :param memory: the memory budget for rows in bytes.
+        :param temp_dir: the directory for run files,
+                         by default the system temporary directory.
+        """
+        self.writer = writer
+        self.key = key
+        self.memory = memory
+        self.temp_dir = temp_dir
+        self.closed = False
+        self.rows: List[Sequence[Any]] = []
+        self.run_rows = self.sample_rows
+        self.runs: List[str] = []
+        self.run_count = 0
+        self.run_dir: Optional[str] = None
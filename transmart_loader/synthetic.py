@@ -0,0 +1,318 @@
+import random
+from datetime import date, datetime, timedelta, timezone
+from typing import Dict, Optional, Tuple, Callable, Iterator, List, \
+    Sequence, TypeVar, Generic
+
+from transmart_loader.transmart import DataCollection, Concept, Modifier, \
+    Dimension, DimensionType, Study, TrialVisit, Visit, Patient, TreeNode, \
+    StudyNode, ConceptNode, Observation, ObservationMetadata, RelationType, \
+    Relation, ValueType, Value, NumericalValue, CategoricalValue, DateValue, \
+    TextValue, intern_value, intern_metadata
+
+T = TypeVar('T')
+
+
+class SyntheticCollectionSettings:
+    def __init__(self,
+                 seed: int = 0,
+                 studies: int = 1,
+                 trial_visits_per_study: int = 1,
+                 patients: int = 100,
+                 visits_per_patient: Tuple[int, int] = (1, 3),
+                 observations_per_visit: Tuple[int, int] = (1, 10),
+                 concepts_per_value_type: Optional[Dict[ValueType, int]] = None,
+                 categories_per_concept: int = 5,
+                 category_skew: float = 1.0,
+                 numeric_mean: float = 50.0,
+                 numeric_deviation: float = 15.0,
+                 ontology_depth: int = 3,
+                 ontology_width: int = 4,
+                 modifiers: int = 2,
+                 metadata_probability: float = 0.1,
+                 relation_types: int = 2,
+                 relation_probability: float = 0.2,
+                 start_date: date = date(2000, 1, 1),
+                 date_range_days: int = 7300):
+        """
+        Settings for generating a synthetic data collection
+
+        Counts given as a (minimum, maximum) pair are drawn uniformly
+        from that range.
+
+        :param seed: the random seed. Equal settings produce equal collections.
+        :param studies: the number of studies.
+        :param trial_visits_per_study: the number of trial visits per study.
+        :param patients: the number of patients. Patients are assigned to the
+                         studies in turn.
+        :param visits_per_patient: the range of the number of visits per patient.
+        :param observations_per_visit: the range of the number of observations
+                                       per visit.
+        :param concepts_per_value_type: the number of concepts per value type.
+        :param categories_per_concept: the number of distinct values
+                                       of categorical concepts.
+        :param category_skew: the exponent of the Zipf distribution of
+                              categorical values, 0 for a uniform distribution.
+        :param numeric_mean: the mean of the normally distributed numerical values.
+        :param numeric_deviation: the standard deviation of numerical values.
+        :param ontology_depth: the maximum number of folder levels between
+                               a study node and the concept nodes.
+        :param ontology_width: the maximum number of children of a folder.
+        :param modifiers: the number of modifiers. A dimension is added
+                          for every modifier.
+        :param metadata_probability: the probability that an observation has
+                                     metadata, with a value for one modifier.
+        :param relation_types: the number of relation types.
+        :param relation_probability: the probability that a patient has a relation
+                                     with another patient.
+        :param start_date: the earliest visit date.
+        :param date_range_days: the number of days in which visits take place.
+        """
+        self.seed = seed
+        self.studies = studies
+        self.trial_visits_per_study = trial_visits_per_study
+        self.patients = patients
+        self.visits_per_patient = visits_per_patient
+        self.observations_per_visit = observations_per_visit
+        self.concepts_per_value_type = concepts_per_value_type \
+            if concepts_per_value_type is not None else {
+                ValueType.Numeric: 10,
+                ValueType.Categorical: 10,
+                ValueType.Date: 2,
+                ValueType.Text: 2}
+        self.categories_per_concept = categories_per_concept
+        self.category_skew = category_skew
+        self.numeric_mean = numeric_mean
+        self.numeric_deviation = numeric_deviation
+        self.ontology_depth = ontology_depth
+        self.ontology_width = ontology_width
+        self.modifiers = modifiers
+        self.metadata_probability = metadata_probability
+        self.relation_types = relation_types
+        self.relation_probability = relation_probability
+        self.start_date = start_date
+        self.date_range_days = date_range_days
+
+
+class Generated(Generic[T]):
+    """
+    An iterable of generated entities. Every iteration generates
+    the same entities again, so that the entities do not need to be
+    kept in memory.
+    """
+    def __init__(self, generate: Callable[[], Iterator[T]], length: int):
+        self.generate = generate
+        self.length = length
+
+    def __iter__(self) -> Iterator[T]:
+        return self.generate()
+
+    def __length_hint__(self) -> int:
+        return self.length
+
+
+def average(count_range: Tuple[int, int]) -> float:
+    return (count_range[0] + count_range[1]) / 2
+
+
+class SyntheticCollectionGenerator:
+    """
+    Generates reproducible synthetic data collections.
+
+    Concepts, modifiers, studies, trial visits and the ontology are
+    created in memory. Patients, visits, observations and relations are
+    generated while they are iterated. Patient and visit objects are
+    recreated for every observation that refers to them; the writer only
+    uses their identifiers.
+    """
+    def rng(self, *key) -> random.Random:
+        return random.Random('{}:{}'.format(
+            self.settings.seed, ':'.join(str(part) for part in key)))
+
+    def create_concepts(self) -> List[Concept]:
+        concepts = []
+        for value_type in ValueType:
+            for index in range(
+                    self.settings.concepts_per_value_type.get(value_type, 0)):
+                name = '{} {}'.format(value_type.name, index + 1)
+                concepts.append(Concept(
+                    'SYNTH:{}:{}'.format(value_type.name.upper(), index + 1),
+                    name,
+                    '\\Synthetic\\{}\\'.format(name),
+                    value_type))
+        return concepts
+
+    def create_tree(self, parent: TreeNode, concepts: Sequence[Concept],
+                    level: int) -> None:
+        width = self.settings.ontology_width
+        if level >= self.settings.ontology_depth or len(concepts) <= width:
+            for concept in concepts:
+                parent.add_child(ConceptNode(concept))
+            return
+        size = -(-len(concepts) // width)
+        for index in range(0, len(concepts), size):
+            folder = TreeNode('Folder {}.{}'.format(level + 1,
+                                                    index // size + 1))
+            parent.add_child(folder)
+            self.create_tree(folder, concepts[index:index + size], level + 1)
+
+    def create_ontology(self) -> List[TreeNode]:
+        ontology = []
+        for study in self.studies:
+            study_node = StudyNode(study)
+            self.create_tree(study_node, self.concepts, 0)
+            ontology.append(study_node)
+        return ontology
+
+    def patient(self, index: int) -> Patient:
+        return Patient('SUBJ{}'.format(index),
+                       'male' if self.rng('sex', index).random() < 0.5
+                       else 'female',
+                       [])
+
+    def patient_visits(self, index: int) -> List[Visit]:
+        rng = self.rng('visits', index)
+        patient = self.patient(index)
+        visits = []
+        for visit_index in range(rng.randint(
+                *self.settings.visits_per_patient)):
+            start = self.settings.start_date + timedelta(
+                days=rng.randrange(self.settings.date_range_days))
+            visits.append(Visit(patient,
+                                'VISIT{}.{}'.format(index, visit_index),
+                                'A', start, start, 'O', None, 1, []))
+        return visits
+
+    def generate_patients(self) -> Iterator[Patient]:
+        for index in range(self.settings.patients):
+            yield self.patient(index)
+
+    def generate_visits(self) -> Iterator[Visit]:
+        for index in range(self.settings.patients):
+            yield from self.patient_visits(index)
+
+    def value(self, concept: Concept, rng: random.Random) -> Value:
+        if concept.value_type is ValueType.Numeric:
+            return NumericalValue(round(rng.gauss(
+                self.settings.numeric_mean,
+                self.settings.numeric_deviation), 2))
+        if concept.value_type is ValueType.Categorical:
+            category = rng.choices(range(self.settings.categories_per_concept),
+                                   cum_weights=self.category_weights)[0]
+            return intern_value(CategoricalValue,
+                                'Category {}'.format(category + 1))
+        if concept.value_type is ValueType.Date:
+            return DateValue(self.settings.start_date + timedelta(
+                days=rng.randrange(self.settings.date_range_days)))
+        return TextValue('Text {:08x}'.format(rng.getrandbits(32)))
+
+    def metadata(self, rng: random.Random) -> Optional[ObservationMetadata]:
+        if not self.modifiers or \
+                rng.random() >= self.settings.metadata_probability:
+            return None
+        modifier = rng.choice(self.modifiers)
+        if modifier.value_type is ValueType.Numeric:
+            value = NumericalValue(rng.randrange(1000))
+            return ObservationMetadata({modifier: value})
+        return intern_metadata({modifier: CategoricalValue(
+            'Code {}'.format(rng.randrange(10)))})
+
+    def generate_observations(self) -> Iterator[Observation]:
+        for index in range(self.settings.patients):
+            rng = self.rng('observations', index)
+            trial_visits = self.trial_visits_per_study[
+                index % len(self.studies)]
+            for visit in self.patient_visits(index):
+                start = datetime.combine(visit.start_date, datetime.min.time(),
+                                         tzinfo=timezone.utc)
+                for _ in range(rng.randint(
+                        *self.settings.observations_per_visit)):
+                    concept = rng.choice(self.concepts)
+                    yield Observation(
+                        visit.patient, concept, visit,
+                        rng.choice(trial_visits),
+                        start + timedelta(minutes=rng.randrange(24 * 60)),
+                        None,
+                        self.value(concept, rng),
+                        self.metadata(rng))
+
+    def generate_relations(self) -> Iterator[Relation]:
+        if not self.relation_types or self.settings.patients < 2:
+            return
+        for index in range(self.settings.patients):
+            rng = self.rng('relations', index)
+            if rng.random() < self.settings.relation_probability:
+                other = rng.randrange(self.settings.patients - 1)
+                if other >= index:
+                    other = other + 1
+                yield Relation(self.patient(index),
+                               rng.choice(self.relation_types),
+                               self.patient(other),
+                               rng.random() < 0.5,
+                               rng.random() < 0.5)
+
+    def collection(self) -> DataCollection:
+        settings = self.settings
+        visit_count = settings.patients * average(settings.visits_per_patient)
+        observation_count = visit_count * average(
+            settings.observations_per_visit)
+        return DataCollection(
+            self.concepts,
+            self.modifiers,
+            self.dimensions,
+            self.studies,
+            [trial_visit for trial_visits in self.trial_visits_per_study
+             for trial_visit in trial_visits],
+            Generated(self.generate_visits, int(visit_count)),
+            self.create_ontology(),
+            Generated(self.generate_patients, settings.patients),
+            Generated(self.generate_observations, int(observation_count)),
+            self.relation_types,
+            Generated(self.generate_relations,
+                      int(settings.patients * settings.relation_probability)))
+
+    def __init__(self, settings: SyntheticCollectionSettings):
+        self.settings = settings
+        self.concepts = self.create_concepts()
+        self.modifiers = [
+            Modifier('SYNTH:MOD:{}'.format(index + 1),
+                     'Modifier {}'.format(index + 1),
+                     '\\Synthetic modifiers\\Modifier {}\\'.format(index + 1),
+                     ValueType.Numeric if index % 2 else ValueType.Categorical)
+            for index in range(settings.modifiers)]
+        self.dimensions = [
+            Dimension(modifier.name, modifier, DimensionType.Attribute)
+            for modifier in self.modifiers]
+        self.studies = [Study('SYNTH{}'.format(index + 1),
+                              'Synthetic study {}'.format(index + 1))
+                        for index in range(settings.studies)]
+        self.trial_visits_per_study = [
+            [TrialVisit(study, 'Week {}'.format(week), 'Week', week)
+             for week in range(1, settings.trial_visits_per_study + 1)]
+            for study in self.studies]
+        self.relation_types = [
+            RelationType('RELATION{}'.format(index + 1),
+                         'Relation type {}'.format(index + 1),
+                         index % 2 == 0, index % 3 == 0)
+            for index in range(settings.relation_types)]
+        weights = [1 / (category + 1) ** settings.category_skew
+                   for category in range(settings.categories_per_concept)]
+        self.category_weights = [sum(weights[:index + 1])
+                                 for index in range(len(weights))]
+
+
+def generate_collection(settings: Optional[SyntheticCollectionSettings] = None
+                        ) -> DataCollection:
+    """
+    Generates a reproducible synthetic data collection.
+
+    Patients, visits, observations and relations are generated lazily,
+    every time they are iterated, such that large collections can be
+    written without keeping them in memory. These fields provide
+    the (expected) number of entities as length hint.
+
+    :param settings: the settings, defaults to SyntheticCollectionSettings().
+    :return: the data collection.
+    """
+    if settings is None:
+        settings = SyntheticCollectionSettings()
+    return SyntheticCollectionGenerator(settings).collection()
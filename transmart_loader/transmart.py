@@ -1,10 +1,19 @@
 from abc import abstractmethod
-from datetime import date
+from datetime import date, datetime, timedelta
 from enum import Enum
-from typing import Any, Sequence, Iterable, Optional, Dict, List
+from types import MappingProxyType
+from typing import Any, Sequence, Iterable, Optional, Dict, List, Tuple, \
+    Type, TypeVar
 
 from pydantic import BaseModel
 
+from transmart_loader.loader_exception import LoaderException
+
+try:
+    import numpy as np
+except ImportError:  # numpy is only required for observation batches
+    np = None
+
 
 class ValueType(Enum):
     """
@@ -20,6 +29,8 @@ class Value:
     """
     An observed value
     """
+    __slots__ = ()
+
     @property
     @abstractmethod
     def value_type(self) -> ValueType:
@@ -35,6 +46,8 @@ class NumericalValue(Value):
     """
     A numerical value
     """
+    __slots__ = ('_value',)
+
     def __init__(self, value: Optional[float]):
         self._value = value
 
@@ -51,6 +64,8 @@ class DateValue(Value):
     """
     A date value
     """
+    __slots__ = ('_value',)
+
     def __init__(self, value: Optional[date]):
         self._value = value
 
@@ -67,6 +82,8 @@ class CategoricalValue(Value):
     """
     A categorical value
     """
+    __slots__ = ('_value',)
+
     def __init__(self, value: Optional[str]):
         self._value = value
 
@@ -83,6 +100,8 @@ class TextValue(Value):
     """
     A text value
     """
+    __slots__ = ('_value',)
+
     def __init__(self, value: Optional[str]):
         self._value = value
 
@@ -95,6 +114,54 @@ class TextValue(Value):
         return self._value
 
 
+V = TypeVar('V', bound=Value)
+
+InternKey = Tuple[type, type, Any, Optional[timedelta]]
+
+interned_values: Dict[InternKey, Value] = {}
+
+
+def intern_key(value_class: type, value: Any) -> InternKey:
+    """
+    Returns the key of a value in the interned values. The type of the
+    value is part of the key, because values such as 1, 1.0 and True are
+    equal. NaN is not equal to itself, all NaN values share one key.
+    Equal datetimes with different UTC offsets have different wall-clock
+    fields, so the offset is part of the key.
+    """
+    if isinstance(value, float) and value != value:
+        return value_class, float, 'NaN', None
+    utc_offset = value.utcoffset() if isinstance(value, datetime) else None
+    return value_class, type(value), value, utc_offset
+
+
+def intern_value(value_class: Type[V], value: Any) -> V:
+    """
+    Returns a shared instance of the value class for the value,
+    e.g., intern_value(CategoricalValue, 'Influenza').
+    Use this for values that occur in many observations to avoid
+    creating a new object for every observation. Interned values are
+    kept for the lifetime of the process and must not be modified.
+
+    :param value_class: the Value subclass.
+    :param value: the value.
+    :return: the shared Value instance.
+    """
+    key = intern_key(value_class, value)
+    instance = interned_values.get(key)
+    if instance is None:
+        instance = value_class(value)
+        interned_values[key] = instance
+    return instance
+
+
+def is_interned(value: Value) -> bool:
+    """
+    Checks if the value is a shared instance created by intern_value.
+    """
+    return interned_values.get(intern_key(type(value), value.value)) is value
+
+
 class DimensionType(Enum):
     """
     Type of a dimension.
@@ -167,6 +234,8 @@ class IdentifierMapping:
 
 
 class Patient:
+    __slots__ = ('identifier', 'sex', 'mappings')
+
     def __init__(self,
                  identifier: str,
                  sex: str,
@@ -239,6 +308,9 @@ class Relation:
 
 
 class Visit:
+    __slots__ = ('patient', 'identifier', 'active_status', 'start_date',
+                 'end_date', 'inout', 'location', 'length_of_stay', 'mappings')
+
     def __init__(self, patient: Patient,
                  identifier: str,
                  active_status: Optional[str],
@@ -380,6 +452,8 @@ class Dimension:
 
 
 class TrialVisit:
+    __slots__ = ('study', 'rel_time_unit', 'rel_time', 'rel_time_label')
+
     def __init__(self,
                  study: Study,
                  rel_time_label: str,
@@ -407,6 +481,8 @@ class TrialVisit:
 
 
 class ObservationMetadata:
+    __slots__ = ('values',)
+
     def __init__(self, values: Dict[Modifier, Value]):
         """
         Metadata about an observation.
@@ -417,8 +493,45 @@ class ObservationMetadata:
         """
         self.values = values
 
+    def __reduce__(self):
+        # Interned metadata are read-only mapping proxies, which cannot be
+        # pickled, and are interned again when unpickled.
+        if isinstance(self.values, MappingProxyType):
+            return intern_metadata, (dict(self.values),)
+        return ObservationMetadata, (self.values,)
+
+
+interned_metadata: Dict[
+    Tuple[Tuple[Modifier, InternKey], ...],
+    ObservationMetadata] = {}
+
+
+def intern_metadata(values: Dict[Modifier, Value]) -> ObservationMetadata:
+    """
+    Returns a shared, read-only observation metadata instance for the
+    metadata values. The values are interned as well.
+    Use this for metadata that is identical for many observations, e.g.,
+    a missing value code. Interned metadata are kept for the lifetime
+    of the process.
+
+    :param values: a map from modifier to the metadata value.
+    :return: the shared ObservationMetadata instance.
+    """
+    key = tuple((modifier, intern_key(type(value), value.value))
+                for modifier, value in values.items())
+    instance = interned_metadata.get(key)
+    if instance is None:
+        instance = ObservationMetadata(MappingProxyType({
+            modifier: intern_value(type(value), value.value)
+            for modifier, value in values.items()}))
+        interned_metadata[key] = instance
+    return instance
+
 
 class Observation:
+    __slots__ = ('patient', 'concept', 'visit', 'trial_visit', 'start_date',
+                 'end_date', 'value', 'metadata')
+
     def __init__(self,
                  patient: Patient,
                  concept: Concept,
@@ -453,6 +566,96 @@ class Observation:
         self.metadata = metadata
 
 
+class ObservationBatch:
+    missing_date = -2 ** 63
+    """
+    Epoch value of a missing start or end date (the value of NaT).
+    """
+
+    def __init__(self,
+                 patients: Sequence[Patient],
+                 concepts: Sequence[Concept],
+                 trial_visits: Sequence[TrialVisit],
+                 patient_index: Any,
+                 concept_index: Any,
+                 trial_visit_index: Any,
+                 start_date: Any,
+                 end_date: Any,
+                 value_type: Any,
+                 numeric_value: Any,
+                 text_value: Any,
+                 visits: Sequence[Visit] = (),
+                 visit_index: Any = None):
+        """
+        A batch of observations, stored column-wise in NumPy arrays
+
+        The patient, concept, trial visit and visit of an observation
+        are stored as indexes in the patients, concepts, trial_visits
+        and visits sequences. Requires numpy.
+
+        :param patients: the patients the observations are about.
+        :param concepts: the concepts of the observations.
+        :param trial_visits: the trial visits of the observations.
+        :param patient_index: per observation, the index of the patient.
+        :param concept_index: per observation, the index of the concept.
+        :param trial_visit_index: per observation, the index of the trial visit.
+        :param start_date: per observation, the start date as datetime64 or as
+                           int64 microseconds since the epoch (UTC).
+                           Missing dates are NaT or missing_date.
+        :param end_date: per observation, the end date, as for start_date,
+                         or None if all end dates are missing.
+        :param value_type: per observation, the value type code (see ValueType).
+        :param numeric_value: per observation, the float64 value of numerical
+                              observations, or the date value of date observations
+                              in microseconds since the epoch. NaN if missing.
+        :param text_value: per observation, the string value of categorical and
+                           text observations. None if missing.
+        :param visits: the visits of the observations.
+        :param visit_index: per observation, the index of the (optional) visit,
+                            -1 if the observation has no visit.
+                            None if none of the observations has a visit.
+        """
+        if np is None:
+            raise LoaderException('Observation batches require numpy')
+        self.patients = patients
+        self.concepts = concepts
+        self.trial_visits = trial_visits
+        self.visits = visits
+        self.patient_index = np.asarray(patient_index, dtype=np.intp)
+        size = len(self.patient_index)
+        self.concept_index = np.asarray(concept_index, dtype=np.intp)
+        self.trial_visit_index = np.asarray(trial_visit_index, dtype=np.intp)
+        self.visit_index = np.full(size, -1, dtype=np.intp) \
+            if visit_index is None \
+            else np.asarray(visit_index, dtype=np.intp)
+        self.start_date = ObservationBatch.epoch_microseconds(start_date, size)
+        self.end_date = ObservationBatch.epoch_microseconds(end_date, size)
+        self.value_type = np.asarray(value_type, dtype=np.int8)
+        self.numeric_value = np.full(size, np.nan) if numeric_value is None \
+            else np.asarray(numeric_value, dtype=np.float64)
+        self.text_value = np.full(size, None, dtype=object) \
+            if text_value is None \
+            else np.asarray(text_value, dtype=object)
+        for column in [self.concept_index, self.trial_visit_index,
+                       self.visit_index, self.start_date, self.end_date,
+                       self.value_type, self.numeric_value, self.text_value]:
+            if column.shape != (size,):
+                raise LoaderException(
+                    'Observation batch columns differ in length')
+
+    @staticmethod
+    def epoch_microseconds(values: Any, size: int):
+        if values is None:
+            return np.full(size, ObservationBatch.missing_date, dtype=np.int64)
+        values = np.asarray(values)
+        if values.dtype.kind == 'M':
+            return values.astype('datetime64[us]').view(np.int64)
+        return values.astype(np.int64)
+
+    def __len__(self):
+        return len(self.patient_index)
+
+
 class TreeNodeMetadata:
     """
     Metadata tags, provided as a key-value dictionary.
@@ -524,10 +727,12 @@ class DataCollection:
                  patients: Iterable[Patient],
                  observations: Iterable[Observation],
                  relation_types: Iterable[RelationType] = [],
-                 relations: Iterable[Relation] = []):
+                 relations: Iterable[Relation] = [],
+                 observation_batches: Iterable[ObservationBatch] = []):
         """
         A data collection that can be loaded into TranSMART.
-        Relation types and relations are optional, all other fields are mandatory.
+        Relation types, relations and observation batches are optional,
+        all other fields are mandatory.
 
         :param concepts: all concepts linked to observations and tree nodes.
         :param modifiers: all modifiers linked to observations and dimensions.
@@ -540,6 +745,7 @@ class DataCollection:
         :param observations: all observations in the data set.
         :param relation_types: all relation types linked to relations.
         :param relations: all relations in the data set, linked to subjects.
+        :param observation_batches: observations in column-wise batches.
         """
         self.concepts = concepts
         self.modifiers = modifiers
@@ -552,3 +758,13 @@ class DataCollection:
         self.observations = observations
         self.relation_types = relation_types
         self.relations = relations
+        self.observation_batches = observation_batches
+
+
+collection_fields = ['concepts', 'modifiers', 'dimensions', 'studies',
+                     'trial_visits', 'visits', 'ontology', 'patients',
+                     'observations', 'relation_types', 'relations',
+                     'observation_batches']
+"""
+The names of the fields of a DataCollection.
+"""
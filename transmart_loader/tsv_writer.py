@@ -1,27 +1,103 @@
-import csv
-from typing import Sequence, Any
+import os
+from typing import Sequence, Any, Optional, List
 
+from transmart_loader.background_file import BackgroundFile
+from transmart_loader.compression import Compression, CompressedFile
 from transmart_loader.csv_types import CsvWriter
+from transmart_loader.row_encoder import row_encoder, format_row, RowEncoder
 
 
 class TsvWriter(CsvWriter):
     """
     Tab-separated values writer. Creates a new file when initialised
-    and fails when the file already exists.
+    and fails when the file already exists, unless append is set.
+    If compression is specified, the compression extension is appended
+    to the path and the file is compressed in a background thread.
+    If threaded is set, an uncompressed file is also written
+    in a background thread. If an open file is specified,
+    the rows are written to that file instead.
+
+    The output is the same as that of csv.writer with the excel dialect
+    and tab as delimiter. Rows are formatted with a row encoder for the
+    number of columns of the first row (the header) and written to the
+    file in chunks of buffer_rows rows.
     """
     def writerow(self, row:  Sequence[Any]) -> None:
-        self.writer.writerow(row)
+        try:
+            line = self.encode_row(row)
+        except ValueError:
+            line = None
+        if line is None:
+            line = format_row(row)
+        self.buffer.append(line)
+        if len(self.buffer) >= self.buffer_rows:
+            self.flush()
 
     def writerows(self, rows:  Sequence[Sequence[Any]]) -> None:
-        self.writer.writerows(rows)
+        for row in rows:
+            self.writerow(row)
+
+    def write(self, data: str) -> None:
+        """ Writes data that is already formatted as tab-separated rows.
+        """
+        self.flush()
+        self.file.write(data)
+
+    def flush(self) -> None:
+        """ Writes the buffered rows to the file.
+        """
+        if self.buffer:
+            self.buffer.append('')
+            self.file.write('\r\n'.join(self.buffer))
+            self.buffer = []
+
+    def sync(self) -> int:
+        """ Writes the buffered rows and flushes the file, such that
+        the file can be truncated to the returned size and appended to later.
+
+        :return: the size of the file in bytes.
+        """
+        self.flush()
+        if hasattr(self.file, 'sync'):
+            return self.file.sync()
+        self.file.flush()
+        return os.fstat(self.file.fileno()).st_size
 
     def close(self) -> None:
         if self.file:
-            self.file.close()
+            try:
+                self.flush()
+            finally:
+                file = self.file
+                self.file = None
+                file.close()
+
+    def init_encoder(self, row: Sequence[Any]) -> Optional[str]:
+        self.encode_row = row_encoder(len(row))
+        return self.encode_row(row)
 
-    def __init__(self, path: str):
-        self.file = open(path, 'x')
-        self.writer: CsvWriter = csv.writer(self.file, delimiter='\t')
+    def __init__(self,
+                 path: Optional[str],
+                 compression: Optional[Compression] = None,
+                 buffer_rows: int = 10000,
+                 append: bool = False,
+                 threaded: bool = False,
+                 file: Optional[Any] = None):
+        self.file = None
+        if compression is not None:
+            path = path + compression.extension
+        self.path = path
+        if file is not None:
+            self.file = file
+        elif compression is None and threaded:
+            self.file = BackgroundFile(path, append=append)
+        elif compression is None:
+            self.file = open(path, 'a' if append else 'x')
+        else:
+            self.file = CompressedFile(path, compression, append=append)
+        self.buffer_rows = buffer_rows
+        self.buffer: List[str] = []
+        self.encode_row: RowEncoder = self.init_encoder
 
     def __del__(self):
         self.close()